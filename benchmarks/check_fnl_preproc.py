@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+"""
+Checks the native FNL_preproc (run_fnl_preproc_series_native: hcp_regression + hcp_filter) on a small synthetic REST
+series against a reference written out here in plain NumPy, in this order:
+
+    1. nuisance regression of the raw _Atlas.dtseries.nii: betas by least squares of the design [intercept, WM mean,
+       ventricle mean, every Movement_Regressors.txt column] on the frames with FD <= fd_th after the first
+       skip_seconds, residuals = data - design . betas on every frame
+    2. band-pass of those residuals: butter(bp_order, [lp_Hz hp_Hz] / nyquist) with the coefficients fixed below,
+       run forward then backward like Matlab / Octave filtfilt (odd reflection of 3 * (filter length - 1) frames at
+       both ends, initial conditions from the filter's steady state scaled to the first sample)
+
+The same reference the other way round (band-pass, then regress) is printed too: its difference from the native
+output shows the check tells the two orders apart.
+
+With --octave-series, a REST series FNL_preproc_Matlab already went through (REST?/ with _Atlas.dtseries.nii,
+Movement_Regressors.txt & FNL_preproc/ holding the WM / ventricle means and Octave's FNL_preproc dtseries) is run
+through the native engine too, and both FNL_preproc dtseries are compared.
+
+Usage:
+    python check_fnl_preproc.py
+    python check_fnl_preproc.py --octave-series /mnt/ASD/SUBJ001/visit1/HCP_pipe/SUBJ001/MNINonLinear/Results/REST1 \\
+        --tr 2.5 --project ASD
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from os import path
+
+import numpy as np
+import nibabel
+from nibabel.cifti2 import cifti2_axes
+
+HERE = path.dirname(path.abspath(__file__))
+
+# hcp_postprocess imports oct2py: the stand-in is enough here
+sys.path.insert(0, path.join(HERE, 'stubs'))
+sys.path.insert(1, path.dirname(HERE))
+
+import make_fixture
+import config_hcp_postprocess
+import hcp_postprocess
+
+PROJECT = 'ASD'
+
+TR = 0.8
+
+FRAMES = 200
+
+# butter(2, [0.009 0.08] / (0.5 / 0.8)): the ASD project's band-pass at TR 0.8
+BUTTER_B = [0.025264114249973536, 0.0, -0.05052822849994707, 0.0, 0.025264114249973536]
+BUTTER_A = [1.0, -3.4705965435219577, 4.552535744338801, -2.685484472418577, 0.6038070491000388]
+
+# float32 output, float64 arithmetic
+TOLERANCE = 1e-5
+
+# Octave's own float32 output & order of summation
+OCTAVE_TOLERANCE = 1e-4
+
+
+# ~~~~~~~~~~~~~~~~ REFERENCE ~~~~~~~~~~~~~~~~ #
+def reference_fd(movement, brain_radius_mm):
+    """
+    :return: Power FD per frame, 0 for the first: translations in mm, rotations (degrees) as mm of arc
+    """
+
+    params = movement[:, :6] * np.array([1.0, 1.0, 1.0] + [np.pi / 180.0 * brain_radius_mm] * 3)
+
+    return np.concatenate([[0.0], np.abs(np.diff(params, axis=0)).sum(axis=1)])
+
+
+def reference_regress(data, design, frames):
+
+    betas = np.linalg.lstsq(design[frames], data[frames], rcond=None)[0]
+
+    return data - design.dot(betas)
+
+
+def steady_state(b, a):
+    """
+    :return: initial conditions of the direct-form II transposed filter for a unit step, the system Matlab's
+             filtfilt solves: (sparse(rows, cols, vals) \\ rhs)
+    """
+
+    order = len(a) - 1
+
+    system = np.eye(order)
+    system[:, 0] += a[1:]
+    system[np.arange(order - 1), np.arange(1, order)] = -1.0
+
+    return np.linalg.solve(system, b[1:] - b[0] * a[1:])
+
+
+def direct_form_filter(b, a, data, state):
+    """
+    One pass of the filter along frames, direct-form II transposed, every column at once.
+    """
+
+    order = len(a) - 1
+    state = state.copy()
+    out = np.empty_like(data)
+
+    for frame in range(data.shape[0]):
+
+        out[frame] = b[0] * data[frame] + state[0]
+
+        for k in range(order - 1):
+            state[k] = b[k + 1] * data[frame] + state[k + 1] - a[k + 1] * out[frame]
+
+        state[order - 1] = b[order] * data[frame] - a[order] * out[frame]
+
+    return out
+
+
+def reference_filtfilt(data, b, a):
+
+    b, a = np.asarray(b, dtype=np.float64), np.asarray(a, dtype=np.float64)
+
+    pad = 3 * (max(len(a), len(b)) - 1)
+
+    padded = np.vstack([2 * data[0] - data[pad:0:-1], data, 2 * data[-1] - data[-2:-pad - 2:-1]])
+
+    zi = steady_state(b, a)[:, np.newaxis]
+
+    forward = direct_form_filter(b, a, padded, zi * padded[0])[::-1]
+
+    backward = direct_form_filter(b, a, forward, zi * forward[0])[::-1]
+
+    return backward[pad:-pad]
+
+
+# ~~~~~~~~~~~~~~~~ CHECKS ~~~~~~~~~~~~~~~~ #
+def relative_error(result, expected):
+
+    if result.shape != expected.shape:
+        return np.inf
+
+    return np.max(np.abs(result - expected)) / max(np.max(np.abs(expected)), 1e-12)
+
+
+def write_series(series_dir, series_name, brain_models, seed=0):
+    """
+    A REST series of FRAMES frames: slow drift + nuisance signals + noise, with motion spikes above fd_th.
+
+    :return: tuple (dense data (frames, grayordinates) float32, movement, wm_mean, vent_mean)
+    """
+
+    random = np.random.RandomState(seed)
+
+    fnl_preproc_dir = path.join(series_dir, 'FNL_preproc')
+
+    os.makedirs(fnl_preproc_dir)
+
+    movement = np.cumsum(random.randn(FRAMES, 6) * 0.02, axis=0)
+    movement[FRAMES // 3::17, :3] += 0.4
+    movement = np.hstack([movement, np.vstack([np.zeros((1, 6)), np.diff(movement, axis=0)])])
+
+    wm_mean = 1000 + np.cumsum(random.randn(FRAMES))
+    vent_mean = 800 + np.cumsum(random.randn(FRAMES))
+
+    design = np.column_stack([np.ones(FRAMES), wm_mean, vent_mean, movement])
+
+    grayordinates = len(brain_models)
+
+    drift = np.sin(np.linspace(0, 3 * np.pi, FRAMES))[:, np.newaxis] * random.randn(grayordinates) * 20
+
+    data = (design.dot(random.randn(design.shape[1], grayordinates) * 0.5) + 5000 + drift +
+            random.randn(FRAMES, grayordinates) * 10).astype(np.float32)
+
+    make_fixture.write_cifti(path.join(series_dir, series_name + '_Atlas.dtseries.nii'), data,
+                             (cifti2_axes.SeriesAxis(0, TR, FRAMES, unit='SECOND'), brain_models),
+                             'NIFTI_INTENT_CONNECTIVITY_DENSE_SERIES')
+
+    text_files = [(path.join(series_dir, 'Movement_Regressors.txt'), movement)
+                  , (path.join(fnl_preproc_dir, series_name + '_wm_mean.txt'), wm_mean)
+                  , (path.join(fnl_preproc_dir, series_name + '_vent_mean.txt'), vent_mean)]
+
+    for text_path, values in text_files:
+        np.savetxt(text_path, values, fmt='%.6f')
+
+    # THE REFERENCE READS WHAT THE ENGINE READS, ROUNDED TO 6 DECIMALS
+    movement, wm_mean, vent_mean = [np.loadtxt(text_path) for text_path, values in text_files]
+
+    return data, movement, wm_mean, vent_mean
+
+
+def run_native(series_dir, series_name, project_config, tr, fnl_preproc_dir, workers=2):
+
+    return np.asarray(nibabel.load(hcp_postprocess.run_fnl_preproc_series_native(
+        fnl_preproc_dir, project_config, series_name, tr, fnl_preproc_dir, series_dir, workers)).get_fdata())
+
+
+def check_synthetic(work_dir):
+
+    project_config = dict(config_hcp_postprocess.configured_projects[PROJECT])
+
+    series_dir = path.join(work_dir, 'REST1')
+
+    data, movement, wm_mean, vent_mean = write_series(series_dir, 'REST1', make_fixture.dense_axis(
+        2000, make_fixture.SCALES['small']['epi_shape']))
+
+    # 1 MB BLOCKS -> SEVERAL BLOCKS OF GRAYORDINATES, 2 AT ONCE
+    config_hcp_postprocess.native_settings['regress_chunk_mb'] = 1
+
+    native = run_native(series_dir, 'REST1', project_config, TR, path.join(series_dir, 'FNL_preproc'))
+
+    fd = reference_fd(movement, project_config['brain_radius_in_mm'])
+
+    frames = fd <= project_config['fd_th']
+    frames[:int(project_config['skip_seconds'] / TR)] = False
+
+    design = np.column_stack([np.ones(FRAMES), wm_mean, vent_mean, movement])
+
+    raw = np.asarray(data, dtype=np.float64)
+
+    expected = reference_filtfilt(reference_regress(raw, design, frames), BUTTER_B, BUTTER_A)
+
+    other_order = reference_regress(reference_filtfilt(raw, BUTTER_B, BUTTER_A), design, frames)
+
+    error = relative_error(native, expected)
+
+    print 'FD: %s of %s frames fit the betas (FD <= %s, first %s s skipped)' % (frames.sum(), FRAMES,
+                                                                              project_config['fd_th'],
+                                                                              project_config['skip_seconds'])
+
+    print 'regress, then band-pass: max relative error %.2g: %s' % (error, 'ok' if error <= TOLERANCE else 'FAILED')
+
+    print 'band-pass, then regress: max relative difference %.2g (the other order, for scale)' % relative_error(
+        native, other_order)
+
+    return error > TOLERANCE
+
+
+def check_octave(work_dir, series_dir, tr, project):
+
+    series_dir = path.abspath(series_dir)
+    series_name = path.basename(series_dir)
+
+    octave_path = path.join(series_dir, 'FNL_preproc', series_name + '_FNL_preproc_Atlas.dtseries.nii')
+
+    # THE NATIVE OUTPUT GOES NEXT TO COPIES OF THE MEANS, NEVER OVER OCTAVE'S
+    fnl_preproc_dir = path.join(work_dir, 'native_FNL_preproc')
+
+    os.makedirs(fnl_preproc_dir)
+
+    for name in ('_wm_mean.txt', '_vent_mean.txt'):
+        shutil.copy(path.join(series_dir, 'FNL_preproc', series_name + name), fnl_preproc_dir)
+
+    native = run_native(series_dir, series_name, dict(config_hcp_postprocess.configured_projects[project]), tr,
+                        fnl_preproc_dir)
+
+    error = relative_error(native, np.asarray(nibabel.load(octave_path).get_fdata()))
+
+    print '%s: max relative error %.2g vs FNL_preproc_Matlab: %s' % (series_name, error,
+                                                                    'ok' if error <= OCTAVE_TOLERANCE else 'FAILED')
+
+    return error > OCTAVE_TOLERANCE
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Checks the native FNL_preproc against a NumPy reference / Octave.')
+
+    parser.add_argument('--octave-series', help='MNINonLinear/Results/REST? folder FNL_preproc_Matlab already ran on')
+    parser.add_argument('--tr', type=float, help='TR of that series (seconds)')
+    parser.add_argument('--project', default=PROJECT, choices=sorted(config_hcp_postprocess.configured_projects),
+                        help='project config of that series [default=%s]' % PROJECT)
+    parser.add_argument('--keep', help='write the synthetic files here and keep them')
+
+    args = parser.parse_args()
+
+    if args.octave_series and not args.tr:
+        parser.error('--octave-series needs --tr')
+
+    work_dir = args.keep or tempfile.mkdtemp(prefix='check_fnl_preproc_')
+
+    if not path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    try:
+        failures = check_synthetic(work_dir)
+
+        if args.octave_series:
+            failures += check_octave(work_dir, args.octave_series, args.tr, args.project)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
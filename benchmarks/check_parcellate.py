@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Checks the native parcellation (hcp_cifti.parcellate) on a small synthetic dtseries / dlabel pair built like the
+benchmark fixture's (make_fixture.py): every parcel's time-series must be the unweighted mean of its grayordinates,
+what 'wb_command -cifti-parcellate <dtseries> <dlabel> COLUMN <out>' computes, within float32 tolerance. Runs with a
+chunk size small enough that the dtseries is read in many blocks of grayordinates.
+
+With --wb-command, the same pair also goes through a real wb_command and both ptseries are compared.
+
+Usage:
+    python check_parcellate.py
+    python check_parcellate.py --wb-command /usr/bin/wb_command --keep /tmp/parcellate_check
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+from os import path
+
+import numpy as np
+import nibabel
+from nibabel.cifti2 import cifti2_axes
+
+HERE = path.dirname(path.abspath(__file__))
+
+sys.path.insert(0, path.dirname(HERE))
+
+import make_fixture
+import hcp_cifti
+
+ATLASES = [('Gordon', 333), ('HCP', 360)]
+
+FRAMES = 150
+
+# float32 output, float64 sums
+TOLERANCE = 1e-5
+
+
+def reference_means(dense_data, label_values):
+    """
+    :param dense_data: float64 array (frames, grayordinates)
+    :param label_values: label key of each grayordinate
+    :return: float64 array (frames, parcels), parcels in ascending key order, unlabeled & empty keys left out
+    """
+
+    keys = [key for key in np.unique(label_values) if key != hcp_cifti.UNLABELED_KEY]
+
+    return np.column_stack([dense_data[:, label_values == key].mean(axis=1) for key in keys])
+
+
+def check(work_dir, wb_command=None):
+
+    brain_models = make_fixture.dense_axis(3000, make_fixture.SCALES['small']['epi_shape'])
+
+    dense_data = np.random.RandomState(0).randn(FRAMES, len(brain_models)).astype(np.float32) * 100 + 1000
+
+    dtseries_path = path.join(work_dir, 'check.dtseries.nii')
+
+    make_fixture.write_cifti(dtseries_path, dense_data,
+                             (cifti2_axes.SeriesAxis(0, 0.8, FRAMES, unit='SECOND'), brain_models),
+                             'NIFTI_INTENT_CONNECTIVITY_DENSE_SERIES')
+
+    make_fixture.make_labels(work_dir, ATLASES, brain_models)
+
+    dlabel_paths = [path.join(work_dir, atlas, 'fsLR', atlas + '.subcortical.32k_fs_LR.dlabel.nii')
+                    for atlas, parcels in ATLASES]
+
+    # 20 GRAYORDINATES (ALL FRAMES) PER BLOCK -> 150 BLOCKS
+    results = hcp_cifti.parcellate(dtseries_path, dlabel_paths, max_chunk_bytes=FRAMES * 8 * 20)
+
+    failures = 0
+
+    for (atlas, parcels), dlabel_path, (parcel_series, series_axis, parcel_axis) in zip(ATLASES, dlabel_paths,
+                                                                                        results):
+
+        label_values = np.rint(np.asanyarray(nibabel.load(dlabel_path).dataobj)[0]).astype(np.int64)
+
+        expected = reference_means(np.asarray(dense_data, dtype=np.float64), label_values)
+
+        error = np.max(np.abs(parcel_series - expected) / np.maximum(np.abs(expected), 1))
+
+        ok = parcel_series.shape == expected.shape and error <= TOLERANCE and len(parcel_axis) == expected.shape[1]
+
+        print '%-8s %s parcels, %s frames, max relative error %.2g vs dense means: %s' % (
+            atlas, parcel_series.shape[1], parcel_series.shape[0], error, 'ok' if ok else 'FAILED')
+
+        failures += not ok
+
+        if wb_command:
+
+            wb_path = path.join(work_dir, atlas + '.wb.ptseries.nii')
+
+            subprocess.check_call([wb_command, '-cifti-parcellate', dtseries_path, dlabel_path, 'COLUMN', wb_path])
+
+            wb_series = np.asarray(nibabel.load(wb_path).get_fdata())
+
+            wb_error = np.max(np.abs(parcel_series - wb_series) / np.maximum(np.abs(wb_series), 1)) \
+                if wb_series.shape == parcel_series.shape else np.inf
+
+            print '%-8s max relative error %.2g vs wb_command: %s' % (atlas, wb_error,
+                                                                      'ok' if wb_error <= TOLERANCE else 'FAILED')
+
+            failures += wb_error > TOLERANCE
+
+    return failures
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Checks hcp_cifti.parcellate against dense means / wb_command.')
+
+    parser.add_argument('--wb-command', help='real wb_command to compare with')
+    parser.add_argument('--keep', help='write the synthetic files here and keep them')
+
+    args = parser.parse_args()
+
+    work_dir = args.keep or tempfile.mkdtemp(prefix='check_parcellate_')
+
+    if not path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    try:
+        failures = check(work_dir, args.wb_command)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+"""
+Builds a synthetic HCP output tree for benchmarking hcp_postprocess offline: subjects with N REST series of T
+frames (4D NIfTI, dense time-series CIFTI, movement regressors), T1 / T2, wmparc, surfaces, a label directory of
+dense label CIFTIs, the program templates, a FAKE FSL_DIR and stub binaries (see stubs/stub_tool.py).
+
+Shapes follow the HCP 'hcp' scale (2mm MNI 91x109x91 EPI, 0.7mm T1, 91282 grayordinates) or a 'small' scale for
+quick runs. Everything run_benchmark.py needs to point hcp_postprocess at the tree is written to fixture.json.
+
+Subjects live under <root>/mnt/<project>/<subject>/<visit>/HCP_pipe/<subject>, so hcp_postprocess infers the
+'rushmore' environment and the project from the path.
+
+Usage:
+    python make_fixture.py /tmp/hcp_bench --series 4 --frames 400 --scale hcp
+"""
+
+import os
+import sys
+import json
+import gzip
+import stat
+import shutil
+import argparse
+from os import path
+
+import numpy as np
+import nibabel
+from nibabel.cifti2 import cifti2_axes
+
+HERE = path.dirname(path.abspath(__file__))
+
+STUB_TOOL = path.join(HERE, 'stubs', 'stub_tool.py')
+
+STUB_TOOLS = ['wb_command', 'fslmaths', 'fslmeants', 'slices', 'flirt', 'octave']
+
+FIXTURE_FILE_NAME = 'fixture.json'
+
+SCALES = {
+
+    'small': {
+        'epi_shape'         : (20, 24, 20),
+        't1_shape'          : (40, 48, 40),
+        't1_voxel_mm'       : 1.0,
+        'mni_1mm_shape'     : (46, 55, 46),
+        'grayordinates'     : 3000
+    },
+
+    'hcp': {
+        'epi_shape'         : (91, 109, 91),
+        't1_shape'          : (260, 311, 260),
+        't1_voxel_mm'       : 0.7,
+        'mni_1mm_shape'     : (182, 218, 182),
+        'grayordinates'     : 91282
+    }
+}
+
+# HCP 91282 grayordinates: 29696 left & 29716 right cortex vertices (of 32492 each), 31870 subcortical voxels
+HCP_GRAYORDINATES = (29696, 29716, 31870)
+SURFACE_VERTICES = 32492
+SUBCORTICAL_STRUCTURES = ['accumbens_left', 'accumbens_right', 'amygdala_left', 'amygdala_right', 'caudate_left',
+                          'caudate_right', 'cerebellum_left', 'cerebellum_right', 'hippocampus_left',
+                          'hippocampus_right', 'pallidum_left', 'pallidum_right', 'putamen_left', 'putamen_right',
+                          'thalamus_left', 'thalamus_right', 'brain_stem', 'diencephalon_ventral_left',
+                          'diencephalon_ventral_right']
+
+DEFAULT_ATLASES = [('Gordon', 333), ('Power', 264), ('Yeo', 17)]
+
+# wmparc labels inside the mask thresholds of config_hcp_postprocess (ventricles 4 / 43, white matter ~3000 / ~4000)
+WMPARC_LABELS = {'other': 17, 'vent_L': 4, 'vent_R': 43, 'wm_R': 3000, 'wm_L': 4000}
+
+
+def mni_affine(shape, voxel_mm):
+
+    affine = np.diag([-voxel_mm, voxel_mm, voxel_mm, 1.0])
+    affine[:3, 3] = [voxel_mm * (shape[0] - 1) / 2.0, -voxel_mm * (shape[1] - 1) / 2.0,
+                     -voxel_mm * (shape[2] - 1) / 2.0]
+
+    return affine
+
+
+def ellipsoid(shape, radius_fraction, offset=(0, 0, 0)):
+    """
+    :return: boolean volume, an ellipsoid with radii = radius_fraction * shape, centred (+ offset voxels)
+    """
+
+    grid = np.ogrid[tuple(slice(0, size) for size in shape)]
+
+    distance = sum(((axis - (size - 1) / 2.0 - shift) / (radius_fraction * size)) ** 2
+                   for axis, size, shift in zip(grid, shape, offset))
+
+    return distance <= 1.0
+
+
+def write_volume(file_path, shape, voxel_mm, frames=1, tr=1.0, dtype=np.float32, make_frame=None):
+    """
+    Writes a 3D / 4D .nii.gz frame by frame (so an HCP-sized series never has to be in memory at once).
+
+    :param make_frame: function(frame number) -> 3D array; None = zeros
+    """
+
+    header = nibabel.Nifti1Header()
+    header.set_data_dtype(dtype)
+    header.set_data_shape(tuple(shape) + ((frames,) if frames > 1 else ()))
+    header.set_zooms((voxel_mm,) * 3 + ((tr,) if frames > 1 else ()))
+    header.set_xyzt_units('mm', 'sec')
+    header.set_qform(mni_affine(shape, voxel_mm), code=4)
+    header.set_sform(mni_affine(shape, voxel_mm), code=4)
+    header['vox_offset'] = 352
+
+    f = gzip.open(file_path, 'wb', compresslevel=1)
+
+    try:
+        header.write_to(f)
+        f.write('\x00' * (352 - f.tell()))
+
+        for frame in range(frames):
+            data = make_frame(frame) if make_frame else np.zeros(shape)
+            f.write(np.asarray(data, dtype=dtype).tostring(order='F'))
+    finally:
+        f.close()
+
+
+def dense_axis(grayordinates, epi_shape):
+    """
+    :param grayordinates: total number, split between cortex & subcortical volume like HCP's 91282
+    :return: nibabel BrainModelAxis (left & right cortex, then the subcortical structures in the EPI grid)
+    """
+
+    left, right = [grayordinates * count // sum(HCP_GRAYORDINATES) for count in HCP_GRAYORDINATES[:2]]
+    voxels = grayordinates - left - right
+
+    axis = None
+
+    for name, count in (('CortexLeft', left), ('CortexRight', right)):
+
+        vertex_mask = np.zeros(SURFACE_VERTICES, dtype=bool)
+        vertex_mask[np.linspace(0, SURFACE_VERTICES - 1, count).astype(int)] = True
+
+        surface = cifti2_axes.BrainModelAxis.from_mask(vertex_mask, name=name)
+        axis = surface if axis is None else axis + surface
+
+    candidates = np.flatnonzero(ellipsoid(epi_shape, 0.3))
+
+    if voxels > candidates.size:
+        raise ValueError('%s subcortical grayordinates do not fit in a %s volume, use a bigger scale'
+                         % (voxels, 'x'.join(str(size) for size in epi_shape)))
+
+    chosen = candidates[np.linspace(0, candidates.size - 1, voxels).astype(int)]
+
+    for structure, structure_voxels in zip(SUBCORTICAL_STRUCTURES,
+                                           np.array_split(chosen, len(SUBCORTICAL_STRUCTURES))):
+
+        if not structure_voxels.size:
+            continue
+
+        voxel_mask = np.zeros(int(np.prod(epi_shape)), dtype=bool)
+        voxel_mask[structure_voxels] = True
+
+        axis = axis + cifti2_axes.BrainModelAxis.from_mask(voxel_mask.reshape(epi_shape),
+                                                          affine=mni_affine(epi_shape, 2.0), name=structure)
+
+    return axis
+
+
+def write_cifti(file_path, data, axes, intent):
+
+    image = nibabel.Cifti2Image(data, header=axes)
+    image.nifti_header.set_intent(intent)
+
+    nibabel.save(image, file_path)
+
+
+def make_labels(labels_dir, atlases, brain_models):
+    """
+    One <atlas>/fsLR/<atlas>.subcortical.32k_fs_LR.dlabel.nii per atlas: contiguous runs of grayordinates per
+    parcel, ~5% unlabelled (key 0, like the medial wall).
+
+    :param atlases: list of (name, number of parcels)
+    """
+
+    grayordinates = len(brain_models)
+
+    for atlas_num, (atlas, parcels) in enumerate(atlases):
+
+        label_dir = path.join(labels_dir, atlas, 'fsLR')
+
+        if not path.exists(label_dir):
+            os.makedirs(label_dir)
+
+        keys = 1 + np.arange(grayordinates) * parcels // grayordinates
+        keys[np.random.RandomState(atlas_num).rand(grayordinates) < 0.05] = 0
+
+        rng = np.random.RandomState(100 + atlas_num)
+        table = {0: ('???', (0.0, 0.0, 0.0, 0.0))}
+        table.update((key, ('%s_%03d' % (atlas, key), tuple(rng.rand(3)) + (1.0,))) for key in range(1, parcels + 1))
+
+        write_cifti(path.join(label_dir, atlas + '.subcortical.32k_fs_LR.dlabel.nii'),
+                    keys[None, :].astype(np.float32),
+                    (cifti2_axes.LabelAxis([atlas], [table]), brain_models),
+                    'NIFTI_INTENT_CONNECTIVITY_DENSE_LABELS')
+
+
+def make_stub_bin(bin_dir):
+    """
+    One executable per tool in bin_dir, each running stubs/stub_tool.py with this interpreter.
+    """
+
+    if not path.exists(bin_dir):
+        os.makedirs(bin_dir)
+
+    for tool in STUB_TOOLS:
+
+        wrapper = path.join(bin_dir, tool)
+
+        with open(wrapper, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (sys.executable, STUB_TOOL, tool))
+
+        os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def make_program_dir(prog_dir, scale):
+    """
+    templates/ next to the (virtual) hcp_postprocess.py: scene template & MNI152_T1_1mm_brain.
+    """
+
+    templates_dir = path.join(prog_dir, 'templates')
+
+    if not path.exists(templates_dir):
+        os.makedirs(templates_dir)
+
+    with open(path.join(templates_dir, 'image_template_temp.scene'), 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<SceneFile Version="3">\n')
+        for template in ('T1_IMG', 'T2_IMG', 'RPIAL', 'LPIAL', 'RWHITE', 'LWHITE'):
+            f.write('    <Object Type="pathName" Name="%s">%s_PATH</Object>\n' % (template, template))
+            f.write('    <Object Type="string" Name="%s_file">%s_NAME</Object>\n' % (template, template))
+        f.write('</SceneFile>\n')
+
+    shape = SCALES[scale]['mni_1mm_shape']
+    brain = ellipsoid(shape, 0.4)
+
+    write_volume(path.join(templates_dir, 'MNI152_T1_1mm_brain.nii.gz'), shape, 1.0, dtype=np.int16,
+                 make_frame=lambda frame: brain * 5000)
+
+
+def make_subject(output_folder, subject, series, frames, tr, scale, brain_models, has_t2=True, seed=0):
+    """
+    Writes one subject's HCP tree: unprocessed/NIFTI REST series, MNINonLinear T1 / T2 / wmparc / surfaces and
+    Results/REST? (4D epi, _Atlas.dtseries.nii, Movement_Regressors.txt).
+    """
+
+    settings = SCALES[scale]
+    epi_shape, t1_shape = settings['epi_shape'], settings['t1_shape']
+
+    mni_dir = path.join(output_folder, 'MNINonLinear')
+    raw_dir = path.join(output_folder, 'unprocessed', 'NIFTI')
+    surface_dir = path.join(mni_dir, 'fsaverage_LR32k')
+
+    for directory in (raw_dir, path.join(mni_dir, 'ROIs'), surface_dir, path.join(mni_dir, 'Results')):
+        if not path.exists(directory):
+            os.makedirs(directory)
+
+    rng = np.random.RandomState(seed)
+
+    # STRUCTURALS
+    head, brain = ellipsoid(t1_shape, 0.45), ellipsoid(t1_shape, 0.38)
+
+    write_volume(path.join(mni_dir, 'T1w_restore.nii.gz'), t1_shape, settings['t1_voxel_mm'], dtype=np.int16,
+                 make_frame=lambda frame: head * 400 + brain * 600)
+    write_volume(path.join(mni_dir, 'T1w_restore_brain.nii.gz'), t1_shape, settings['t1_voxel_mm'], dtype=np.int16,
+                 make_frame=lambda frame: brain * 1000)
+
+    if has_t2:
+        write_volume(path.join(mni_dir, 'T2w_restore.nii.gz'), t1_shape, settings['t1_voxel_mm'], dtype=np.int16,
+                     make_frame=lambda frame: head * 800 + brain * 200)
+
+    # WMPARC (2mm): left / right white matter & ventricles thick enough to survive the mask erosion
+    wmparc = np.where(ellipsoid(epi_shape, 0.45), WMPARC_LABELS['other'], 0)
+    centre = [(size - 1) / 2.0 for size in epi_shape]
+    white_matter = ellipsoid(epi_shape, 0.38)
+    left_half = (np.arange(epi_shape[0]) > centre[0])[:, None, None]
+    wmparc[white_matter & left_half] = WMPARC_LABELS['wm_L']
+    wmparc[white_matter & ~left_half] = WMPARC_LABELS['wm_R']
+
+    half_width = [max(3, size // 10) for size in epi_shape]
+    for label, x_offset in (('vent_L', half_width[0]), ('vent_R', -half_width[0])):
+        x_centre = int(centre[0] + x_offset)
+        wmparc[x_centre - half_width[0] // 2 - 1:x_centre + half_width[0] // 2 + 2,
+               int(centre[1]) - half_width[1]:int(centre[1]) + half_width[1] + 1,
+               int(centre[2]) - half_width[2]:int(centre[2]) + half_width[2] + 1] = WMPARC_LABELS[label]
+
+    write_volume(path.join(mni_dir, 'ROIs', 'wmparc.2.nii.gz'), epi_shape, 2.0, dtype=np.int32,
+                 make_frame=lambda frame: wmparc)
+
+    for hemisphere in ('L', 'R'):
+        for surface in ('white', 'pial'):
+            open(path.join(surface_dir, '%s.%s.%s.32k_fs_LR.surf.gii' % (subject, hemisphere, surface)), 'w').close()
+
+    with open(path.join(surface_dir, subject + '.32k_fs_LR.wb.spec'), 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<CaretSpecFile Version="1.0">\n</CaretSpecFile>\n')
+
+    # REST SERIES: written once, copied for the other series
+    brain_mask = ellipsoid(epi_shape, 0.4)
+    baseline = brain_mask * 1000.0 + rng.rand(*epi_shape) * 50
+
+    first_epi = first_cifti = None
+
+    for series_num in range(1, series + 1):
+
+        series_name = 'REST%s' % series_num
+        result_dir = path.join(mni_dir, 'Results', series_name)
+
+        if not path.exists(result_dir):
+            os.makedirs(result_dir)
+
+        epi = path.join(result_dir, series_name + '.nii.gz')
+        cifti = path.join(result_dir, series_name + '_Atlas.dtseries.nii')
+
+        if first_epi is None:
+
+            write_volume(epi, epi_shape, 2.0, frames=frames, tr=tr,
+                         make_frame=lambda frame: baseline + rng.standard_normal(epi_shape) * 10)
+
+            write_cifti(cifti, (1000 + rng.standard_normal((frames, len(brain_models))) * 10).astype(np.float32),
+                        (cifti2_axes.SeriesAxis(0, tr, frames, 'second'), brain_models),
+                        'NIFTI_INTENT_CONNECTIVITY_DENSE_SERIES')
+
+            first_epi, first_cifti = epi, cifti
+
+        else:
+            shutil.copyfile(first_epi, epi)
+            shutil.copyfile(first_cifti, cifti)
+
+        shutil.copyfile(epi, path.join(raw_dir, '%s_%s.nii.gz' % (subject, series_name)))
+
+        # 6 motion parameters + 6 derivatives, one row per frame
+        regressors = np.cumsum(rng.standard_normal((frames, 12)) * 0.02, axis=0)
+        np.savetxt(path.join(result_dir, 'Movement_Regressors.txt'), regressors, fmt='%.6f')
+
+
+def make_fixture(root, subjects=1, series=2, frames=120, tr=0.8, scale='small', grayordinates=None,
+                 atlases=None, project='ASD', has_t2=True):
+    """
+    Builds the whole fixture under root (an existing root is replaced).
+
+    :return: dict, also written to <root>/fixture.json: parameters, 'environment' (config_hcp_postprocess
+             configured_environments entry), 'prog_path', 'bin_dir', 'subjects' [(subjectID, output_folder)] and
+             'list_path' (list-file of all subjects)
+    """
+
+    root = path.abspath(root)
+
+    if path.exists(root):
+        shutil.rmtree(root)
+
+    os.makedirs(root)
+
+    atlases = atlases or DEFAULT_ATLASES
+    grayordinates = grayordinates or SCALES[scale]['grayordinates']
+
+    bin_dir = path.join(root, 'bin')
+    prog_dir = path.join(root, 'prog')
+    labels_dir = path.join(root, 'labels')
+    fsl_dir = path.join(root, 'fsl')
+
+    make_stub_bin(bin_dir)
+    make_program_dir(prog_dir, scale)
+
+    epi_shape = SCALES[scale]['epi_shape']
+
+    standard_dir = path.join(fsl_dir, 'data', 'standard')
+    os.makedirs(standard_dir)
+    standard_brain = ellipsoid(epi_shape, 0.4)
+    write_volume(path.join(standard_dir, 'MNI152_T1_2mm_brain.nii.gz'), epi_shape, 2.0, dtype=np.int16,
+                 make_frame=lambda frame: standard_brain * 5000)
+
+    brain_models = dense_axis(grayordinates, epi_shape)
+
+    make_labels(labels_dir, atlases, brain_models)
+
+    for utility_dir in ('HCP_Matlab', 'framewise_displacement'):
+        os.makedirs(path.join(root, utility_dir))
+
+    subject_list = []
+
+    for subject_num in range(1, subjects + 1):
+
+        subject = 'SUBJ%03d' % subject_num
+        output_folder = path.join(root, 'mnt', project, subject, 'visit1', 'HCP_pipe', subject)
+
+        print 'Writing %s (%s x %s frames)...' % (output_folder, series, frames)
+
+        make_subject(output_folder, subject, series, frames, tr, scale, brain_models, has_t2, seed=subject_num)
+
+        subject_list.append((subject, output_folder))
+
+    list_path = path.join(root, 'subjects.csv')
+
+    with open(list_path, 'w') as f:
+        f.write(''.join('%s,%s\n' % subject_row for subject_row in subject_list))
+
+    fixture = {
+        'root'              : root
+        , 'scale'           : scale
+        , 'series'          : series
+        , 'frames'          : frames
+        , 'tr'              : tr
+        , 'grayordinates'   : len(brain_models)
+        , 'atlases'         : atlases
+        , 'project'         : project
+        , 'has_t2'          : has_t2
+        , 'subjects'        : subject_list
+        , 'list_path'       : list_path
+        , 'prog_path'       : prog_dir
+        , 'bin_dir'         : bin_dir
+        , 'environment'     : {
+            'path_to_label_files'               : labels_dir
+            , 'path_to_movement_regressor_check': path.join(root, 'movmnt_regressor_check.py')
+            , 'FSL_DIR'                         : fsl_dir
+            , 'octave'                          : path.join(bin_dir, 'octave')
+            , 'wb_command'                      : path.join(bin_dir, 'wb_command')
+            , 'framewise_disp_path'             : path.join(root, 'framewise_displacement')
+            , 'HCP_Mat_Path'                    : path.join(root, 'HCP_Matlab')
+            , 'matlab_template'                 : 'FNL_preproc_Matlab.m'
+        }
+    }
+
+    with open(path.join(root, FIXTURE_FILE_NAME), 'w') as f:
+        json.dump(fixture, f, indent=1, sort_keys=True)
+
+    return fixture
+
+
+def load_fixture(root):
+
+    with open(path.join(root, FIXTURE_FILE_NAME), 'r') as f:
+        return json.load(f)
+
+
+def parse_atlas(value):
+    """
+    :param value: 'NAME=PARCELS'
+    :return: tuple (name, parcels)
+    """
+
+    name, parcels = value.split('=', 1)
+
+    return name, int(parcels)
+
+
+def add_fixture_arguments(parser):
+
+    parser.add_argument('--subjects', type=int, default=1, help='number of subjects [default=1]')
+    parser.add_argument('--series', type=int, default=2, help='REST series per subject [default=2]')
+    parser.add_argument('--frames', type=int, default=120, help='frames per REST series [default=120]')
+    parser.add_argument('--tr', type=float, default=0.8, help='repetition time in seconds [default=0.8]')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small',
+                        help="volume & CIFTI sizes: 'hcp' (2mm MNI EPI, 0.7mm T1, 91282 grayordinates) or 'small' "
+                             "[default=small]")
+    parser.add_argument('--grayordinates', type=int, help='override the number of grayordinates of the scale')
+    parser.add_argument('--atlas', dest='atlases', action='append', type=parse_atlas, metavar='NAME=PARCELS',
+                        help='label files to make, repeatable [default=Gordon=333 Power=264 Yeo=17]')
+    parser.add_argument('--project', default='ASD', help='project directory / config name [default=ASD]')
+    parser.add_argument('--no-t2', dest='has_t2', action='store_false', help='subjects without T2w_restore')
+
+
+def fixture_options(args):
+
+    return {
+        'subjects'          : args.subjects
+        , 'series'          : args.series
+        , 'frames'          : args.frames
+        , 'tr'              : args.tr
+        , 'scale'           : args.scale
+        , 'grayordinates'   : args.grayordinates
+        , 'atlases'         : args.atlases
+        , 'project'         : args.project
+        , 'has_t2'          : args.has_t2
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Builds a synthetic HCP tree + stub binaries for benchmarks')
+
+    parser.add_argument('root', help='fixture directory (replaced if it exists)')
+
+    add_fixture_arguments(parser)
+
+    args = parser.parse_args()
+
+    fixture = make_fixture(args.root, **fixture_options(args))
+
+    print '\nFixture written to %s (%s subjects, list-file %s)' % (fixture['root'], len(fixture['subjects']),
+                                                                    fixture['list_path'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Offline benchmark of hcp_postprocess: builds (or reuses) a synthetic HCP fixture (make_fixture.py), runs
+hcp_postprocess.main() on it against stub binaries with configurable latency, and reports per-stage & per-tool
+timings from the summaries the pipeline writes (summary/hcp_postprocess_stages.json & hcp_postprocess_tools.json).
+
+Arguments this script does not know are passed on to hcp_postprocess, e.g. to compare engines or schedulers:
+
+    python run_benchmark.py --series 4 --frames 400 --latency wb_command=0.2 --latency octave=1 -c 4
+    python run_benchmark.py --fixture /tmp/hcp_bench --reuse --backend parcellate=native -c 4
+    python run_benchmark.py --subjects 8 --repeat 3 --json results.json -w 4 -c 8
+
+Octave is driven through oct2py, so a stand-in oct2py module (stubs/oct2py) runs the stub octave binary for every
+Octave function call.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from os import path
+
+HERE = path.dirname(path.abspath(__file__))
+
+# the stand-in oct2py has to win over an installed one
+sys.path.insert(0, path.join(HERE, 'stubs'))
+sys.path.insert(1, path.dirname(HERE))
+
+import make_fixture
+from stub_tool import LATENCY_VARIABLE
+
+
+def get_parser():
+
+    parser = argparse.ArgumentParser(
+        description='Runs hcp_postprocess on a synthetic HCP tree with stub binaries and reports per-stage timings. '
+                    'Unknown arguments are passed on to hcp_postprocess.')
+
+    parser.add_argument('--fixture', default=path.join('/tmp', 'hcp_postprocess_benchmark'),
+                        help='fixture directory [default=/tmp/hcp_postprocess_benchmark]')
+    parser.add_argument('--reuse', action='store_true',
+                        help='reuse an existing fixture in --fixture instead of building a new one (the fixture '
+                             'options below are then ignored)')
+
+    make_fixture.add_fixture_arguments(parser)
+
+    parser.add_argument('--latency', action='append', default=[], metavar='TOOL=SECONDS',
+                        help='latency of a stub tool (wb_command, fslmaths, fslmeants, slices, flirt, octave), an '
+                             'Octave function (FNL_preproc_Matlab, analyses_v2) or "default", repeatable')
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs [default=1]')
+    parser.add_argument('--warm', action='store_true',
+                        help='keep outputs & stage cache between runs (measures up-to-date re-runs); by default '
+                             'every run starts over with --force-stage all')
+    parser.add_argument('--batch', action='store_true',
+                        help='run the subjects as a batch (--list) even if there is only one')
+    parser.add_argument('--json', dest='json_path', help='also write the results to this JSON file')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the pipeline output instead of writing it to <fixture>/benchmark_run<N>.log')
+
+    return parser
+
+
+def run_pipeline(hcp_postprocess, argv, log_path=None):
+    """
+    Runs hcp_postprocess.main() with argv.
+
+    :return: tuple (elapsed seconds, exit code)
+    """
+
+    saved_argv, saved_stdout = sys.argv, sys.stdout
+
+    sys.argv = argv
+    exit_code = 0
+
+    log = open(log_path, 'w') if log_path else None
+
+    if log:
+        sys.stdout = log
+
+    start = time.time()
+
+    try:
+        hcp_postprocess.main()
+    except SystemExit, e:
+        exit_code = e.code if isinstance(e.code, int) else 1
+    finally:
+        elapsed = time.time() - start
+        sys.argv, sys.stdout = saved_argv, saved_stdout
+        if log:
+            log.close()
+
+    return elapsed, exit_code
+
+
+def print_report(runs, subjects):
+
+    print '\n%-4s %12s %6s %16s' % ('run', 'wall (s)', 'exit', 'subjects / hour')
+    print '-' * 41
+
+    for run_num, run in enumerate(runs, 1):
+        print '%-4s %12.2f %6s %16.1f' % (run_num, run['elapsed'], run['exit_code'],
+                                          3600.0 * subjects / run['elapsed'] if run['elapsed'] else 0)
+
+    stage_names = sorted(set(name for run in runs for name in run['stages']),
+                         key=lambda name: -sum(run['stages'].get(name, {}).get('wall_s', 0) for run in runs))
+
+    row_format = '%-36s %6s %12s %12s %12s %12s'
+
+    print '\n' + row_format % ('stage (mean over runs)', 'calls', 'wall (s)', 'mean (s)', 'max (s)', 'cpu (s)')
+    print '-' * 96
+
+    for name in stage_names:
+
+        stats = [run['stages'][name] for run in runs if name in run['stages']]
+
+        print row_format % (name, sum(stage['count'] for stage in stats) / len(stats),
+                            '%.3f' % (sum(stage['wall_s'] for stage in stats) / len(stats)),
+                            '%.3f' % (sum(stage['mean_wall_s'] for stage in stats) / len(stats)),
+                            '%.3f' % max(stage['max_wall_s'] for stage in stats),
+                            '%.3f' % (sum(stage['cpu_s'] for stage in stats) / len(stats)))
+
+    tool_names = sorted(set(name for run in runs for name in run['tools']))
+
+    if tool_names:
+
+        row_format = '%-36s %6s %12s %12s'
+
+        print '\n' + row_format % ('tool (mean over runs)', 'calls', 'wall (s)', 'cpu (s)')
+        print '-' * 70
+
+        for name in tool_names:
+
+            stats = [run['tools'][name] for run in runs if name in run['tools']]
+
+            print row_format % (name, sum(tool['count'] for tool in stats) / len(stats),
+                                '%.3f' % (sum(tool['wall_s'] for tool in stats) / len(stats)),
+                                '%.3f' % (sum(tool['cpu_s'] for tool in stats) / len(stats)))
+
+
+def main():
+
+    parser = get_parser()
+
+    args, pipeline_args = parser.parse_known_args()
+
+    for latency in args.latency:
+        if '=' not in latency:
+            parser.error('--latency expects TOOL=SECONDS, got %s' % latency)
+
+    if args.reuse and path.exists(path.join(args.fixture, make_fixture.FIXTURE_FILE_NAME)):
+        fixture = make_fixture.load_fixture(args.fixture)
+        print 'Reusing fixture %s' % fixture['root']
+    else:
+        fixture = make_fixture.make_fixture(args.fixture, **make_fixture.fixture_options(args))
+
+    # POINT HCP_POSTPROCESS AT THE FIXTURE: environment config, stub binaries on PATH, program dir (templates)
+    import config_hcp_postprocess
+    config_hcp_postprocess.configured_environments['rushmore'].update(fixture['environment'])
+
+    import hcp_postprocess
+
+    os.environ['PATH'] = fixture['bin_dir'] + os.pathsep + os.environ.get('PATH', '')
+    os.environ[LATENCY_VARIABLE] = ','.join(args.latency)
+
+    subjects = [tuple(subject) for subject in fixture['subjects']]
+
+    argv = [path.join(fixture['prog_path'], 'hcp_postprocess.py')]
+
+    if args.batch or len(subjects) > 1:
+        argv += ['-l', fixture['list_path']]
+    else:
+        argv += ['-s', subjects[0][0], '-o', subjects[0][1]]
+
+    argv += pipeline_args
+
+    print '\nRunning: %s\nStub latency: %s\n' % (' '.join(argv[1:]), ', '.join(args.latency) or 'none')
+
+    runs = []
+
+    for run_num in range(1, args.repeat + 1):
+
+        run_argv = argv + ([] if args.warm else ['--force-stage', 'all'])
+
+        log_path = None if args.verbose else path.join(fixture['root'], 'benchmark_run%s.log' % run_num)
+
+        elapsed, exit_code = run_pipeline(hcp_postprocess, run_argv, log_path)
+
+        summary_paths = [path.join(output_folder, 'summary', hcp_postprocess.STAGE_SUMMARY_FILE_NAME)
+                         for subject, output_folder in subjects]
+        tool_paths = [path.join(output_folder, 'summary', hcp_postprocess.TOOL_SUMMARY_FILE_NAME)
+                      for subject, output_folder in subjects]
+
+        runs.append({
+            'elapsed'       : elapsed
+            , 'exit_code'   : exit_code
+            , 'log'         : log_path
+            , 'stages'      : hcp_postprocess.aggregate_stage_summaries(summary_paths)
+            , 'tools'       : hcp_postprocess.aggregate_tool_summaries(tool_paths)
+        })
+
+        print 'Run %s: %.2fs, exit code %s%s' % (run_num, elapsed, exit_code, ' (log: %s)' % log_path if log_path
+                                                 else '')
+
+    print_report(runs, len(subjects))
+
+    if args.json_path:
+
+        with open(args.json_path, 'w') as f:
+            json.dump({'fixture': dict((key, value) for key, value in fixture.items() if key != 'environment'),
+                       'argv': argv[1:], 'latency': args.latency, 'warm': args.warm, 'runs': runs},
+                      f, indent=1, sort_keys=True)
+
+        print '\nResults written to %s' % args.json_path
+
+    if [run for run in runs if run['exit_code']]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark stand-in for oct2py: every Octave function call runs the configured octave executable once with
+--eval "<function>('<argument>')" (the stub octave of the benchmark fixture), instead of keeping an interpreter
+session. Only the parts hcp_octave.OctaveSession uses are here.
+
+run_benchmark.py puts this directory first on sys.path; never install it.
+"""
+
+import time
+import signal
+import subprocess
+
+
+class Oct2PyError(Exception):
+    pass
+
+
+class Oct2Py(object):
+
+    def __init__(self, executable='octave', timeout=None, temp_dir=None, convert_to_float=True, **kwargs):
+
+        self.executable = executable
+        self.timeout = timeout
+        self.temp_dir = temp_dir
+        self.paths = []
+
+    def addpath(self, *paths):
+
+        self.paths.extend(paths)
+
+    def eval(self, expression, **kwargs):
+
+        # health check of OctaveSession: '1 + 1'
+        return eval(expression, {'__builtins__': {}})
+
+    def exit(self):
+
+        pass
+
+    def __getattr__(self, function_name):
+
+        if function_name.startswith('_'):
+            raise AttributeError(function_name)
+
+        def call(*args):
+
+            argv = [self.executable, '--traditional', '--quiet', '--eval',
+                    '%s(%s)' % (function_name, ', '.join("'%s'" % arg for arg in args))]
+
+            proc = subprocess.Popen(argv, cwd=self.temp_dir)
+
+            deadline = time.time() + self.timeout if self.timeout else None
+
+            while proc.poll() is None:
+
+                if deadline and time.time() > deadline:
+                    proc.send_signal(signal.SIGKILL)
+                    proc.wait()
+                    raise Oct2PyError('Timed out: %s' % function_name)
+
+                time.sleep(0.01)
+
+            if proc.returncode:
+                raise Oct2PyError('%s exited with status %s' % (function_name, proc.returncode))
+
+        return call
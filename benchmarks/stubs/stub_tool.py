@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+Stand-in for the external binaries of hcp_postprocess (wb_command, fslmaths, fslmeants, slices, flirt, octave) in
+benchmarks: sleeps for the tool's configured latency, then writes plausible outputs where hcp_postprocess expects
+them, so the whole pipeline runs offline.
+
+Called through the small wrappers make_fixture.py puts in <fixture>/bin:
+
+    stub_tool.py <tool> [tool arguments...]
+
+Latency (seconds) comes from the HCP_BENCH_LATENCY environment variable, e.g. 'wb_command=0.5,octave=2,default=0'.
+Octave functions can be given their own latency (e.g. 'FNL_preproc_Matlab=5'), otherwise 'octave' is used; tools
+without a latency use 'default' (0 if unset).
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import glob
+import gzip
+import shutil
+from os import path
+
+LATENCY_VARIABLE = 'HCP_BENCH_LATENCY'
+
+# 1x1 transparent PNG, for the -show-scene images
+PNG_BYTES = ('\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4'
+             '\x89\x00\x00\x00\rIDATx\x9cc\xf8\x0f\x00\x00\x01\x01\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB`\x82')
+
+GIF_BYTES = 'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00' \
+            '\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
+
+
+def parse_latencies(spec):
+    """
+    :param spec: 'tool=seconds,tool=seconds...'
+    :return: dict of tool -> seconds
+    """
+
+    latencies = {}
+
+    for item in (spec or '').split(','):
+
+        if '=' in item:
+            tool, seconds = item.split('=', 1)
+            latencies[tool.strip()] = float(seconds)
+
+    return latencies
+
+
+def latency_for(*names):
+
+    latencies = parse_latencies(os.environ.get(LATENCY_VARIABLE))
+
+    for name in names:
+        if name in latencies:
+            return latencies[name]
+
+    return latencies.get('default', 0.0)
+
+
+def option_value(args, option):
+
+    if option in args and args.index(option) + 1 < len(args):
+        return args[args.index(option) + 1]
+
+    return None
+
+
+def nifti_path(file_path):
+    """
+    FSL tools take image names with or without extension.
+    """
+
+    if file_path.endswith('.nii') or file_path.endswith('.nii.gz'):
+        return file_path
+
+    for extension in ('.nii.gz', '.nii'):
+        if path.exists(file_path + extension):
+            return file_path + extension
+
+    return file_path + '.nii.gz'
+
+
+def copy_image(src, dst):
+    """
+    Copies an image the way FSL writes it: gzip-compressed if dst ends with .gz, whatever src was.
+    """
+
+    with open(src, 'rb') as f:
+        compressed = f.read(2) == '\x1f\x8b'
+
+    source = gzip.open(src, 'rb') if compressed else open(src, 'rb')
+    destination = gzip.open(dst, 'wb') if dst.endswith('.gz') else open(dst, 'wb')
+
+    try:
+        shutil.copyfileobj(source, destination)
+    finally:
+        source.close()
+        destination.close()
+
+
+def write_bytes(file_path, content):
+
+    with open(file_path, 'wb') as f:
+        f.write(content)
+
+
+def count_frames(image_path):
+
+    try:
+        import nibabel
+        shape = nibabel.load(image_path).shape
+        return shape[3] if len(shape) > 3 else 1
+    except Exception:
+        return 1
+
+
+# ~~~~~~~~~~~~~~~~ TOOLS ~~~~~~~~~~~~~~~~ #
+
+def wb_command(args):
+
+    if args[0] == '-show-scene':
+        write_bytes(args[3], PNG_BYTES)
+
+    elif args[0] == '-cifti-merge':
+
+        merged_path = args[1]
+        inputs = [args[i + 1] for i, arg in enumerate(args) if arg == '-cifti']
+
+        try:
+            import numpy as np
+            import nibabel
+            from nibabel.cifti2 import cifti2_axes
+
+            images = [nibabel.load(input_path) for input_path in inputs]
+            series = images[0].header.get_axis(0)
+            data = np.concatenate([np.asarray(image.dataobj) for image in images], axis=0)
+            merged_series = cifti2_axes.SeriesAxis(series.start, series.step, data.shape[0], series.unit)
+            merged = nibabel.Cifti2Image(data, header=(merged_series, images[0].header.get_axis(1)))
+            merged.nifti_header.set_intent('NIFTI_INTENT_CONNECTIVITY_DENSE_SERIES')
+            nibabel.save(merged, merged_path)
+
+        except ImportError:
+            shutil.copyfile(inputs[0], merged_path)
+
+    elif args[0] == '-cifti-parcellate':
+
+        # hcp_postprocess' own parcellation when it can be imported (checkout root is two levels up), so later
+        # stages can read the .ptseries.nii, else an empty file
+        sys.path.insert(0, path.dirname(path.dirname(path.dirname(path.abspath(__file__)))))
+
+        try:
+            import hcp_cifti
+            hcp_cifti.save_ptseries(*(hcp_cifti.parcellate(args[1], [args[2]])[0] + (args[4],)))
+
+        except ImportError:
+            write_bytes(args[4], '')
+
+
+def fslmaths(args):
+
+    # every call reads one image & writes the last argument: copy the input so later stages can read it
+    copy_image(nifti_path(args[0]), nifti_path(args[-1]))
+
+
+def fslmeants(args):
+
+    frames = count_frames(nifti_path(option_value(args, '-i')))
+
+    with open(option_value(args, '-o'), 'w') as f:
+        f.write(''.join('%.6f\n' % (1000.0 + frame) for frame in range(frames)))
+
+
+def slices(args):
+
+    write_bytes(option_value(args, '-o'), GIF_BYTES)
+
+
+def flirt(args):
+
+    copy_image(nifti_path(option_value(args, '-in')), nifti_path(option_value(args, '-out')))
+
+
+def octave(function_name, config):
+    """
+    Writes the outputs of FNL_preproc_Matlab / analyses_v2 from their JSON config.
+    """
+
+    if function_name == 'FNL_preproc_Matlab':
+
+        shutil.copyfile(config['path_cii'], path.join(config['result_dir'], config['FNL_preproc_CIFTI_name']))
+
+        with open(config['file_mov_reg'], 'r') as f:
+            frames = len([line for line in f if line.strip()])
+
+        write_bytes(path.join(config['result_dir'], config['motion_filename']), 'frames %s\n' % frames)
+
+        # FD_REST?.txt for the executive summary, one value per frame
+        series_name = path.basename(path.dirname(path.normpath(config['result_dir'])))
+
+        with open(path.join(config['path_ex_sum'], 'FD_%s.txt' % series_name), 'w') as f:
+            f.write(''.join('%.4f\n' % (0.05 + 0.001 * (frame % 100)) for frame in range(frames)))
+
+    elif function_name == 'analyses_v2':
+
+        for image_name in ('DVARS_and_FD_CONCA.png', 'FD_dist.png'):
+            write_bytes(path.join(config['summary_Dir'], image_name), PNG_BYTES)
+
+        for mat_name in ('FD.mat', 'motion_numbers.mat', 'power_2014_motion.mat'):
+            write_bytes(path.join(config['result_dir'], mat_name), '')
+
+        # one time-course per parcellation: <subject>_FNL_preproc_<atlas>[_subcortical].ptseries.nii -> <atlas>.csv
+        for ptseries in glob.glob(path.join(config['path_motion_numbers'], '*_FNL_preproc_*.ptseries.nii')):
+            atlas = path.basename(ptseries).split('_FNL_preproc_', 1)[1][:-len('.ptseries.nii')]
+            write_bytes(path.join(config['path_timecourses'], atlas + '.csv'), '')
+
+
+def main():
+
+    tool = sys.argv[1]
+    args = sys.argv[2:]
+
+    if tool == 'octave':
+
+        # octave --traditional --quiet --eval "Function('/path/to/config.json')"
+        call = re.match(r"\s*(\w+)\s*\(\s*'?([^')]*)'?\s*\)", option_value(args, '--eval') or '')
+
+        function_name, config_path = call.groups() if call else (None, None)
+
+        time.sleep(latency_for(function_name, 'octave'))
+
+        if function_name and config_path and path.exists(config_path):
+            with open(config_path, 'r') as f:
+                octave(function_name, json.load(f))
+
+        return 0
+
+    time.sleep(latency_for(tool))
+
+    {
+        'wb_command'    : wb_command
+        , 'fslmaths'    : fslmaths
+        , 'fslmeants'   : fslmeants
+        , 'slices'      : slices
+        , 'flirt'       : flirt
+    }[tool](args)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
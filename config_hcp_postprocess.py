@@ -65,6 +65,65 @@ configured_environments = {
         }
     }
 # print configured_environments
+
+# NATIVE (NumPy) ENGINE SETTINGS
+native_settings = {
+
+    'meants_chunk_mb'       : 256,  # max MB of epi data held in memory at once when extracting mean time-series
+    'parcellate_chunk_mb'   : 256,  # max MB of dense time-series held in memory at once when parcellating
+    'regress_chunk_mb'      : 256,  # max MB of dense time-series held in memory at once for nuisance regression
+    'regress_linear_trend'  : False,  # also regress out a linear trend (FNL_preproc_Matlab does not)
+    'fd_thresholds'         : [0.1, 0.2, 0.3, 0.5],  # FD thresholds (mm) of --fd-sweep, plus fd_th
+    'atlas_cache_dir'       : None,  # parcel membership cache, None = <path_to_label_files>/.atlas_index
+}
+
+# COMPUTE BACKEND OF EACH STAGE -> the stage's tool, or 'native' (in-process) where hcp_backends.BACKENDS has one
+# every stage runs its tool unless switched to native here, or with --backend stage=backend on the command line
+backends = {
+
+    'masks'         : 'fsl',  # fsl | native
+    'means'         : 'fsl',  # fsl | native
+    'resample'      : 'flirt',  # flirt | native
+    'merge'         : 'wb',
+    'parcellate'    : 'wb',  # wb | native
+    'regress'       : 'octave',  # octave | native
+    'qc_images'     : 'slices',  # slices | native
+}
+
+# DECODED-VOLUME CACHE -> each .nii.gz input is decompressed once per subject, for every stage (see hcp_volume_cache)
+volume_cache = {
+
+    'enabled'   : True,
+    'dir'       : None,  # local disk / tmpfs for the uncompressed copies, None = the --scratch folder, else system temp
+    'ram_mb'    : 2048,  # max MB of decoded volumes the native stages keep in RAM (least recently used out first)
+}
+
+# OCTAVE TIMEOUTS -> seconds = base + per_million_values * (frames x grayordinates / 1e6)
+# 'deadline' = how long to keep watching for outputs after Oct2Py gives up, before moving on
+octave_timeouts = {
+
+    'FNL_preproc_Matlab': {       # per REST series, ~120s for 400 frames of a 91k dtseries
+        'base'                  : 60,
+        'per_million_values'    : 1.6,
+        'deadline'              : 60
+    },
+    'analyses_v2': {              # all series at once, ~800s for 4 x 400 frames of a 91k dtseries
+        'base'                  : 300,
+        'per_million_values'    : 3.4,
+        'deadline'              : 600
+    }
+}
+
+# EXTERNAL COMMAND TIMEOUTS -> seconds before a call of that tool is killed (None = wait forever)
+command_timeouts = {
+
+    'wb_command'    : 3600,
+    'fslmaths'      : 1800,
+    'fslmeants'     : 1800,
+    'flirt'         : 1800,
+    'slices'        : 600,
+    'default'       : 7200      # any other tool
+}
 mask_threshold_values_dict = {
 
     # TODO: do these change ever? Specific to human atlases?
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Compute backends of hcp_postprocess: which implementation runs each computational stage.
+
+Every stage has the external tool it always had (fslmaths, fslmeants, flirt, slices, wb_command, octave) and may have
+an in-process 'native' engine. The active backend of each stage comes from config_hcp_postprocess.backends, then
+from the command line:
+
+    --backend masks=native,parcellate=wb --backend regress=native
+
+A native backend whose Python dependencies are missing falls back to the stage's tool, so native engines can be
+rolled out stage by stage with the existing tools behind them.
+"""
+
+# stage -> (tool backend, other backends...), the first one is the fallback
+BACKENDS = {
+    'masks'         : ('fsl', 'native')      # eroded WM & ventricle masks from wmparc
+    , 'means'       : ('fsl', 'native')      # WM & ventricle mean time-series of each REST epi
+    , 'resample'    : ('flirt', 'native')    # T1 to 2mm MNI for the registration gifs
+    , 'merge'       : ('wb',)                # concatenation of the FNL_preproc dtseries
+    , 'parcellate'  : ('wb', 'native')       # parcellated time-series of every atlas
+    , 'regress'     : ('octave', 'native')   # nuisance regression & band-pass filtering of each REST dtseries
+    , 'qc_images'   : ('slices', 'native')   # registration gifs
+}
+
+
+def tool_backend(stage):
+
+    return BACKENDS[stage][0]
+
+
+def parse_backend_spec(specs):
+    """
+    :param specs: list of 'stage=backend[,stage=backend...]' strings (later ones win)
+    :return: dict of stage -> backend
+    :raise ValueError: on unknown stages / backends
+    """
+
+    choices = {}
+
+    for spec in specs or []:
+        for item in [item.strip() for item in spec.split(',') if item.strip()]:
+
+            if '=' not in item:
+                raise ValueError("'%s' is not stage=backend" % item)
+
+            stage, backend = [part.strip() for part in item.split('=', 1)]
+
+            if stage not in BACKENDS:
+                raise ValueError("unknown stage '%s', choices are: %s" % (stage, ', '.join(sorted(BACKENDS))))
+
+            if backend not in BACKENDS[stage]:
+                raise ValueError("unknown backend '%s' for %s, choices are: %s" % (backend, stage,
+                                                                                   ', '.join(BACKENDS[stage])))
+
+            choices[stage] = backend
+
+    return choices
+
+
+def resolve_backends(defaults, overrides=None, missing=None):
+    """
+    :param defaults: dict of stage -> backend (config_hcp_postprocess.backends), missing stages use their tool
+    :param overrides: dict of stage -> backend, e.g. from parse_backend_spec
+    :param missing: dict of stage -> backends whose Python dependencies could not be imported
+    :return: tuple (dict of stage -> backend for every stage, list of (stage, wanted, used) fallbacks)
+    """
+
+    wanted = dict((stage, tool_backend(stage)) for stage in BACKENDS)
+
+    wanted.update(parse_backend_spec(['%s=%s' % item for item in sorted((defaults or {}).items())]))
+    wanted.update(overrides or {})
+
+    backends = {}
+    fallbacks = []
+
+    for stage in sorted(wanted):
+
+        backend = wanted[stage]
+
+        if backend in (missing or {}).get(stage, []):
+            fallbacks.append((stage, backend, tool_backend(stage)))
+            backend = tool_backend(stage)
+
+        backends[stage] = backend
+
+    return backends, fallbacks
+
+
+def describe(backends):
+
+    return ', '.join('%s=%s' % (stage, backends[stage]) for stage in sorted(backends))
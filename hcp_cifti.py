@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+"""
+In-process (NumPy / nibabel / SciPy) parcellation of dense CIFTI time-series for hcp_postprocess.
+
+wb_command -cifti-parcellate re-reads the whole merged dtseries for every atlas. Here each .dlabel.nii becomes a
+sparse (parcels x grayordinates) averaging matrix, the dtseries is read once in contiguous blocks of grayordinates
+and every atlas' parcel means are accumulated from one sparse product per block -- the same numbers as
+'-cifti-parcellate <label> COLUMN' (unweighted MEAN over each label's grayordinates).
+
+Parcel membership only depends on the label file and the grayordinates of the dense file, which are the same for every
+subject of a study, so an AtlasIndex keeps it on disk (keyed by the label file's content hash) and the dlabel XML is
+only parsed the first time an atlas is seen.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+from nibabel.cifti2 import cifti2_axes
+from nibabel.cifti2.parse_cifti2 import Cifti2Extension
+from multiprocessing.pool import ThreadPool
+from os import path
+
+# key of the unlabeled ('???') entry of a dlabel's label table, never a parcel
+UNLABELED_KEY = 0
+
+
+# ~~~~~~~~~~~~~~~~ GRAYORDINATE MATCHING ~~~~~~~~~~~~~~~~ #
+def grayordinate_keys(brain_models, structure_ids):
+    """
+    One integer per grayordinate identifying where it is, so grayordinates of two files can be matched like wb does:
+    surface vertices by structure & vertex number, voxels by their (i, j, k) in the volume.
+
+    :param brain_models: nibabel BrainModelAxis
+    :param structure_ids: dict of CIFTI structure name -> small int, shared by the files being matched
+    :return: int64 array (grayordinates,), voxel keys >= 0, surface keys < 0
+    """
+
+    keys = np.zeros(len(brain_models), dtype=np.int64)
+
+    surface = brain_models.surface_mask
+
+    if surface.any():
+        structures = np.array([structure_ids[name] for name in brain_models.name[surface]], dtype=np.int64)
+        keys[surface] = -(structures * 2 ** 32 + brain_models.vertex[surface]) - 1
+
+    volume = brain_models.volume_mask
+
+    if volume.any():
+        keys[volume] = np.ravel_multi_index(tuple(brain_models.voxel[volume].T), brain_models.volume_shape)
+
+    return keys
+
+
+def dense_labels(dense_axis, label_axis, label_brain_models, label_values):
+    """
+    Label key of each grayordinate of a dense file, looked up in a dlabel covering (some of) the same brainordinates.
+
+    :param dense_axis: BrainModelAxis of the dtseries
+    :param label_axis: LabelAxis of the dlabel (only used for error messages)
+    :param label_brain_models: BrainModelAxis of the dlabel
+    :param label_values: label key of each dlabel grayordinate
+    :return: int64 array (dense grayordinates,), UNLABELED_KEY where the dlabel has nothing
+    """
+
+    if dense_axis.volume_mask.any() and label_brain_models.volume_mask.any() and \
+            tuple(dense_axis.volume_shape) != tuple(label_brain_models.volume_shape):
+        raise ValueError('volume space of %s does not match the dense time-series' % label_axis.name[0])
+
+    structure_ids = dict((name, structure_id) for structure_id, name in enumerate(
+        sorted(set(dense_axis.name) | set(label_brain_models.name))))
+
+    dense_keys = grayordinate_keys(dense_axis, structure_ids)
+    label_keys = grayordinate_keys(label_brain_models, structure_ids)
+
+    order = np.argsort(label_keys)
+    sorted_keys = label_keys[order]
+
+    positions = np.minimum(np.searchsorted(sorted_keys, dense_keys), len(sorted_keys) - 1)
+    found = sorted_keys[positions] == dense_keys
+
+    labels = np.zeros(len(dense_keys), dtype=np.int64)
+    labels[found] = np.asarray(label_values, dtype=np.int64)[order][positions[found]]
+
+    return labels
+
+
+# ~~~~~~~~~~~~~~~~ PARCEL (AVERAGING) MATRICES ~~~~~~~~~~~~~~~~ #
+def parcel_membership(dlabel_path, dense_axis):
+    """
+    Which grayordinates of the dense file belong to which parcel of a dlabel: parcels are the label table's keys in
+    ascending order (unlabeled & empty ones left out), named after their labels, like wb_command -cifti-parcellate.
+
+    :param dlabel_path: path to <atlas>.dlabel.nii
+    :param dense_axis: BrainModelAxis of the dtseries to parcellate
+    :return: tuple (list of parcel names, list of int arrays of grayordinate indices, one per parcel)
+    """
+
+    label_img = nib.load(dlabel_path)
+
+    label_axis = label_img.header.get_axis(0)
+    label_brain_models = label_img.header.get_axis(1)
+
+    label_values = np.rint(np.asanyarray(label_img.dataobj)[0]).astype(np.int64)
+
+    labels = dense_labels(dense_axis, label_axis, label_brain_models, label_values)
+
+    label_table = label_axis.label[0]
+
+    names = []
+    members = []
+
+    for key in sorted(label_table.keys()):
+
+        if key == UNLABELED_KEY:
+            continue
+
+        indices = np.flatnonzero(labels == key)
+
+        if indices.size:
+            names.append(label_table[key][0])
+            members.append(indices)
+
+    if not members:
+        raise ValueError('no parcel of %s covers the dense time-series' % dlabel_path)
+
+    return names, members
+
+
+def averaging_matrix(members, n_grayordinates):
+    """
+    :param members: list of grayordinate index arrays, one per parcel
+    :param n_grayordinates: number of grayordinates in the dense file
+    :return: scipy CSR matrix (parcels x grayordinates), each row 1 / parcel size over the parcel's grayordinates
+    """
+
+    rows = np.concatenate([np.repeat(parcel_num, indices.size) for parcel_num, indices in enumerate(members)])
+    columns = np.concatenate(members)
+    weights = np.concatenate([np.repeat(1.0 / indices.size, indices.size) for indices in members])
+
+    return sparse.csr_matrix((weights, (rows, columns)), shape=(len(members), n_grayordinates))
+
+
+def parcels_axis(names, members, dense_axis):
+    """
+    :return: nibabel ParcelsAxis describing each parcel by the dense grayordinates averaged into it
+    """
+
+    return cifti2_axes.ParcelsAxis.from_brain_models(
+        [(name, dense_axis[indices]) for name, indices in zip(names, members)])
+
+
+# ~~~~~~~~~~~~~~~~ ATLAS INDEX (ON-DISK MEMBERSHIP CACHE) ~~~~~~~~~~~~~~~~ #
+def dense_axis_signature(dense_axis):
+    """
+    :param dense_axis: BrainModelAxis of a dense file
+    :return: sha1 of its grayordinates (structures, vertices, voxels, volume space), the same for all 91k files
+    """
+
+    sha1 = hashlib.sha1()
+
+    for name, structure_slice, brain_models in dense_axis.iter_structures():
+        sha1.update('%s %s %s;' % (name, structure_slice.start, structure_slice.stop))
+
+    sha1.update(np.ascontiguousarray(dense_axis.vertex, dtype=np.int64).tostring())
+    sha1.update(np.ascontiguousarray(dense_axis.voxel, dtype=np.int64).tostring())
+    sha1.update(str(dense_axis.volume_shape))
+
+    return sha1.hexdigest()
+
+
+class AtlasIndex(object):
+    """
+    Parcel membership of each atlas (names, grayordinate indices), built once per label file content and dense
+    grayordinate space and stored as .npz in cache_dir, which can be shared by every subject of a study.
+
+    :parameter cache_dir: directory for the index; created if needed, caching is skipped if it cannot be written
+    """
+
+    def __init__(self, cache_dir):
+
+        self.cache_dir = cache_dir
+
+        self.hits = 0
+        self.builds = 0
+
+        try:
+            if not path.exists(cache_dir):
+                os.makedirs(cache_dir)
+        except OSError, e:
+            print '\nCannot create atlas cache dir %s (%s), parcel membership will not be cached' % (cache_dir, e)
+
+        self.writable = path.isdir(cache_dir) and os.access(cache_dir, os.W_OK)
+
+    def label_hash(self, dlabel_path):
+        """
+        sha1 of a label file's contents. The hash is remembered with the file's size & mtime in index.json, so a label
+        file is only read again once it changed.
+
+        :param dlabel_path: path to .dlabel.nii
+        :return: hex digest
+        """
+
+        dlabel_path = path.abspath(dlabel_path)
+
+        stat = os.stat(dlabel_path)
+
+        index = self._load_index()
+
+        recorded = index.get(dlabel_path)
+
+        if recorded and recorded['size'] == stat.st_size and recorded['mtime'] == stat.st_mtime:
+            return recorded['sha1']
+
+        sha1 = hashlib.sha1()
+
+        with open(dlabel_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha1.update(block)
+
+        index[dlabel_path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1.hexdigest()}
+
+        self._write_atomic('index.json', lambda f: json.dump(index, f, indent=1, sort_keys=True))
+
+        return index[dlabel_path]['sha1']
+
+    def membership(self, dlabel_path, dense_axis):
+        """
+        Same as parcel_membership(dlabel_path, dense_axis), from the cache when this label file content was already
+        indexed for these grayordinates.
+
+        :return: tuple (list of parcel names, list of int arrays of grayordinate indices, one per parcel)
+        """
+
+        entry_name = '%s_%s.npz' % (self.label_hash(dlabel_path), dense_axis_signature(dense_axis)[:16])
+
+        entry_path = path.join(self.cache_dir, entry_name)
+
+        if path.exists(entry_path):
+
+            try:
+                entry = np.load(entry_path)
+                offsets = entry['offsets']
+                self.hits += 1
+                return [unicode(name) for name in entry['names']], np.split(entry['indices'], offsets[1:-1])
+            except (IOError, ValueError, KeyError), e:
+                print '\nIgnoring unreadable atlas cache entry %s (%s)' % (entry_path, e)
+
+        names, members = parcel_membership(dlabel_path, dense_axis)
+
+        self.builds += 1
+
+        offsets = np.cumsum([0] + [indices.size for indices in members])
+
+        self._write_atomic(entry_name, lambda f: np.savez(f, names=np.array(names, dtype='U'),
+                                                          indices=np.concatenate(members), offsets=offsets))
+
+        return names, members
+
+    def _load_index(self):
+
+        index_path = path.join(self.cache_dir, 'index.json')
+
+        if not path.exists(index_path):
+            return {}
+
+        try:
+            with open(index_path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def _write_atomic(self, file_name, write):
+
+        if not self.writable:
+            return
+
+        # write next to the target & rename, so subjects sharing the cache never read a half-written file
+        handle, temp_path = tempfile.mkstemp(prefix='.' + file_name, dir=self.cache_dir)
+
+        with os.fdopen(handle, 'wb') as f:
+            write(f)
+
+        os.rename(temp_path, path.join(self.cache_dir, file_name))
+
+
+# ~~~~~~~~~~~~~~~~ DTSERIES -> PTSERIES ~~~~~~~~~~~~~~~~ #
+def iter_grayordinate_chunks(dense_img, max_chunk_bytes):
+    """
+    Dense series are stored frame-fastest, so a block of grayordinates (every frame of each) is one contiguous read.
+
+    :param dense_img: nibabel Cifti2Image of a dtseries (frames x grayordinates)
+    :param max_chunk_bytes: max bytes of data held at once (at least one grayordinate is always read)
+    :return: generator of tuples (first grayordinate index, float64 array (frames, grayordinates))
+    """
+
+    n_frames, n_grayordinates = dense_img.shape
+
+    grayordinates_per_chunk = max(1, int(max_chunk_bytes // (n_frames * 8)))
+
+    for first in range(0, n_grayordinates, grayordinates_per_chunk):
+
+        yield first, np.asarray(dense_img.dataobj[:, first:first + grayordinates_per_chunk], dtype=np.float64)
+
+
+def write_dense_series(out_path, series_axis, dense_axis, chunks):
+    """
+    Writes a float32 .dtseries.nii from blocks of grayordinates, without ever holding the whole matrix: the NIfTI-2
+    header & CIFTI XML go first, then each block is appended (grayordinates are the slow axis on disk). The file is
+    written under a temporary name and renamed when complete.
+
+    :param series_axis: nibabel SeriesAxis (frames)
+    :param dense_axis: nibabel BrainModelAxis (grayordinates)
+    :param chunks: iterable of arrays (frames, grayordinates in the block), in grayordinate order
+    :return: out_path
+    """
+
+    shape = (len(series_axis), len(dense_axis))
+
+    header = nib.Nifti2Header()
+    header.set_data_dtype(np.float32)
+    header.set_data_shape((1, 1, 1, 1) + shape)
+    header.set_intent('NIFTI_INTENT_CONNECTIVITY_DENSE_SERIES')
+    header.extensions.append(Cifti2Extension(content=nib.cifti2.Cifti2Header.from_axes((series_axis, dense_axis))
+                                             .to_xml()))
+
+    # data starts after header + extensions, 16-byte aligned like nibabel / wb_command
+    header.set_data_offset(16 * ((header.single_vox_offset + header.extensions.get_sizeondisk() + 15) // 16))
+
+    written = 0
+
+    temp_path = out_path + '.tmp'
+
+    with open(temp_path, 'wb') as f:
+
+        header.write_to(f)
+
+        f.write('\x00' * (header.get_data_offset() - f.tell()))
+
+        for chunk in chunks:
+            f.write(np.asarray(chunk, dtype='<f4').tostring(order='F'))
+            written += chunk.shape[1]
+
+    if written != shape[1]:
+        os.remove(temp_path)
+        raise ValueError('wrote %s of %s grayordinates to %s' % (written, shape[1], out_path))
+
+    os.rename(temp_path, out_path)
+
+    return out_path
+
+
+def map_dense_series(dtseries_path, out_path, block_function, max_chunk_bytes=256 * 1024 * 1024, workers=1):
+    """
+    Applies block_function to every block of grayordinates of a dtseries (all frames of each) and writes the results as
+    a new dtseries with the same axes. With workers > 1 the blocks go through a thread pool (NumPy / SciPy release the
+    GIL in their loops), workers blocks at a time, each 1 / workers of max_chunk_bytes.
+
+    :param block_function: function(float64 array (frames, grayordinates)) -> array of the same shape
+    :return: out_path
+    """
+
+    dense_img = nib.load(dtseries_path)
+
+    workers = max(1, int(workers))
+
+    blocks = (block for first, block in iter_grayordinate_chunks(dense_img, max_chunk_bytes // workers))
+
+    def map_in_batches(pool):
+
+        batch = []
+
+        for block in blocks:
+
+            batch.append(block)
+
+            if len(batch) == workers:
+                for result in pool.map(block_function, batch):
+                    yield result
+                batch = []
+
+        for result in pool.map(block_function, batch):
+            yield result
+
+    if workers == 1:
+        return write_dense_series(out_path, dense_img.header.get_axis(0), dense_img.header.get_axis(1),
+                                  (block_function(block) for block in blocks))
+
+    pool = ThreadPool(workers)
+
+    try:
+        return write_dense_series(out_path, dense_img.header.get_axis(0), dense_img.header.get_axis(1),
+                                  map_in_batches(pool))
+    finally:
+        pool.terminate()
+
+
+def parcellate(dtseries_path, dlabel_paths, max_chunk_bytes=256 * 1024 * 1024, atlas_index=None):
+    """
+    Parcel mean time-series of one dtseries for any number of atlases, reading the dtseries once: block by block of
+    grayordinates (contiguous on disk), each block adding its grayordinates' share to every parcel mean.
+
+    :param dtseries_path: path to dense time-series, e.g. <subj>_FNL_preproc_Atlas.dtseries.nii
+    :param dlabel_paths: list of .dlabel.nii paths
+    :param max_chunk_bytes: bounds the dense data held in memory at once
+    :param atlas_index: optional AtlasIndex to take parcel membership from
+    :return: list of tuples (float32 array (frames, parcels), SeriesAxis, ParcelsAxis), one per dlabel
+    """
+
+    dense_img = nib.load(dtseries_path)
+
+    series_axis = dense_img.header.get_axis(0)
+    dense_axis = dense_img.header.get_axis(1)
+
+    n_frames, n_grayordinates = dense_img.shape
+
+    atlases = []
+
+    for dlabel_path in dlabel_paths:
+
+        if atlas_index is not None:
+            names, members = atlas_index.membership(dlabel_path, dense_axis)
+        else:
+            names, members = parcel_membership(dlabel_path, dense_axis)
+
+        # CSC: EACH BLOCK TAKES A RANGE OF COLUMNS
+        atlases.append((averaging_matrix(members, n_grayordinates).tocsc(), parcels_axis(names, members, dense_axis),
+                        np.zeros((n_frames, len(members)), dtype=np.float64)))
+
+    for first, block in iter_grayordinate_chunks(dense_img, max_chunk_bytes):
+
+        for matrix, parcel_axis, parcel_series in atlases:
+
+            parcel_series += matrix[:, first:first + block.shape[1]].dot(block.T).T
+
+    return [(parcel_series.astype(np.float32), series_axis, parcel_axis)
+            for matrix, parcel_axis, parcel_series in atlases]
+
+
+def save_ptseries(parcel_series, series_axis, parcel_axis, out_path):
+    """
+    Writes parcel time-series as a CIFTI-2 .ptseries.nii (float32, like wb_command).
+
+    :return: out_path
+    """
+
+    img = nib.Cifti2Image(parcel_series, header=(series_axis, parcel_axis))
+
+    img.nifti_header.set_intent('NIFTI_INTENT_CONNECTIVITY_PARCELLATED_SERIES')
+
+    nib.save(img, out_path)
+
+    return out_path
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+Shell-free runner for the external binaries of hcp_postprocess (fslmaths, wb_command, slices, flirt...).
+
+Commands are argv lists (no shell), their stdout & stderr go straight to a per-subject log file instead of memory,
+a non-zero exit status is an error, each tool has its own timeout after which it is killed, and the resource usage
+of every call (from wait4) is added up per tool to show which binary the node-hours go to.
+"""
+
+import os
+import json
+import errno
+import time
+import shlex
+import signal
+import tempfile
+import threading
+import subprocess
+from collections import namedtuple
+from os import path
+from datetime import datetime
+
+# seconds between SIGTERM and SIGKILL for a command past its timeout
+KILL_GRACE_SECONDS = 10
+
+CommandResult = namedtuple('CommandResult', ['argv', 'tool', 'returncode', 'wall_s', 'cpu_s', 'maxrss_kb', 'output'])
+
+
+class CommandError(RuntimeError):
+    """
+    A command exited with a non-zero status, or was killed after its timeout.
+    """
+
+    def __init__(self, result, reason):
+
+        self.result = result
+
+        RuntimeError.__init__(self, '%s %s: %s' % (result.tool, reason, ' '.join(result.argv)))
+
+
+def as_argv(cmd):
+    """
+    :param cmd: argv list, or a command-line string (split like a shell would, but never run through one)
+    :return: list of strings
+    """
+
+    if isinstance(cmd, basestring):
+        return shlex.split(cmd)
+
+    return [str(arg) for arg in cmd]
+
+
+class CommandRunner(object):
+    """
+    Runs commands for one subject and keeps per-tool totals.
+
+    :parameter log_path: file every command line & its output is appended to (None = inherit this process' stdout)
+    :parameter timeouts: dict of tool name (basename of argv[0]) -> seconds, 'default' for every other tool; None or
+                         missing = no timeout
+    """
+
+    def __init__(self, log_path=None, timeouts=None):
+
+        self.log_path = log_path
+        self.timeouts = dict(timeouts or {})
+        self.tool_stats = {}
+
+        self._lock = threading.Lock()
+
+        if log_path and not path.exists(path.dirname(log_path)):
+            os.makedirs(path.dirname(log_path))
+
+    def timeout_for(self, tool):
+
+        return self.timeouts.get(tool, self.timeouts.get('default'))
+
+    def run(self, cmd, timeout=None, check=True, capture=False, cwd=None):
+        """
+        Runs one command and waits for it, killing it when it runs past its timeout.
+
+        :param cmd: argv list (or command-line string, see as_argv)
+        :param timeout: seconds, overrides the tool's configured timeout
+        :param check: raise CommandError on a non-zero exit status / timeout
+        :param capture: return the command's stdout in result.output (it still goes to the log too)
+        :param cwd: working directory for the command
+        :return: CommandResult
+        """
+
+        argv = as_argv(cmd)
+        tool = path.basename(argv[0])
+        timeout = timeout if timeout is not None else self.timeout_for(tool)
+
+        log = open(self.log_path, 'a', 0) if self.log_path else None
+        captured = tempfile.TemporaryFile() if capture else None
+
+        try:
+            with self._lock:
+                if log:
+                    log.write('\n[%s] $ %s\n' % (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), ' '.join(argv)))
+
+            start = time.time()
+
+            proc = subprocess.Popen(argv, stdout=captured or log, stderr=log, cwd=cwd, close_fds=True)
+
+            status, usage, timed_out = self._wait(proc, timeout)
+
+            returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+            output = None
+
+            if captured:
+                captured.seek(0)
+                output = captured.read()
+                if log:
+                    log.write(output)
+
+            result = CommandResult(argv, tool, returncode, time.time() - start, usage.ru_utime + usage.ru_stime,
+                                   usage.ru_maxrss, output)
+
+            self._record(result, timed_out)
+
+            with self._lock:
+                if log:
+                    log.write('[%s] exit %s after %.1fs%s\n' % (tool, returncode, result.wall_s,
+                                                                 ' (killed, timeout %ss)' % timeout if timed_out else ''))
+        finally:
+            if log:
+                log.close()
+            if captured:
+                captured.close()
+
+        if check and timed_out:
+            raise CommandError(result, 'killed after %ss timeout' % timeout)
+
+        if check and returncode != 0:
+            raise CommandError(result, 'exited with status %s' % returncode)
+
+        return result
+
+    @staticmethod
+    def _wait(proc, timeout):
+        """
+        wait4()s for proc (for its rusage), sending SIGTERM at the timeout and SIGKILL if it is still there after
+        KILL_GRACE_SECONDS.
+
+        :return: tuple (wait status, rusage, Boolean timed out)
+        """
+
+        if not timeout:
+            # NOTHING TO WATCH THE CLOCK FOR: block until it exits, no polling delay added to every call
+            status, usage = CommandRunner._reap(proc)
+            return status, usage, False
+
+        deadline = time.time() + timeout
+        timed_out = False
+        interval = 0.01
+
+        while True:
+
+            pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+
+            if pid == proc.pid:
+                # reaped here: keep Popen from trying again
+                proc.returncode = status
+                return status, usage, timed_out
+
+            now = time.time()
+
+            if now >= deadline:
+
+                if not timed_out:
+                    timed_out = True
+                    proc.send_signal(signal.SIGTERM)
+                    deadline = now + KILL_GRACE_SECONDS
+                    # most tools exit right away on SIGTERM
+                    interval = 0.01
+                else:
+                    proc.kill()
+                    status, usage = CommandRunner._reap(proc)
+                    return status, usage, timed_out
+
+            # NEVER SLEEP PAST THE DEADLINE
+            time.sleep(max(min(interval, deadline - time.time()), 0.001))
+            interval = min(interval * 2, 0.5)
+
+    @staticmethod
+    def _reap(proc):
+        """
+        Blocking wait4() for proc, retried when a signal interrupts it.
+
+        :return: tuple (wait status, rusage)
+        """
+
+        while True:
+
+            try:
+                pid, status, usage = os.wait4(proc.pid, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            # reaped here: keep Popen from trying again
+            proc.returncode = status
+            return status, usage
+
+    def _record(self, result, timed_out):
+
+        with self._lock:
+
+            stats = self.tool_stats.setdefault(result.tool, {'count': 0, 'failed': 0, 'timed_out': 0, 'wall_s': 0.0,
+                                                             'cpu_s': 0.0, 'max_rss_kb': 0})
+            stats['count'] += 1
+            stats['failed'] += result.returncode != 0
+            stats['timed_out'] += timed_out
+            stats['wall_s'] += result.wall_s
+            stats['cpu_s'] += result.cpu_s
+            stats['max_rss_kb'] = max(stats['max_rss_kb'], result.maxrss_kb)
+
+    def write_stats(self, stats_path):
+        """
+        Writes the per-tool totals as JSON.
+
+        :return: stats_path
+        """
+
+        with self._lock:
+            with open(stats_path + '.tmp', 'w') as f:
+                json.dump(self.tool_stats, f, indent=1, sort_keys=True)
+
+        os.rename(stats_path + '.tmp', stats_path)
+
+        return stats_path
+
+    def print_stats(self):
+
+        row_format = '%-20s %6s %6s %12s %12s %14s'
+
+        print '\n' + row_format % ('tool', 'calls', 'failed', 'wall (s)', 'cpu (s)', 'max rss (MB)')
+        print '-' * 75
+
+        for tool, stats in sorted(self.tool_stats.items(), key=lambda item: item[1]['wall_s'], reverse=True):
+            print row_format % (tool, stats['count'], stats['failed'], '%.1f' % stats['wall_s'],
+                                '%.1f' % stats['cpu_s'], '%.1f' % (stats['max_rss_kb'] / 1024.0))
+
+
+# one runner per process: batch subjects each run in their own process
+_runner = CommandRunner()
+
+
+def get_runner():
+
+    return _runner
+
+
+def set_runner(runner):
+    """
+    :param runner: CommandRunner used by run_command from now on (e.g. one per subject)
+    :return: the previous runner
+    """
+
+    global _runner
+
+    previous, _runner = _runner, runner
+
+    return previous
+
+
+def run_command(cmd, **kwargs):
+    """
+    Runs cmd with the current runner, see CommandRunner.run.
+    """
+
+    return _runner.run(cmd, **kwargs)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+In-process (SciPy) temporal band-pass filtering of dense time-series for hcp_postprocess, the filtering part of
+FNL_preproc_Matlab.
+
+Same filter as Octave's butter(bp_order, [lp_Hz hp_Hz] / nyquist) + filtfilt: a Butterworth band-pass applied forward
+and backward (zero phase), with odd reflection padding of 3 * (filter length - 1) frames at both ends. The filter
+only depends on TR, order & cut-offs, so it is designed once per combination for the whole run (all series, all
+subjects of a batch worker).
+"""
+
+import threading
+import numpy as np
+from scipy import signal
+
+_filter_cache = {}
+_cache_lock = threading.Lock()
+
+
+def butterworth_bandpass(tr, order, low_hz, high_hz):
+    """
+    :param tr: repetition time (seconds)
+    :param order: project_config 'bp_order'
+    :param low_hz: lower cut-off (Hz)
+    :param high_hz: upper cut-off (Hz), below nyquist (0.5 / TR)
+    :return: tuple (b, a) filter coefficients, cached per (TR, order, cut-offs)
+    """
+
+    key = (round(float(tr), 6), int(order), float(low_hz), float(high_hz))
+
+    with _cache_lock:
+        if key in _filter_cache:
+            return _filter_cache[key]
+
+    nyquist = 0.5 / key[0]
+
+    if not 0 < key[2] < key[3] < nyquist:
+        raise ValueError('band-pass %s - %s Hz does not fit under the nyquist frequency (%s Hz) of TR %s' % (
+            low_hz, high_hz, nyquist, tr))
+
+    coefficients = signal.butter(key[1], [key[2] / nyquist, key[3] / nyquist], btype='bandpass')
+
+    with _cache_lock:
+        _filter_cache[key] = coefficients
+
+    return coefficients
+
+
+def clear_cache():
+
+    with _cache_lock:
+        _filter_cache.clear()
+
+
+def filtfilt(data, coefficients):
+    """
+    Zero-phase filtering along the time axis, padded like Octave / Matlab filtfilt.
+
+    :param data: array (frames, ...)
+    :param coefficients: tuple (b, a)
+    :return: float64 array, same shape
+    """
+
+    b, a = coefficients
+
+    padlen = 3 * (max(len(a), len(b)) - 1)
+
+    if data.shape[0] <= padlen:
+        raise ValueError('%s frames are too few for a filter of order %s (needs more than %s)' % (
+            data.shape[0], len(a) - 1, padlen))
+
+    return signal.filtfilt(b, a, data, axis=0, padlen=padlen)
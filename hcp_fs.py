@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+In-process file-system helpers for hcp_postprocess: copies, links & removals without forking cp / ln / rm.
+
+copy_file tries, in order: a reflink (copy-on-write clone, FICLONE: btrfs, XFS...), a hard link when the caller only
+ever reads the copy, os.copy_file_range / os.sendfile where this Python has them (kernel-side copies), and finally a
+buffered stream. Multi-GB dtseries copies on the same file system then cost no data copy at all.
+"""
+
+import os
+import errno
+import hashlib
+import shutil
+from os import path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+COPY_CHUNK_BYTES = 64 * 1024 * 1024
+
+# reflink / copy_file_range / sendfile refusals that just mean "not here, try the next way"
+UNSUPPORTED_ERRNOS = set(getattr(errno, name) for name in ('EXDEV', 'EINVAL', 'ENOSYS', 'EOPNOTSUPP', 'ENOTSUP',
+                                                          'ENOTTY', 'EBADF', 'EPERM') if hasattr(errno, name))
+
+
+# ~~~~~~~~~~~~~~~~ COPIES ~~~~~~~~~~~~~~~~ #
+def copy_file(src, dst, allow_link=False):
+    """
+    :param src: file to copy
+    :param dst: destination file (replaced if it exists), or existing directory
+    :param allow_link: dst is only ever read, so it may be a hard link to src
+    :return: how it was copied: 'same', 'reflink', 'hardlink', 'copy_file_range', 'sendfile' or 'stream'
+    """
+
+    if path.isdir(dst):
+        dst = path.join(dst, path.basename(src))
+
+    if path.exists(dst) and path.samefile(src, dst):
+        return 'same'
+
+    if path.lexists(dst):
+        os.remove(dst)
+
+    if allow_link and same_device(src, dst):
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError, e:
+            if e.errno not in UNSUPPORTED_ERRNOS and e.errno not in (errno.EMLINK, errno.EACCES):
+                raise
+
+    with open(src, 'rb') as source, open(dst, 'wb') as destination:
+
+        for method in (reflink, copy_file_range, sendfile):
+
+            try:
+                if method(source.fileno(), destination.fileno(), os.fstat(source.fileno()).st_size):
+                    return method.__name__
+            except (IOError, OSError), e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+
+            # A FAILED ATTEMPT MAY HAVE WRITTEN PART OF THE FILE, START OVER
+            destination.seek(0)
+            destination.truncate()
+            source.seek(0)
+
+        shutil.copyfileobj(source, destination, 1024 * 1024)
+
+    return 'stream'
+
+
+def reflink(source_fd, destination_fd, size):
+
+    if fcntl is None:
+        return False
+
+    fcntl.ioctl(destination_fd, FICLONE, source_fd)
+
+    return True
+
+
+def copy_file_range(source_fd, destination_fd, size):
+
+    copy_range = getattr(os, 'copy_file_range', None)
+
+    if copy_range is None:
+        return False
+
+    copied = 0
+
+    while copied < size:
+
+        count = copy_range(source_fd, destination_fd, min(COPY_CHUNK_BYTES, size - copied))
+
+        if not count:
+            break
+
+        copied += count
+
+    return copied == size
+
+
+def sendfile(source_fd, destination_fd, size):
+
+    send = getattr(os, 'sendfile', None)
+
+    if send is None:
+        return False
+
+    copied = 0
+
+    while copied < size:
+
+        count = send(destination_fd, source_fd, copied, min(COPY_CHUNK_BYTES, size - copied))
+
+        if not count:
+            break
+
+        copied += count
+
+    return copied == size
+
+
+def copy_files(sources, dst_dir, allow_link=False):
+    """
+    :return: dict of source -> how it was copied (see copy_file)
+    """
+
+    return dict((src, copy_file(src, dst_dir, allow_link)) for src in sources)
+
+
+def same_device(src, dst):
+
+    return os.stat(src).st_dev == os.stat(path.dirname(path.abspath(dst))).st_dev
+
+
+# ~~~~~~~~~~~~~~~~ LINKS & REMOVALS ~~~~~~~~~~~~~~~~ #
+def make_links(links):
+    """
+    Creates sym-links, leaving those already pointing at the right target alone (so re-runs do not touch them).
+
+    :param links: dict of target -> link path (an existing directory gets a link named after the target inside it)
+    :return: list of link paths (re-)created
+    """
+
+    created = []
+
+    for target, link_path in sorted(links.items()):
+
+        if path.isdir(link_path) and not path.islink(link_path):
+            link_path = path.join(link_path, path.basename(path.normpath(target)))
+
+        if path.islink(link_path):
+            if os.readlink(link_path) == target:
+                continue
+            os.remove(link_path)
+
+        elif path.lexists(link_path):
+            remove_path(link_path)
+
+        os.symlink(target, link_path)
+
+        created.append(link_path)
+
+    return created
+
+
+def remove_path(file_path):
+    """
+    rm -rf: removes a file, link or directory tree, if there.
+    """
+
+    if path.islink(file_path) or path.isfile(file_path):
+        os.remove(file_path)
+
+    elif path.isdir(file_path):
+        shutil.rmtree(file_path)
+
+
+def file_sha1(file_path, block_bytes=4 * 1024 * 1024):
+
+    sha1 = hashlib.sha1()
+
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_bytes), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+In-process (NumPy / nibabel) motion numbers for hcp_postprocess: FD for the native FNL_preproc, and FD / DVARS /
+censoring for the --fd-sweep report.
+
+All runs are handled as one concatenated series: framewise displacement comes from a single diff of every run's
+Movement_Regressors.txt stacked together (zeroed at each run start), and the censoring masks of a whole sweep of FD
+thresholds are computed at once as a (thresholds, frames) boolean array, so asking for results at another threshold
+does not mean another run.
+
+The report is a threshold table of its own (summary/FD_threshold_sweep.txt), written next to what analyses_v2.m
+writes for the GUI_environments consumers (FD.mat, power_2014_motion.mat, motion_numbers.mat), not instead of it.
+"""
+
+import numpy as np
+import nibabel as nib
+
+import hcp_cifti
+
+# Movement_Regressors.txt: translations x, y, z (mm), rotations x, y, z (degrees), then their derivatives
+ROTATION_COLUMNS = slice(3, 6)
+
+
+# ~~~~~~~~~~~~~~~~ MOTION ~~~~~~~~~~~~~~~~ #
+def framewise_displacement(movement, brain_radius_mm, run_lengths=None):
+    """
+    Framewise displacement (Power et al. 2012): sum of the absolute frame-to-frame changes of the 3 translations and
+    of the 3 rotations, taken as mm of arc on a sphere of brain_radius_mm.
+
+    :param movement: array (frames, >= 6) of movement regressors, runs one after the other
+    :param brain_radius_mm: project_config 'brain_radius_in_mm'
+    :param run_lengths: frames of each run in movement, None = a single run
+    :return: float64 array (frames,), 0 for the first frame of every run
+    """
+
+    params = np.array(movement[:, :6], dtype=np.float64)
+
+    params[:, ROTATION_COLUMNS] *= np.pi / 180.0 * brain_radius_mm
+
+    fd = np.zeros(params.shape[0])
+
+    fd[1:] = np.abs(np.diff(params, axis=0)).sum(axis=1)
+
+    fd[run_starts(run_lengths or [params.shape[0]])] = 0
+
+    return fd
+
+
+def dvars(dtseries_path, max_chunk_bytes=256 * 1024 * 1024):
+    """
+    DVARS (Power et al. 2012): root mean square over grayordinates of the frame-to-frame signal change, accumulated
+    over blocks of grayordinates.
+
+    :param dtseries_path: e.g. FNL_preproc/REST1_FNL_preproc_Atlas.dtseries.nii
+    :param max_chunk_bytes: bounds the dense data held in memory at once
+    :return: float64 array (frames,), 0 for the first frame
+    """
+
+    dense_img = nib.load(dtseries_path)
+
+    frames, grayordinates = dense_img.shape
+
+    squares = np.zeros(frames)
+
+    for first, block in hcp_cifti.iter_grayordinate_chunks(dense_img, max_chunk_bytes):
+        squares[1:] += np.square(np.diff(block, axis=0)).sum(axis=1)
+
+    return np.sqrt(squares / grayordinates)
+
+
+def run_starts(run_lengths):
+
+    return np.concatenate([[0], np.cumsum(run_lengths)[:-1]]).astype(int)
+
+
+# ~~~~~~~~~~~~~~~~ CENSORING ~~~~~~~~~~~~~~~~ #
+def censoring_masks(fd, thresholds, run_lengths, skip_frames, min_contiguous):
+    """
+    Frames kept at each FD threshold: FD <= threshold, not among the first skip_frames of a run, and inside a stretch
+    of at least min_contiguous such frames (stretches never span two runs).
+
+    :param fd: framewise displacement (frames,), runs concatenated
+    :param thresholds: FD thresholds (mm)
+    :param run_lengths: frames of each run
+    :param skip_frames: frames dropped at the start of every run (skip_seconds / TR)
+    :param min_contiguous: project_config 'expected_contiguous_frame_count'
+    :return: boolean array (thresholds, frames)
+    """
+
+    keep = np.asarray(fd)[np.newaxis, :] <= np.asarray(thresholds, dtype=np.float64)[:, np.newaxis]
+
+    for start, length in zip(run_starts(run_lengths), run_lengths):
+        keep[:, start:start + min(skip_frames, length)] = False
+
+    return contiguous_frames(keep, run_lengths, min_contiguous)
+
+
+def contiguous_frames(keep, run_lengths, min_length):
+    """
+    :param keep: boolean array (rows, frames)
+    :param run_lengths: frames of each run, stretches stop at run boundaries
+    :param min_length: shortest stretch of kept frames to keep
+    :return: boolean array (rows, frames), keep without the stretches shorter than min_length
+    """
+
+    # ONE FALSE COLUMN BETWEEN RUNS, ONE AT EACH END, THEN EVERY STRETCH STARTS AT A +1 AND ENDS AT A -1 EDGE
+    boundaries = np.cumsum(run_lengths)[:-1]
+
+    separated = np.insert(keep, boundaries, False, axis=1)
+
+    edges = np.diff(np.pad(separated.astype(np.int8), ((0, 0), (1, 1)), 'constant'), axis=1)
+
+    start_rows, starts = np.nonzero(edges == 1)
+    end_rows, ends = np.nonzero(edges == -1)
+
+    short = (ends - starts) < min_length
+
+    # +1 / -1 AT THE BOUNDS OF EVERY SHORT STRETCH, THE RUNNING SUM MARKS THE FRAMES INSIDE THEM
+    marks = np.zeros(edges.shape, dtype=int)
+
+    np.add.at(marks, (start_rows[short], starts[short]), 1)
+    np.add.at(marks, (end_rows[short], ends[short]), -1)
+
+    separated &= np.cumsum(marks, axis=1)[:, :-1] == 0
+
+    return np.delete(separated, boundaries + np.arange(len(boundaries)), axis=1)
+
+
+def motion_numbers(fd, dvars_values, masks, thresholds, run_lengths, tr):
+    """
+    :return: dict of per-threshold numbers (frame counts, seconds, mean FD & DVARS of the kept frames)
+    """
+
+    counts = masks.sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_fd = np.where(counts > 0, masks.dot(fd) / counts, np.nan)
+        mean_dvars = np.where(counts > 0, masks.dot(dvars_values) / counts, np.nan)
+
+    return {
+        'FD_threshold'                  : np.asarray(thresholds, dtype=np.float64)
+        , 'total_frame_count'           : masks.shape[1]
+        , 'remaining_frame_count'       : counts
+        , 'remaining_seconds'           : counts * float(tr)
+        , 'remaining_frame_mean_FD'     : mean_fd
+        , 'remaining_frame_mean_DVARS'  : mean_dvars
+        , 'remaining_frames_per_run'    : np.add.reduceat(masks.astype(int), run_starts(run_lengths), axis=1)
+    }
+
+
+def write_threshold_sweep(out_path, numbers):
+    """
+    :param out_path: e.g. summary/FD_threshold_sweep.txt
+    :param numbers: dict from motion_numbers
+    :return: out_path, one row per FD threshold: frames & seconds kept, mean FD & DVARS of the kept frames
+    """
+
+    with open(out_path, 'w') as f:
+
+        f.write('FD_threshold remaining_frame_count remaining_seconds remaining_frame_mean_FD '
+                'remaining_frame_mean_DVARS\n')
+
+        for i, threshold in enumerate(numbers['FD_threshold']):
+            f.write('%g %d %.1f %.6f %.6f\n' % (threshold, numbers['remaining_frame_count'][i],
+                                                 numbers['remaining_seconds'][i],
+                                                 numbers['remaining_frame_mean_FD'][i],
+                                                 numbers['remaining_frame_mean_DVARS'][i]))
+
+    return out_path
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Minimal NIfTI-1 / NIfTI-2 (CIFTI-2) header reader with a per-run cache, standard library only.
+
+Only the first 348 / 540 bytes of a file are read (for .nii.gz only that much is decompressed), which is all
+hcp_postprocess needs for TR, dimensions and voxel sizes -- no fslhd | grep | gawk pipeline per file. Headers are
+cached per path + mtime + size, so every stage asking about the same file during a run gets it for free.
+"""
+
+import os
+import gzip
+import struct
+import threading
+from collections import namedtuple
+from os import path
+
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+# CIFTI-2 intent codes (3000 - 3099): dense/parcellated series, scalars, labels...
+CIFTI_INTENT_CODES = range(3000, 3100)
+
+NiftiHeader = namedtuple('NiftiHeader', ['path', 'version', 'shape', 'pixdim', 'datatype', 'bitpix', 'vox_offset',
+                                         'scl_slope', 'scl_inter', 'xyzt_units', 'intent_code', 'byte_order'])
+
+_header_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _read_header_bytes(nifti_path):
+
+    opener = gzip.open if nifti_path.endswith('.gz') else open
+
+    f = opener(nifti_path, 'rb')
+
+    try:
+        return f.read(NIFTI2_HEADER_SIZE)
+    finally:
+        f.close()
+
+
+def parse_header(raw, nifti_path=''):
+    """
+    :param raw: first bytes of a NIfTI-1 (348) or NIfTI-2 (540) file
+    :param nifti_path: only used in the returned header / error messages
+    :return: NiftiHeader
+    """
+
+    for byte_order in ('<', '>'):
+
+        if len(raw) < 4:
+            break
+
+        sizeof_hdr = struct.unpack(byte_order + 'i', raw[:4])[0]
+
+        if sizeof_hdr == NIFTI1_HEADER_SIZE and len(raw) >= NIFTI1_HEADER_SIZE:
+
+            dim = struct.unpack(byte_order + '8h', raw[40:56])
+            intent_code, datatype, bitpix = struct.unpack(byte_order + '3h', raw[68:74])
+            pixdim = struct.unpack(byte_order + '8f', raw[76:108])
+            vox_offset, scl_slope, scl_inter = struct.unpack(byte_order + '3f', raw[108:120])
+            xyzt_units = struct.unpack('B', raw[123:124])[0]
+            version = 1
+
+        elif sizeof_hdr == NIFTI2_HEADER_SIZE and len(raw) >= NIFTI2_HEADER_SIZE:
+
+            datatype, bitpix = struct.unpack(byte_order + '2h', raw[12:16])
+            dim = struct.unpack(byte_order + '8q', raw[16:80])
+            pixdim = struct.unpack(byte_order + '8d', raw[104:168])
+            vox_offset = struct.unpack(byte_order + 'q', raw[168:176])[0]
+            scl_slope, scl_inter = struct.unpack(byte_order + '2d', raw[176:192])
+            xyzt_units, intent_code = struct.unpack(byte_order + '2i', raw[500:508])
+            version = 2
+
+        else:
+            continue
+
+        n_dims = max(0, min(int(dim[0]), 7))
+
+        return NiftiHeader(
+            path            = nifti_path
+            , version       = version
+            , shape         = tuple(int(d) for d in dim[1:n_dims + 1])
+            , pixdim        = tuple(float(p) for p in pixdim[1:n_dims + 1])
+            , datatype      = int(datatype)
+            , bitpix        = int(bitpix)
+            , vox_offset    = int(vox_offset)
+            , scl_slope     = float(scl_slope)
+            , scl_inter     = float(scl_inter)
+            , xyzt_units    = int(xyzt_units)
+            , intent_code   = int(intent_code)
+            , byte_order    = byte_order
+        )
+
+    raise ValueError('not a NIfTI-1 / NIfTI-2 file: %s' % nifti_path)
+
+
+def get_header(nifti_path):
+    """
+    Cached header of a .nii / .nii.gz / CIFTI file; re-read only if the file changed (mtime or size) since.
+
+    :param nifti_path: path to file
+    :return: NiftiHeader
+    """
+
+    nifti_path = path.abspath(nifti_path)
+
+    stat = os.stat(nifti_path)
+
+    key = (nifti_path, stat.st_mtime, stat.st_size)
+
+    with _cache_lock:
+        if key in _header_cache:
+            return _header_cache[key]
+
+    header = parse_header(_read_header_bytes(nifti_path), nifti_path)
+
+    with _cache_lock:
+        _header_cache[key] = header
+
+    return header
+
+
+def clear_cache():
+
+    with _cache_lock:
+        _header_cache.clear()
+
+
+def is_cifti(header):
+
+    return header.intent_code in CIFTI_INTENT_CODES
+
+
+def get_tr(nifti_path):
+    """
+    :param nifti_path: path to 4D NIfTI
+    :return: pixdim4 (TR) as stored in the header (same as fslhd's pixdim4)
+    """
+
+    header = get_header(nifti_path)
+
+    return header.pixdim[3] if len(header.pixdim) > 3 else 0.0
+
+
+def get_frames_and_elements(nifti_path):
+    """
+    :param nifti_path: path to 4D NIfTI or to a CIFTI series (e.g. .dtseries.nii)
+    :return: tuple (number of frames, number of voxels / grayordinates per frame)
+    """
+
+    header = get_header(nifti_path)
+
+    shape = header.shape
+
+    if is_cifti(header):
+        # CIFTI-2 keeps its matrix in dims 5 (series points) & 6 (grayordinates / parcels)
+        matrix_dims = shape[4:] or (1,)
+        return int(matrix_dims[0]), int(reduce(lambda a, b: a * b, matrix_dims[1:], 1))
+
+    frames = shape[3] if len(shape) > 3 else 1
+
+    return int(frames), int(reduce(lambda a, b: a * b, shape[:3], 1))
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""
+One managed Octave interpreter per subject for hcp_postprocess.
+
+Starting Octave (and re-adding the code paths) for every REST series and again for analyses_v2 costs more than some of
+the work itself, so OctaveSession starts one Oct2Py lazily, keeps it for every call, checks it still answers before
+each call and restarts it if it hangs. Oct2Py exchanges its data through .mat files in temp_dir; that directory lives
+on node-local tmpfs (/dev/shm) when available instead of the NFS matlab_code folder.
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+from os import path
+from oct2py import Oct2Py
+
+# grayordinates in a standard 91k (32k_fs_LR surfaces + 2mm subcortical) dtseries
+STANDARD_GRAYORDINATES = 91282
+
+
+def local_temp_root():
+    """
+    Picks where Octave temp files go: $HCP_OCTAVE_TMPDIR if set, else /dev/shm (tmpfs) if writable, else the system
+    temp dir (usually node-local /tmp).
+
+    :return: path to a writable directory
+    """
+
+    candidates = [os.environ.get('HCP_OCTAVE_TMPDIR'), '/dev/shm', tempfile.gettempdir()]
+
+    for candidate in candidates:
+        if candidate and path.isdir(candidate) and os.access(candidate, os.W_OK):
+            return candidate
+
+    return tempfile.gettempdir()
+
+
+def scaled_timeout(timeout_config, frames, grayordinates=STANDARD_GRAYORDINATES):
+    """
+    Octave time grows with the size of the data it works on: base seconds + seconds per million (frame x grayordinate)
+    values.
+
+    :param timeout_config: dict with 'base' and 'per_million_values' (see config octave_timeouts)
+    :param frames: number of frames (time points) the call processes
+    :param grayordinates: number of grayordinates per frame
+    :return: timeout in seconds (int)
+    """
+
+    values = float(frames) * grayordinates / 1e6
+
+    return int(timeout_config['base'] + timeout_config['per_million_values'] * values)
+
+
+def wait_for_outputs(expected_paths, is_running=None, deadline=600, poll_interval=2):
+    """
+    Polls for expected output files, returning as soon as all of them exist and stopped growing, as soon as the process
+    producing them is gone, or at the deadline -- whichever comes first.
+
+    :param expected_paths: paths that exist once the work is complete
+    :param is_running: optional callable, False once the producing process has died
+    :param deadline: max seconds to wait
+    :param poll_interval: seconds between checks
+    :return: Boolean, True if all expected outputs are there
+    """
+
+    give_up_at = time.time() + deadline
+
+    last_sizes = None
+
+    while True:
+
+        if all(path.exists(expected) for expected in expected_paths):
+
+            sizes = [os.stat(expected).st_size for expected in expected_paths]
+
+            # same sizes as on the last check -> nothing is still being written
+            if sizes == last_sizes:
+                return True
+
+            last_sizes = sizes
+
+        elif is_running is not None and not is_running():
+
+            print '\nOctave process is gone and outputs are missing: \n%s' % '\n'.join(
+                expected for expected in expected_paths if not path.exists(expected))
+
+            return False
+
+        if time.time() >= give_up_at:
+            return all(path.exists(expected) for expected in expected_paths)
+
+        time.sleep(min(poll_interval, max(0, give_up_at - time.time())))
+
+
+class OctaveSession(object):
+    """
+    Lazily-started, thread-safe Oct2Py wrapper with paths preloaded, a health check and automatic restart.
+
+    :parameter executable: path to octave binary (env config 'octave')
+    :parameter code_paths: directories to addpath once per interpreter start
+    :parameter health_timeout: seconds the interpreter has to answer the health check before it is restarted
+    """
+
+    def __init__(self, executable, code_paths, health_timeout=30, convert_to_float=False):
+
+        self.executable = executable
+        self.code_paths = [code_path for code_path in code_paths if code_path]
+        self.health_timeout = health_timeout
+        self.convert_to_float = convert_to_float
+
+        self.oc = None
+        self.temp_dir = None
+        self.starts = 0
+
+        self._lock = threading.RLock()
+        self._suspect = False
+
+    def __repr__(self):
+
+        # stable across runs: sessions are passed to stages, whose arguments are hashed by the stage cache
+        return 'OctaveSession(%r, %r)' % (self.executable, self.code_paths)
+
+    def start(self):
+        """
+        Starts a new interpreter in a fresh node-local temp dir and adds the code paths to it.
+        """
+
+        with self._lock:
+
+            self.temp_dir = tempfile.mkdtemp(prefix='hcp_octave_', dir=local_temp_root())
+
+            print '\nStarting Octave session (temp dir: %s)...' % self.temp_dir
+
+            self.oc = Oct2Py(executable=self.executable, timeout=self.health_timeout, temp_dir=self.temp_dir,
+                             convert_to_float=self.convert_to_float)
+
+            for code_path in self.code_paths:
+                self.oc.addpath(code_path)
+
+            self.starts += 1
+            self._suspect = False
+
+    def is_alive(self):
+        """
+        Health check: the interpreter has to evaluate a trivial expression within health_timeout seconds.
+
+        :return: Boolean
+        """
+
+        with self._lock:
+
+            if self.oc is None:
+                return False
+
+            self.oc.timeout = self.health_timeout
+
+            try:
+                return int(self.oc.eval('1 + 1')) == 2
+            except Exception, e:
+                print '\nOctave session did not answer the health check: %s' % e
+                return False
+
+    def octave_pid(self):
+        """
+        :return: pid of the octave process behind the current Oct2Py instance, or None if unknown
+        """
+
+        oc = self.oc
+
+        # oct2py >= 4 talks to octave through a metakernel REPL, older versions through their own _session
+        for attrs in (('_engine', 'repl', 'child', 'pid'), ('_session', 'proc', 'pid')):
+
+            obj = oc
+
+            for attr in attrs:
+                obj = getattr(obj, attr, None)
+
+            if isinstance(obj, int):
+                return obj
+
+        return None
+
+    def process_alive(self):
+        """
+        Checks the octave process without talking to it (safe to use while a call is still running).
+
+        :return: Boolean, False once the process is gone (or a zombie); True if alive or its pid is unknown
+        """
+
+        if self.oc is None:
+            return False
+
+        pid = self.octave_pid()
+
+        if pid is None:
+            return True
+
+        try:
+            with open('/proc/%s/stat' % pid) as f:
+                return f.read().split(')')[-1].split()[0] != 'Z'
+        except (IOError, OSError, IndexError):
+            try:
+                os.kill(pid, 0)
+                return True
+            except OSError:
+                return False
+
+    def restart(self):
+
+        with self._lock:
+            print '\nRestarting Octave session...'
+            self.exit()
+            self.start()
+
+    def call(self, func_name, *args, **kwargs):
+        """
+        Calls an Octave function (found on the code paths) in the session, (re-)starting the interpreter if needed.
+
+        :param func_name: e.g. 'FNL_preproc_Matlab'
+        :param args: arguments passed on to the function
+        :param timeout: seconds before Oct2Py gives up on the call (keyword only)
+        :return: whatever Oct2Py returns
+        """
+
+        timeout = kwargs.pop('timeout', None)
+
+        with self._lock:
+
+            if self.oc is None:
+                self.start()
+            elif self._suspect and not self.is_alive():
+                self.restart()
+
+            self.oc.timeout = timeout
+
+            try:
+                return getattr(self.oc, func_name)(*args)
+            except Exception:
+                # a timed-out / crashed call may leave octave busy: check it before it is used again
+                self._suspect = True
+                raise
+
+    def exit(self):
+        """
+        Stops the interpreter (if any) and removes its temp dir.
+        """
+
+        with self._lock:
+
+            if self.oc is not None:
+                try:
+                    self.oc.exit()
+                except Exception, e:
+                    print '\nProblem stopping Octave session: %s' % e
+
+            self.oc = None
+
+            if self.temp_dir and path.exists(self.temp_dir):
+                shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+            self.temp_dir = None
@@ -11,13 +11,64 @@ import os
 import sys
 from os import path
 import argparse
-import subprocess
-import shutil
+import multiprocessing
+import re
+import json
+import hashlib
+import threading
+from fnmatch import fnmatch
 from glob import glob
+from multiprocessing.pool import ThreadPool
 import config_hcp_postprocess
-from oct2py import Oct2Py
+import hcp_backends
+import hcp_fs
+import hcp_scratch
+import hcp_volume_cache
+import hcp_stages
+import hcp_octave
+import hcp_nifti
+import hcp_trace
+import hcp_commands
+
+try:
+    import hcp_volumes  # native engines, need numpy & nibabel
+except ImportError:
+    hcp_volumes = None
+try:
+    import hcp_cifti  # native parcellation, needs numpy, nibabel & scipy
+except ImportError:
+    hcp_cifti = None
+try:
+    import hcp_regression  # native nuisance regression & band-pass filtering, need numpy, nibabel & scipy
+    import hcp_filter
+    import hcp_motion
+except ImportError:
+    hcp_regression = hcp_filter = hcp_motion = None
+try:
+    import hcp_qc  # native QC montages, need numpy, nibabel & Pillow
+except ImportError:
+    hcp_qc = None
+try:
+    import numpy as np  # in-process regressor checks
+except ImportError:
+    np = None
+from collections import namedtuple
 import time
 from datetime import datetime
+from functools import partial
+
+# Movement_Regressors.txt: 6 rigid-body motion parameters, optionally followed by their 6 derivatives (HCP)
+MOVEMENT_REGRESSOR_COLUMNS = (6, 12)
+
+RegressorReport = namedtuple('RegressorReport', ['series', 'epi_path', 'regressors_path', 'frames', 'rows', 'columns',
+                                                 'non_finite', 'problems'])
+
+# written to <output_folder>/summary by every run
+TRACE_FILE_NAME = 'hcp_postprocess_trace.json'  # Chrome trace (chrome://tracing, ui.perfetto.dev)
+STAGE_SUMMARY_FILE_NAME = 'hcp_postprocess_stages.json'
+COMMAND_LOG_FILE_NAME = 'hcp_postprocess_commands.log'
+TOOL_SUMMARY_FILE_NAME = 'hcp_postprocess_tools.json'  # per external binary: calls, wall & cpu time, max rss
+FD_SWEEP_FILE_NAME = 'FD_threshold_sweep.txt'  # --fd-sweep: frames kept at each FD threshold
 
 PROG = 'hcp_post-process_pipeline'
 VERSION = '0.7.3'
@@ -47,12 +98,13 @@ def get_parser():
 
     parser = argparse.ArgumentParser(description=program_desc, prog=PROG, version=VERSION)
 
-    parser.add_argument('-s', '--subject_ID', dest='subject_code', action='store', required=True,
-                        help='''Expects subjID, e.g. ABCDPILOT_MSC02/''')
+    parser.add_argument('-s', '--subject_ID', dest='subject_code', action='store',
+                        help='''Expects subjID, e.g. ABCDPILOT_MSC02/ (required unless using --list)''')
 
-    parser.add_argument('-o', '--output_path', dest='output_path', action='store', required=True,
+    parser.add_argument('-o', '--output_path', dest='output_path', action='store',
                         help='''Expects path to the main subject-code folder where all folders & files get created
-                        during HCP. Should contain unprocessed, T1w, T2w, some REST folders, MNINonLinear, Scripts''')
+                        during HCP. Should contain unprocessed, T1w, T2w, some REST folders, MNINonLinear, Scripts
+                        (required unless using --list)''')
 
     parser.add_argument('-p', '--project_config', dest='project_config', action='store',
                         help='Configure like -p <project> to force a different config...')
@@ -61,6 +113,51 @@ def get_parser():
                         help='''Path to list-file of data to process. List-file should be a 2-column,
                         comma-separated values (.csv file) with contents: subjectID, output_folder for each row.''')
 
+    parser.add_argument('-w', '--workers', dest='workers', action='store', type=int, default=2,
+                        help='''Number of subjects to process at once when using --list (default: 2). Each subject
+                        runs in its own process, so a failure in one does not stop the others.''')
+
+    parser.add_argument('-c', '--cpus', dest='cpus', action='store', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='''Max number of pipeline stages run at once for each subject (default: number of CPUs).
+                        Steps that do not depend on each other (gifs, flirt, scene images, masks, per-REST steps)
+                        run side-by-side.''')
+
+    parser.add_argument('--backend', dest='backends', action='append', metavar='STAGE=BACKEND',
+                        help='''Which implementation runs a stage, e.g. --backend masks=native,parcellate=native (can
+                        be given several times). Stages & backends: %s. 'native' engines run in-process (NumPy /
+                        nibabel / SciPy) and fall back to the tool when those are not installed. Defaults come
+                        from config_hcp_postprocess.backends (every stage's tool). Chunk sizes & the FD threshold
+                        sweep of the native engines are set in config_hcp_postprocess.native_settings.''' % '; '.join(
+                            '%s (%s)' % (stage, ' | '.join(hcp_backends.BACKENDS[stage]))
+                            for stage in sorted(hcp_backends.BACKENDS)))
+
+    parser.add_argument('-i', '--image', dest='image_patterns', action='append', metavar='NAME',
+                        help='''Only render scene image NAME (from image_names in config_hcp_postprocess, shell-style
+                        patterns like 'T1-Axial-*' work too). Can be given several times. Default: all images (T2-*
+                        ones only when the subject has a T2).''')
+
+    parser.add_argument('--check-regressors', dest='check_regressors', action='store_true',
+                        help='''Only check the Movement_Regressors.txt of every series (of the subject, or of every
+                        subject in --list, all at once) against the raw epi frame counts, print a report and exit
+                        (status 1 if any is invalid).''')
+
+    parser.add_argument('--fd-sweep', dest='fd_sweep', action='store_true',
+                        help='''Also write summary/%s: FD, DVARS & frames kept for every FD threshold in
+                        config_hcp_postprocess.native_settings (plus fd_th), computed in-process (NumPy / nibabel)
+                        next to analyses_v2.''' % FD_SWEEP_FILE_NAME)
+
+    parser.add_argument('-f', '--force-stage', dest='force_stages', action='append', metavar='NAME',
+                        help='''Re-run stage NAME (and every stage downstream of it) even if its inputs and settings
+                        have not changed since the last run. Can be given several times. Use "all" to remove previous
+                        outputs and start over.''')
+
+    parser.add_argument('--scratch', dest='scratch_dir', action='store', metavar='DIR',
+                        help='''Node-local disk or tmpfs to run in: the subject's inputs are copied to a private folder
+                        under DIR, every stage runs there, then what the run produced is synced back (in parallel,
+                        sha1-checked) and the folder removed, whether the run succeeded or not. The stage manifests
+                        and earlier outputs come along, so stages that are up to date are still skipped.''')
+
     return parser
 
 
@@ -97,15 +194,15 @@ def get_configs(env, project_name_from_config):
 
     if 'airc' in env.lower():
 
-        env_config = config_fnl_preproc.configured_environments['airc']
+        env_config = config_hcp_postprocess.configured_environments['airc']
 
     elif 'exacloud' in env.lower():
 
-        env_config = config_fnl_preproc.configured_environments['exacloud']
+        env_config = config_hcp_postprocess.configured_environments['exacloud']
 
     elif 'rushmore' in env.lower():
 
-        env_config = config_fnl_preproc.configured_environments['rushmore']
+        env_config = config_hcp_postprocess.configured_environments['rushmore']
 
     else:
 
@@ -113,17 +210,17 @@ def get_configs(env, project_name_from_config):
         print 'env was: %s' % env.lower()
         exit(1)
 
-    if project_name_from_config in config_fnl_preproc.configured_projects.keys():
+    if project_name_from_config in config_hcp_postprocess.configured_projects.keys():
 
-        project_config = config_fnl_preproc.configured_projects[project_name_from_config]
+        project_config = config_hcp_postprocess.configured_projects[project_name_from_config]
 
     else:
-        print 'no configurations for that project! choices are...\n%s' % config_fnl_preproc.configured_projects.keys()
+        print 'no configurations for that project! choices are...\n%s' % config_hcp_postprocess.configured_projects.keys()
         exit(1)
 
-    img_names = config_fnl_preproc.image_names
+    img_names = config_hcp_postprocess.image_names
 
-    mask_thresh_vals = config_fnl_preproc.mask_threshold_values_dict
+    mask_thresh_vals = config_hcp_postprocess.mask_threshold_values_dict
 
     return env_config, project_config, img_names, mask_thresh_vals
 
@@ -163,29 +260,19 @@ def infer_project_details_from_path(output_path, subject_code):
     return project_name, visitID, pipe_name
 
 
-def submit_command(cmd):
+def submit_command(cmd, timeout=None, capture=False):
     """
-    Takes a command-line (string) and runs it in a sub-shell, collecting either errors or info (output) in logger.
-
-    :parameter cmd: command-line (string) you might otherwise run in a shell terminal
-    :return: output
+    Runs a command without a shell, through the subject's hcp_commands runner: output goes to the subject's command
+    log, a non-zero exit status (or running past the tool's timeout) raises hcp_commands.CommandError.
+
+    :parameter cmd: argv list, or command-line (string) you might otherwise run in a shell terminal (split into argv,
+                    so no pipes, redirects or globs)
+    :parameter timeout: seconds, overrides the tool's timeout from config command_timeouts
+    :parameter capture: also return what the command wrote to stdout
+    :return: output if capture, else None
     """
 
-    proc = subprocess.Popen(
-        cmd
-        , shell=True
-        , stdout=subprocess.PIPE
-        , stderr=subprocess.PIPE
-    )
-
-    (output, error) = proc.communicate()
-
-    if error:
-        print 'error! %s' % error
-    if output:
-        print 'output: %s' % output
-
-    return output
+    return hcp_commands.run_command(cmd, timeout=timeout, capture=capture).output
 
 
 def check_complete_inputs(t1_path, regressor_path, t1_brain_path):
@@ -225,7 +312,7 @@ def remove_outputs(list_of_output_paths):
 
         if path.exists(output):
 
-            shutil.rmtree(output)
+            hcp_fs.remove_path(output)
 
 
 def check_final_outputs(path_to_subjdir, subjID):
@@ -276,18 +363,19 @@ def check_final_outputs(path_to_subjdir, subjID):
 # # Count from i to max scenes number, check for t2, create_image_from_template on scene i
 # # OUTPUTS A BUNCH OF PNG FILES
 
-def create_image_from_template(output_folder, scene_num, image_name, env_binaries):
+def create_image_from_template(output_folder, scene_num, image_name, env_binaries, temp_scene=None):
     """
     takes a scene number, finds a template and uses wb_command to make an image
 
     :parameter output_folder: user input
-    :parameter scene_num: established in main for-loop
+    :parameter scene_num: position (from 1) of the image in image_names
     :parameter image_name:
     :parameter env_binaries: from config
+    :parameter temp_scene: .scene file to render from, defaults to output_folder/image_template_temp.scene
     :return: None
     """
-    temp_scene = path.join(output_folder, 'image_template_temp.scene')
-    cmd = '%(wb_command)s -show-scene %(temp-scene)s %(scene-num)s %(out-path)s 900 800 > /dev/null 2>&1' % {
+    temp_scene = temp_scene or path.join(output_folder, 'image_template_temp.scene')
+    cmd = '%(wb_command)s -show-scene %(temp-scene)s %(scene-num)s %(out-path)s 900 800' % {
 
         'wb_command': path.join(env_binaries['wb_command']),
         'temp-scene': temp_scene,
@@ -300,7 +388,8 @@ def create_image_from_template(output_folder, scene_num, image_name, env_binarie
 
 def build_scene_from_template(t2_path, t1_path, rp_path, lp_path, rwm_path, lwm_path, output_folder):
     """
-    Takes several paths and creates a .scene file incorporating them
+    Takes several paths and creates a .scene file incorporating them: every <TEMPLATE>_PATH / <TEMPLATE>_NAME
+    placeholder is substituted in one pass over the template, which is read & written once.
 
     :parameter t2_path: e.g. ${OutputFolder}/MNINonLinear/T2w_restore.nii.gz
     :parameter t1_path: e.g. ${OutputFolder}/MNINonLinear/T1w_restore.nii.gz
@@ -309,44 +398,33 @@ def build_scene_from_template(t2_path, t1_path, rp_path, lp_path, rwm_path, lwm_
     :parameter rwm_path: right white matter surface
     :parameter lwm_path: left white matter surface
     :parameter output_folder: user input
-    :return: None
+    :return: path to the new .scene file
     """
 
     temp_scene = path.join(output_folder, 'image_template_temp.scene')
 
-    shutil.copyfile(path.join(path.dirname(sys.argv[0]), 'templates', 'image_template_temp.scene'), temp_scene)
-
     path_list = [t2_path, t1_path, rp_path, lp_path, rwm_path, lwm_path]
 
     templates = ['T2_IMG', 'T1_IMG', 'RPIAL', 'LPIAL', 'RWHITE', 'LWHITE']
 
-    new_list = zip(path_list, templates)
-    # print 'new_list is: \n%s' % new_list
-
-    for item in new_list:
-        # replace templated pathnames and filenames in scene
-            with open(temp_scene, 'rw') as f:
-
-                text = f.read()
-
-                string_to_replace = '%s_PATH' % item[1]
-
-                text = text.replace(string_to_replace, item[0])
-
-                filename = path.basename(item[0])
+    # replace templated pathnames and filenames in scene
+    substitutions = {}
 
-                other_string_to_replace = '%s_NAME'
+    for file_path, template in zip(path_list, templates):
+        substitutions['%s_PATH' % template] = file_path
+        substitutions['%s_NAME' % template] = path.basename(file_path)
 
-                text = text.replace(other_string_to_replace, filename)
+    placeholders = re.compile('|'.join(re.escape(placeholder) for placeholder in
+                                       sorted(substitutions, key=len, reverse=True)))
 
-                f.close()
+    with open(path.join(path.dirname(sys.argv[0]), 'templates', 'image_template_temp.scene'), 'r') as f:
+        text = f.read()
 
-            # WRITE OUT THE NEW SCENE FILE
-            new_scene = path.join(output_folder, 'image_template_temp.scene')
+    # WRITE OUT THE NEW SCENE FILE
+    with open(temp_scene, 'w') as g:
+        g.write(placeholders.sub(lambda match: substitutions[match.group(0)], text))
 
-            with open(new_scene, 'w') as g:
-                g.write(text)
-                g.close()
+    return temp_scene
 
 
 def count_epi_series(path_to_data_dir):
@@ -364,9 +442,144 @@ def count_epi_series(path_to_data_dir):
 
 
 # CHECK EACH REST SERIES' DATA
+def load_regressors(regressors_path):
+    """
+    Reads a Movement_Regressors.txt (whitespace-separated, one row per frame) into a 2D float array.
+
+    :parameter regressors_path: path to MNINonLinear/Results/REST?/Movement_Regressors.txt
+    :return: tuple (array (rows, columns) or None, problem string or None)
+    """
+
+    if not path.exists(regressors_path):
+        return None, 'missing'
+
+    with open(regressors_path, 'r') as f:
+        rows = [line.split() for line in f if line.strip()]
+
+    if not rows:
+        return None, 'empty'
+
+    widths = set(len(row) for row in rows)
+
+    if len(widths) > 1:
+        return None, 'rows have %s different column counts: %s' % (len(widths), sorted(widths))
+
+    try:
+        return np.array(rows, dtype=np.float64), None
+    except ValueError, e:
+        return None, 'not numeric (%s)' % e
+
+
+def validate_regressors(series_list, expected_columns=MOVEMENT_REGRESSOR_COLUMNS):
+    """
+    Checks the Movement_Regressors.txt of any number of series (one subject or a whole cohort) at once: one row per
+    frame of the raw epi (frame counts from the cached NIfTI headers), a known number of columns, finite values only.
+
+    :parameter series_list: list of tuples (series label, path to raw epi, path to Movement_Regressors.txt)
+    :parameter expected_columns: accepted column counts
+    :return: list of RegressorReport, same order as series_list (report.problems empty = valid)
+    """
+
+    loaded = [load_regressors(regressors_path) for label, epi_path, regressors_path in series_list]
+
+    frames = np.zeros(len(series_list), dtype=np.int64)
+    header_problems = []
+
+    for series_num, (label, epi_path, regressors_path) in enumerate(series_list):
+        try:
+            frames[series_num] = hcp_nifti.get_frames_and_elements(epi_path)[0]
+            header_problems.append(None)
+        except (IOError, OSError, ValueError), e:
+            frames[series_num] = -1
+            header_problems.append('cannot read epi header (%s)' % e)
+
+    shapes = np.array([values.shape if values is not None else (0, 0) for values, problem in loaded], dtype=np.int64)
+    shapes = shapes.reshape(len(series_list), 2)
+
+    non_finite = np.array([int(np.size(values) - np.count_nonzero(np.isfinite(values))) if values is not None else 0
+                           for values, problem in loaded], dtype=np.int64)
+
+    # the checks themselves, for every series at once
+    loaded_ok = np.array([values is not None for values, problem in loaded], dtype=bool)
+    rows_match = shapes[:, 0] == frames
+    columns_ok = np.in1d(shapes[:, 1], expected_columns)
+    all_finite = non_finite == 0
+
+    reports = []
+
+    for series_num, (label, epi_path, regressors_path) in enumerate(series_list):
+
+        problems = [problem for problem in (loaded[series_num][1], header_problems[series_num]) if problem]
+
+        if loaded_ok[series_num]:
+            if frames[series_num] >= 0 and not rows_match[series_num]:
+                problems.append('%s rows for %s frames' % (shapes[series_num, 0], frames[series_num]))
+            if not columns_ok[series_num]:
+                problems.append('%s columns, expected %s' % (shapes[series_num, 1],
+                                                             ' or '.join(str(n) for n in expected_columns)))
+            if not all_finite[series_num]:
+                problems.append('%s non-finite values' % non_finite[series_num])
+
+        reports.append(RegressorReport(
+            series              = label
+            , epi_path          = epi_path
+            , regressors_path   = regressors_path
+            , frames            = int(frames[series_num])
+            , rows              = int(shapes[series_num, 0])
+            , columns           = int(shapes[series_num, 1])
+            , non_finite        = int(non_finite[series_num])
+            , problems          = problems
+        ))
+
+    return reports
+
+
+def print_regressor_report(reports):
+    """
+    :parameter reports: list of RegressorReport
+    :return: number of invalid series
+    """
+
+    invalid = [report for report in reports if report.problems]
+
+    print '\n~~~~~~~~~~~~~~~~ MOVEMENT REGRESSORS: %s series, %s invalid ~~~~~~~~~~~~~~~~' % (len(reports), len(invalid))
+
+    for report in reports:
+        print '%-40s %6s frames %6s rows %3s cols   %s' % (report.series, report.frames, report.rows, report.columns,
+                                                           '; '.join(report.problems) or 'valid')
+
+    return len(invalid)
+
+
+def find_subject_series(subject, output_folder):
+    """
+    :parameter subject: subjectID
+    :parameter output_folder: absolute path to HCP processed data directory
+    :return: list of tuples (subject/REST?, path to raw epi, path to Movement_Regressors.txt), for validate_regressors
+    """
+
+    raw_data_dir = path.join(output_folder, 'unprocessed', 'NIFTI')
+
+    if not path.isdir(raw_data_dir):
+        return []
+
+    series_list = []
+
+    for epi_path in sorted(count_epi_series(raw_data_dir)[1]):
+
+        resting_series_name, rest_num = get_epi_series_info_from_file(epi_path, subject)
+
+        series_list.append(('%s/%s' % (subject, resting_series_name), epi_path,
+                            path.join(output_folder, 'MNINonLinear', 'Results', resting_series_name,
+                                      'Movement_Regressors.txt')))
+
+    return series_list
+
+
 def check_regressors_valid(epi_path, epi_results_path, env_binaries):
     """
-    Uses configured path to regressors-checking script, reports whether 'valid' per file
+    Checks the series' Movement_Regressors.txt in-process (validate_regressors), or with the configured
+    regressors-checking script when NumPy is not available.
 
     :parameter epi_path:
     :parameter epi_results_path:
@@ -380,7 +593,18 @@ def check_regressors_valid(epi_path, epi_results_path, env_binaries):
         print 'Missing the Movement_Regressors.txt file within %s' % path.join(epi_results_path, path.dirname(epi_path))
         sys.exit()
 
-    invalid_files = []
+    if np is not None:
+
+        report = validate_regressors([(path.basename(epi_results_path), epi_path, regressors_path)])[0]
+
+        if report.problems:
+            print '\nmovement regressor file is invalid for %s: %s' % (path.basename(epi_path),
+                                                                      '; '.join(report.problems))
+            return False
+
+        print '\nmovement regressor file is valid for %s...' % path.basename(epi_path)
+
+        return True
 
     validity_test_cmd = "python %(path_to_movment_regressor_check_binary)s --fmri %(raw_epi)s --movmnt %(reg_path)s" % {
 
@@ -389,25 +613,14 @@ def check_regressors_valid(epi_path, epi_results_path, env_binaries):
         'reg_path'                                  : regressors_path
     }
 
-    validty_test_result = submit_command(validity_test_cmd).strip('\n')
-    #print '\nvalidty_test_result is: \n%s' % validty_test_result
+    validty_test_result = submit_command(validity_test_cmd, capture=True).strip('\n')
 
     if validty_test_result == 'valid':
-
-        #  if valid-files == True
         print '\nmovement regressor file is valid for %s...' % path.basename(epi_path)
-
-    else:
-
-        invalid_files.append(epi_path)
-        # print '\nregressor_path is invalid. This is usually due to a random race condition within HCP. ' \
-        #       '\n\tPlease rerun HCP vol!\n'
-
-    if invalid_files:
-        return False
-    else:
         return True
 
+    return False
+
 
 # SETUP AND RUN SLICES (FSL) COMMAND TO MAKE .GIFS
 # TODO: remove hard-coded atlas dependencies for a particular species?
@@ -423,6 +636,10 @@ def create_t1_atlas_gifs(atlas_path, t1_restore_brain_path, summary_dir, subject
     :return: None
     """
 
+    # BOTH MONTAGES READ THE SAME UNCOMPRESSED COPIES
+    t1_restore_brain_path = hcp_volume_cache.local_path(t1_restore_brain_path)
+    atlas_path = hcp_volume_cache.local_path(atlas_path)
+
     cmd_atlas_in_t1 = 'slices %(t1-path)s %(atlas-path)s -o %(summary-dir)s/%(subjID)s_atlas_in_t1.gif' % {
         't1-path'       : t1_restore_brain_path
         , 'atlas-path'  : atlas_path
@@ -439,6 +656,19 @@ def create_t1_atlas_gifs(atlas_path, t1_restore_brain_path, summary_dir, subject
     submit_command(cmd_t1_in_atlas)
 
 
+def create_t1_atlas_gifs_native(atlas_path, t1_restore_brain_path, summary_dir, subjectID):
+    """
+    Same .gifs as create_t1_atlas_gifs, rendered in-process from one read of the atlas & the T1.
+
+    :return: list of paths to the .gifs
+    """
+
+    return [hcp_qc.render_slices(t1_restore_brain_path, atlas_path,
+                                 path.join(summary_dir, '%s_atlas_in_t1.gif' % subjectID)),
+            hcp_qc.render_slices(atlas_path, t1_restore_brain_path,
+                                 path.join(summary_dir, '%s_t1_in_atlas.gif' % subjectID))]
+
+
 # RUN FSL FLIRT on t1_brain -> reg to t1 2mm isovoxel brain -> t1_brain_2mm_mni_space
 
 def flirt_t1_to_mni_2mm(t1_brain_path, fsl_standard_path):
@@ -452,15 +682,90 @@ def flirt_t1_to_mni_2mm(t1_brain_path, fsl_standard_path):
 
     alt_t1_brain = t1_brain_path.replace('_brain.nii.gz', '_brain.2.nii.gz')
 
-    cmd = 'flirt -in %(t1-brain-path)s -ref %(fsl-std)s -applyisoxfm 2 -out %(alt-t1-brain)s' % {
-        't1-brain-path' : t1_brain_path
-        , 'fsl-std'     : fsl_standard_path
-        , 'alt-t1-brain': alt_t1_brain
-    }
+    def run_flirt():
 
-    submit_command(cmd)
+        cmd = 'flirt -in %(t1-brain-path)s -ref %(fsl-std)s -applyisoxfm 2 -out %(alt-t1-brain)s' % {
+            't1-brain-path' : hcp_volume_cache.local_path(t1_brain_path)
+            , 'fsl-std'     : fsl_standard_path
+            , 'alt-t1-brain': alt_t1_brain
+        }
+
+        submit_command(cmd)
+
+    return cached_t1_2mm(t1_brain_path, fsl_standard_path, alt_t1_brain, 'flirt', run_flirt)
+
+
+def flirt_t1_to_mni_2mm_native(t1_brain_path, fsl_standard_path):
+    """
+    Same 2mm T1 as flirt_t1_to_mni_2mm (identity transform, trilinear), resampled in-process.
+
+    :return: path to t1-registered-to-2mm-mni-space output file.
+    """
+
+    alt_t1_brain = t1_brain_path.replace('_brain.nii.gz', '_brain.2.nii.gz')
+
+    return cached_t1_2mm(t1_brain_path, fsl_standard_path, alt_t1_brain, 'native',
+                         partial(hcp_volumes.resample_isotropic, t1_brain_path,
+                                 find_nifti(fsl_standard_path), alt_t1_brain, 2))
+
+
+def find_nifti(image_path):
+    """
+    :parameter image_path: FSL-style image name, with or without .nii / .nii.gz
+    :return: path to the existing file (image_path + '.nii.gz' if none exists)
+    """
+
+    for candidate in (image_path, image_path + '.nii.gz', image_path + '.nii'):
+        if path.isfile(candidate):
+            return candidate
 
-    return path.join(alt_t1_brain)
+    return image_path + '.nii.gz'
+
+
+def cached_t1_2mm(t1_brain_path, fsl_standard_path, alt_t1_brain, backend, resample):
+    """
+    Runs resample() unless this T1 (content hash) was already resampled onto this FSL_DIR template by the same backend,
+    in which case alt_t1_brain is copied from the .resample_cache folder next to the T1 (kept when the stage's outputs
+    are removed, e.g. by --force-stage).
+
+    :parameter backend: 'flirt' or 'native', part of the key
+    :parameter resample: callable writing alt_t1_brain
+    :return: alt_t1_brain
+    """
+
+    template_path = find_nifti(fsl_standard_path)
+
+    # ALWAYS HASHED, WHATEVER THE SIZE: hcp_stages.file_fingerprint LEAVES THE sha1 OUT OF BIG FILES, AND TWO BIG T1s
+    # WOULD THEN SHARE A KEY
+    key = json.dumps({
+        'input_sha1'        : hcp_fs.file_sha1(t1_brain_path)
+        , 'template'        : template_path
+        , 'template_sha1'   : hcp_fs.file_sha1(template_path) if path.isfile(template_path) else None
+        , 'voxel_mm'        : 2
+        , 'backend'         : backend
+    }, sort_keys=True)
+
+    cache_dir = path.join(path.dirname(t1_brain_path), '.resample_cache')
+
+    cached_path = path.join(cache_dir, '%s.%s.nii.gz' % (path.basename(t1_brain_path).split('.')[0],
+                                                         hashlib.sha1(key).hexdigest()[:16]))
+
+    if path.exists(cached_path):
+        print '\n%s already resampled onto %s, copying it from %s\n' % (path.basename(t1_brain_path),
+                                                                      path.basename(template_path), cache_dir)
+        hcp_fs.copy_file(cached_path, alt_t1_brain)
+        return alt_t1_brain
+
+    resample()
+
+    if not path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # WRITE UNDER ANOTHER NAME FIRST, A HALF-COPIED FILE MUST NEVER LOOK LIKE A CACHE HIT
+    hcp_fs.copy_file(alt_t1_brain, cached_path + '.tmp')
+    os.rename(cached_path + '.tmp', cached_path)
+
+    return alt_t1_brain
 
 
 # # BOOLEAN SWITCH FOR WHETHER OR NOT WE HAVE A T2?
@@ -510,7 +815,9 @@ def make_functional_registration_gifs(t1_2mm_path, subject_code, summary_dir, ep
     :return: None
     """
 
-    epi_result_path = path.join(epi_result_path)
+    # BOTH MONTAGES READ THE SAME UNCOMPRESSED COPIES
+    t1_2mm_path = hcp_volume_cache.local_path(t1_2mm_path)
+    epi_result_path = hcp_volume_cache.local_path(path.join(epi_result_path))
 
     t1_space_cmd = 'slices %(t1-2mm-path)s %(epi-path)s -s 2 -o ' \
                    '%(summary-dir)s/%(subject-code)s_%(rest-series-num)s_in_t1.gif' % {
@@ -537,6 +844,21 @@ def make_functional_registration_gifs(t1_2mm_path, subject_code, summary_dir, ep
     submit_command(functional_space_cmd)
 
 
+def make_functional_registration_gifs_native(t1_2mm_path, subject_code, summary_dir, epi_result_path,
+                                            rest_series_name):
+    """
+    Same .gifs as make_functional_registration_gifs, rendered in-process: the 2mm T1 is read once per subject, the first
+    volume of the epi once per series.
+
+    :return: list of paths to the .gifs
+    """
+
+    return [hcp_qc.render_slices(t1_2mm_path, epi_result_path,
+                                 path.join(summary_dir, '%s_%s_in_t1.gif' % (subject_code, rest_series_name)), 2),
+            hcp_qc.render_slices(epi_result_path, t1_2mm_path,
+                                 path.join(summary_dir, '%s_t1_in_%s.gif' % (subject_code, rest_series_name)), 2)]
+
+
 # # START BUNCH OF CALLS TO FSL USING LONG LIST OF PASSED, POSITIONAL ARGS
 def make_wm_mask(seg_brain_dir, seg_brain_file, project_config, subject):
     """
@@ -562,11 +884,11 @@ def make_wm_mask(seg_brain_dir, seg_brain_file, project_config, subject):
     wm_mask_eroded = "wm_2mm_%s_mask_eroded.nii.gz" % subject
 
     # USE THRESHOLDS FROM CONFIG TO CREATE MASKS, BEGINNING WITH LEFT-WM
-    left_wm_cmd = 'fslmaths %(seg-brain-dir)s/%(seg-brain)s -thr %(wm-lt-L)s -uthr ' \
+    left_wm_cmd = 'fslmaths %(seg-brain-path)s -thr %(wm-lt-L)s -uthr ' \
         '%(wm-ut-L)s %(seg-brain-dir)s/%(wm-mask-out)s' % {
 
-            'seg-brain-dir' : seg_brain_dir
-            , 'seg-brain'   : seg_brain_file
+            'seg-brain-dir'     : seg_brain_dir
+            , 'seg-brain-path'  : hcp_volume_cache.local_path(path.join(seg_brain_dir, seg_brain_file))
             , 'wm-lt-L'     : project_config['wm_lt_L']
             , 'wm-ut-L'     : project_config['wm_ut_L']
             , 'wm-mask-out' : wm_mask_L
@@ -575,11 +897,11 @@ def make_wm_mask(seg_brain_dir, seg_brain_file, project_config, subject):
     submit_command(left_wm_cmd)
 
     # MAKE RIGHT-WM
-    right_wm_cmd = 'fslmaths %(seg-brain-dir)s/%(seg-brain)s -thr %(wm-lt-R)s -uthr ' \
+    right_wm_cmd = 'fslmaths %(seg-brain-path)s -thr %(wm-lt-R)s -uthr ' \
         '%(wm-ut-R)s %(seg-brain-dir)s/%(wm-mask-out)s' % {
 
-            'seg-brain-dir' : seg_brain_dir
-            , 'seg-brain'   : seg_brain_file
+            'seg-brain-dir'     : seg_brain_dir
+            , 'seg-brain-path'  : hcp_volume_cache.local_path(path.join(seg_brain_dir, seg_brain_file))
             , 'wm-lt-R'     : project_config['wm_lt_R']
             , 'wm-ut-R'     : project_config['wm_ut_R']
             , 'wm-mask-out' : wm_mask_R
@@ -648,11 +970,11 @@ def make_vent_mask(seg_brain_dir, seg_brain_file, project_config, subject):
 
     vent_mask_eroded = "vent_2mm_%s_mask_eroded.nii.gz" % subject
 
-    left_vent_cmd = 'fslmaths %(seg-brain-dir)s/%(seg-brain)s -thr %(vent-lt-L)s -uthr ' \
+    left_vent_cmd = 'fslmaths %(seg-brain-path)s -thr %(vent-lt-L)s -uthr ' \
         '%(vent-ut-L)s %(seg-brain-dir)s/%(vent-mask-out)s' % {
 
-            'seg-brain-dir' : seg_brain_dir
-            , 'seg-brain'   : seg_brain_file
+            'seg-brain-dir'     : seg_brain_dir
+            , 'seg-brain-path'  : hcp_volume_cache.local_path(path.join(seg_brain_dir, seg_brain_file))
             , 'vent-lt-L'     : project_config['vent_lt_L']
             , 'vent-ut-L'     : project_config['vent_ut_L']
             , 'vent-mask-out' : vent_mask_L
@@ -660,11 +982,11 @@ def make_vent_mask(seg_brain_dir, seg_brain_file, project_config, subject):
 
     submit_command(left_vent_cmd)
 
-    right_vent_cmd = 'fslmaths %(seg-brain-dir)s/%(seg-brain)s -thr %(vent-lt-R)s -uthr ' \
+    right_vent_cmd = 'fslmaths %(seg-brain-path)s -thr %(vent-lt-R)s -uthr ' \
         '%(vent-ut-R)s %(seg-brain-dir)s/%(vent-mask-out)s' % {
 
             'seg-brain-dir'     : seg_brain_dir
-            , 'seg-brain'       : seg_brain_file
+            , 'seg-brain-path'  : hcp_volume_cache.local_path(path.join(seg_brain_dir, seg_brain_file))
             , 'vent-lt-R'       : project_config['vent_lt_R']
             , 'vent-ut-R'       : project_config['vent_ut_R']
             , 'vent-mask-out'   : vent_mask_R
@@ -704,6 +1026,24 @@ def make_vent_mask(seg_brain_dir, seg_brain_file, project_config, subject):
     return path.join(seg_brain_dir, vent_mask_eroded)
 
 
+def make_wm_vent_masks(seg_brain_dir, seg_brain_file, project_config, subject):
+    """
+    Native (NumPy) version of make_wm_mask + make_vent_mask: reads the segmented brain once and writes only the two
+    eroded masks, voxel-identical to the fslmaths outputs.
+
+    :parameter seg_brain_dir: working dir for this step
+    :parameter seg_brain_file: segmented brain to be used for thresholding into label components
+    :parameter project_config: set of project-specific paths and variables
+    :parameter subject: subject_ID -> passed on command-line
+    :returns: tuple (path to eroded_wm mask, path to vent_mask_eroded)
+    """
+
+    return hcp_volumes.make_wm_vent_masks(path.join(seg_brain_dir, seg_brain_file), project_config,
+                                          path.join(seg_brain_dir, "wm_2mm_%s_mask_eroded.nii.gz" % subject),
+                                          path.join(seg_brain_dir, "vent_2mm_%s_mask_eroded.nii.gz" % subject),
+                                          kernel_sigma=2)
+
+
 # ~~~~~~~~~~~~~~~~ EXPECTED OUTPUTS FROM MASKING SECTION ~~~~~~~~~~~~~~~~ #
 # Outputs (in $WD):
 #         NB: all these images are in standard space
@@ -758,7 +1098,8 @@ def calculate_wm_vent_means(epi_result_path, fmri_name, fnl_preproc_dir, eroded_
     :parameter eroded_wm_mask: path to eroded white matter mask
     :return: tuple (path to vent_mean, path to wm_mean)
     """
-    vent_input_file = path.join(epi_result_path, fmri_name + '.nii.gz')
+    # BOTH MEANS READ THE SAME UNCOMPRESSED COPY OF THE EPI
+    vent_input_file = hcp_volume_cache.local_path(path.join(epi_result_path, fmri_name + '.nii.gz'))
     vent_output_file = path.join(fnl_preproc_dir, fmri_name + '_vent_mean.txt')
 
     vent_mean_cmd = 'fslmeants -i %(vent-input-file)s -o %(vent-out-file)s -m %(eroded-vent-mask)s' % {
@@ -768,7 +1109,7 @@ def calculate_wm_vent_means(epi_result_path, fmri_name, fnl_preproc_dir, eroded_
     }
     submit_command(vent_mean_cmd)
 
-    wm_input_file = path.join(epi_result_path, fmri_name + '.nii.gz')
+    wm_input_file = vent_input_file
     wm_output_file = path.join(fnl_preproc_dir, fmri_name + '_wm_mean.txt')
 
     wm_mean_cmd = 'fslmeants -i %(wm-in-file)s -o %(wm-out-file)s -m %(eroded-wm-mask)s' % {
@@ -782,10 +1123,39 @@ def calculate_wm_vent_means(epi_result_path, fmri_name, fnl_preproc_dir, eroded_
     return vent_output_file, wm_output_file
 
 
+def calculate_wm_vent_means_native(epi_result_path, fmri_name, fnl_preproc_dir, eroded_vent_mask, eroded_wm_mask):
+    """
+    Native version of calculate_wm_vent_means: reads the 4D epi once, in chunks of frames, and writes both
+    _mean.txt files in fslmeants format.
+
+    :parameter epi_result_path: path to current epi within main for-loop
+    :parameter fmri_name: e.g. REST1
+    :parameter fnl_preproc_dir: path to MNINonLinear/Results/REST1/FNL_preproc
+    :parameter eroded_vent_mask: path to eroded ventricle mask
+    :parameter eroded_wm_mask: path to eroded white matter mask
+    :return: tuple (path to vent_mean, path to wm_mean)
+    """
+
+    epi_file = path.join(epi_result_path, fmri_name + '.nii.gz')
+
+    vent_output_file = path.join(fnl_preproc_dir, fmri_name + '_vent_mean.txt')
+    wm_output_file = path.join(fnl_preproc_dir, fmri_name + '_wm_mean.txt')
+
+    chunk_bytes = config_hcp_postprocess.native_settings['meants_chunk_mb'] * 1024 * 1024
+
+    means = hcp_volumes.masked_means(epi_file, [eroded_vent_mask, eroded_wm_mask], chunk_bytes)
+
+    hcp_volumes.write_meants(means[:, 0], vent_output_file)
+    hcp_volumes.write_meants(means[:, 1], wm_output_file)
+
+    return vent_output_file, wm_output_file
+
+
 def write_ml_config_and_run_octave(fnl_preproc_dir, env_config, project_config, rest_seriesname,
-                                   tr, summary_dir, cifti_out, epi_result_dir, fnl_preproc_cifti_name):
+                                   tr, summary_dir, cifti_out, epi_result_dir, fnl_preproc_cifti_name, octave_session):
     """
-    Takes several important variables from data, creates a script and runs it in a call to Octave. Per rsfMRI series.
+    Takes several important variables from data, creates a script and runs it in the subject's Octave session. Per
+    rsfMRI series.
 
     :parameter fnl_preproc_dir: path to MNINonLinear/Results/REST?/FNL_preproc
     :parameter env_config: binaries dict
@@ -796,6 +1166,7 @@ def write_ml_config_and_run_octave(fnl_preproc_dir, env_config, project_config,
     :parameter cifti_out: e.g. /path/to/REST1_Atlas.dtseries.nii
     :parameter epi_result_dir: path to MNINonLinear/Results/REST1
     :parameter fnl_preproc_cifti_name: REST1_FNL_preproc_Atlas.dtseries.nii
+    :parameter octave_session: hcp_octave.OctaveSession shared by all Octave calls of this subject
 
     :return: None
     """
@@ -888,74 +1259,107 @@ def write_ml_config_and_run_octave(fnl_preproc_dir, env_config, project_config,
         c.write(cmd)
         c.close()
 
-    oc = Oct2Py(executable=env_config['octave'], timeout=120)
-    oc.addpath(path.dirname(sys.argv[0]))
-    oc.addpath(path.join(path.dirname(sys.argv[0])), 'scripts')
+    # TIMEOUT SCALES WITH THE SIZE OF THE SERIES
+    timeout_config = config_hcp_postprocess.octave_timeouts['FNL_preproc_Matlab']
+
+    frames, grayordinates = get_series_size(cifti_out, movement_regressors_txt)
+
+    timeout = hcp_octave.scaled_timeout(timeout_config, frames, grayordinates)
 
     try:
 
-        oc.FNL_preproc_Matlab(json_config_path)
+        octave_session.call('FNL_preproc_Matlab', json_config_path, timeout=timeout)
 
     except Exception, e:
 
         motion_filename_out = path.join(fnl_preproc_dir, motion_filename)
 
-        if path.exists(motion_filename_out):
+        expected_outputs = [motion_filename_out, path.join(fnl_preproc_dir, path.basename(fnl_preproc_cifti_name))]
+
+        print "\nOctave did not return within %ss (%s)\nLet's watch for its outputs (up to %ss)..." % (
+            timeout, e, timeout_config['deadline'])
+
+        if hcp_octave.wait_for_outputs(expected_outputs, octave_session.process_alive, timeout_config['deadline']):
             print '\nOctave Timed out, HOWEVER we seem to have the necessary outputs \n%s' % motion_filename_out
         else:
-            print "\nLet's try waiting another minute, then I'l exit..."
-            time.sleep(60)
-            oc.exit()
+            raise RuntimeError('FNL_preproc_Matlab did not produce: %s' % ', '.join(
+                expected for expected in expected_outputs if not path.exists(expected)))
+
+
+def count_regressor_frames(movement_regressors_path):
+    """
+    Counts frames (non-empty lines) in a Movement_Regressors.txt
+
+    :parameter movement_regressors_path: path to MNINonLinear/Results/REST?/Movement_Regressors.txt
+    :return: number of frames (int), 0 if the file is missing
+    """
+
+    if not path.exists(movement_regressors_path):
+        return 0
+
+    with open(movement_regressors_path, 'r') as f:
+        return len([line for line in f if line.strip()])
 
 
 def pull_tr_from_raw_resting_state(nifti_path):
     """
-    Uses flshd to pull a TR string from a given nifti path. Intended for epi-data here, but will handle any nii.
+    Pulls the TR (pixdim4) from a given nifti path's header (cached, no fslhd). Intended for epi-data here, but will
+    handle any nii.
 
     :parameter nifti_path: path to NIFTI or .nii.gz file
-    :return tr: repetition time (string) in whichever units that are stored in that file (originates in PATH_GUI
+    :return tr: repetition time (float) in whichever units that are stored in that file (originates in PATH_GUI
+    """
+
+    # same 6 decimals fslhd prints, so a float32 0.8 stays 0.8
+    return float('%f' % hcp_nifti.get_tr(path.abspath(nifti_path)))
+
+
+def get_series_size(cifti_or_nifti_path, movement_regressors_path=None):
     """
-    cmd = """fslhd %s | grep pixdim4 | gawk '{ print $2 }' """ % path.join(path.abspath(nifti_path))
+    Frames & grayordinates (or voxels) of a series from its cached header, used to scale Octave timeouts.
 
-    tr = submit_command(cmd)
+    :parameter cifti_or_nifti_path: e.g. REST1_Atlas.dtseries.nii
+    :parameter movement_regressors_path: fallback for the frame count if the header cannot be read
+    :return: tuple (frames, grayordinates)
+    """
 
-    return float(tr)
+    try:
+        return hcp_nifti.get_frames_and_elements(cifti_or_nifti_path)
+    except (IOError, OSError, ValueError), e:
+        print '\nCould not read header of %s (%s), counting frames from regressors instead' % (cifti_or_nifti_path, e)
+        return count_regressor_frames(movement_regressors_path or ''), hcp_octave.STANDARD_GRAYORDINATES
 
 
-def merge_ciftis(env_config, mni_results_dir, fnl_preproc_dir, rest_num, subj_ID, rest_prefix):
+def merge_ciftis(env_config, mni_results_dir, subj_ID, series_ciftis):
     """
-    Should run once per REST to either create or merge a cifti, depending upon its series-num (merge if > 1)
+    Concatenates the FNL_preproc ciftis of all series in one pass (a single wb_command -cifti-merge with one -cifti per
+    series), so each series' frames are read & written exactly once instead of re-merging into a growing file.
 
     :param env_config: dict of binaries specific to the processing environment in which the code was called
     :param mni_results_dir: path to the output_folder(supplied by user)/MNINonLinear/Results
-    :param fnl_preproc_dir: path to a given directory with pattern = MNINonLinear/Result/REST<series_num>/FNL_preproc
-    :param rest_num: number (string) indicating which series of resting-state data we are working on
     :param subj_ID: subject code (also supplied by user)
-    :param rest_prefix: e.g.  REST1
+    :param series_ciftis: paths to each series' <REST?>_FNL_preproc_Atlas.dtseries.nii, in the order to concatenate
     :return: path to merged cifti file
     """
 
     merged_cifti = path.join(mni_results_dir, subj_ID + '_FNL_preproc_Atlas.dtseries.nii')
-    # IF THE FIRST series, make a copy & remove source
-    if int(rest_num) == 1:
-
-        print '\nCopying first resting cifti to start the merging...Check for output: \n%s\n' % merged_cifti
 
-        src = path.join(fnl_preproc_dir, 'REST1_FNL_preproc_Atlas.dtseries.nii')
+    # IF ONLY ONE series, nothing to merge: just copy it
+    if len(series_ciftis) == 1:
 
-        cp_cmd = 'cp %s %s' % (src, merged_cifti)
+        print '\nCopying only resting cifti...Check for output: \n%s\n' % merged_cifti
 
-        submit_command(cp_cmd)
+        # read-only from here on, so a reflink / hard link will do
+        hcp_fs.copy_file(series_ciftis[0], merged_cifti, allow_link=True)
 
-    elif int(rest_num) > 1:  # WB_COMMAND CIFTI MERGE if REST num > 1
+    else:
 
-        merge_cmd = "%(wb-command)s -cifti-merge %(merged-cifti)s -cifti %(merged-cifti)s " \
-                    "-cifti %(fnl-preproc-cifti-name)s" % {
+        merge_cmd = "%(wb-command)s -cifti-merge %(merged-cifti)s %(cifti-args)s" % {
 
-                        'wb-command'                : env_config['wb_command']
-                        , 'merged-cifti'            : merged_cifti
-                        , 'fnl-preproc-cifti-name'  : path.join(fnl_preproc_dir, rest_prefix + '_FNL_preproc_Atlas.dtseries.nii')
-                    }
+            'wb-command'        : env_config['wb_command']
+            , 'merged-cifti'    : merged_cifti
+            , 'cifti-args'      : ' '.join('-cifti %s' % series_cifti for series_cifti in series_ciftis)
+        }
 
         submit_command(merge_cmd)
 
@@ -991,9 +1395,8 @@ def make_sym_links(links_dict):
     :return: None
     """
 
-    for k, v in links_dict.items():
-        cmd = 'ln -s %s %s' % (k, v)
-        submit_command(cmd)
+    # links already pointing at the right target are left alone, others replaced
+    hcp_fs.make_links(links_dict)
 
 
 # GET THIS path_to_label_files FROM INITIAL CONFIG IMPORT
@@ -1117,6 +1520,122 @@ def make_subcortical_only_parcellations(env_config, mni_nonlinear_results_path,
             continue
 
 
+def get_parcellation_outputs(env_config, mni_nonlinear_results_path, subj_code):
+    """
+    Lists the atlases found in path_to_label_files and the .ptseries.nii files each one produces (the same names
+    make_subcort_and_surface_parcellations & make_subcortical_only_parcellations write).
+
+    :parameter env_config: dict of binaries specific to the processing environment
+    :parameter mni_nonlinear_results_path: path to MNINonLinear/Results
+    :parameter subj_code: subjID
+    :return: list of tuples (path to .dlabel.nii, [path to <parcel>_subcortical.ptseries.nii, <parcel>.ptseries.nii])
+    """
+
+    path_to_label_files = env_config['path_to_label_files']
+
+    if not path.exists(path_to_label_files):
+
+        return []
+
+    parcellation_outputs = []
+
+    for parcel in sorted(os.listdir(path_to_label_files)):
+
+        label_path = path.join(path_to_label_files, parcel, 'fsLR', parcel + '.subcortical.32k_fs_LR.dlabel.nii')
+
+        if path.exists(label_path):
+
+            parcellation_outputs.append((label_path, [
+                path.join(mni_nonlinear_results_path, subj_code + '_FNL_preproc_' + parcel + '_subcortical.ptseries.nii')
+                , path.join(mni_nonlinear_results_path, subj_code + '_FNL_preproc_' + parcel + '.ptseries.nii')
+            ]))
+
+    return parcellation_outputs
+
+
+def get_atlas_cache_dir(env_config):
+    """
+    Where parcel membership of the atlases is kept between runs: native_settings['atlas_cache_dir'] if set, else next
+    to the label files (shared by every subject), else in the user's home if the label files are read-only.
+
+    :parameter env_config: dict of binaries specific to the processing environment
+    :return: path to directory
+    """
+
+    cache_dir = config_hcp_postprocess.native_settings.get('atlas_cache_dir')
+
+    if cache_dir:
+        return cache_dir
+
+    if os.access(env_config['path_to_label_files'], os.W_OK):
+        return path.join(env_config['path_to_label_files'], '.atlas_index')
+
+    return path.join(path.expanduser('~'), '.cache', 'hcp_postprocess', 'atlas_index')
+
+
+def make_parcellations_native(env_config, mni_nonlinear_results_path, subj_code, merged_cifti_path, spec_file):
+    """
+    Native replacement for make_subcort_and_surface_parcellations + make_subcortical_only_parcellations: reads the
+    merged dtseries once and parcellates it with every atlas at the same time (see hcp_cifti), then adds the
+    .ptseries.nii files to the .spec.
+
+    :parameter env_config: dict of binaries specific to the processing environment
+    :parameter mni_nonlinear_results_path: path to MNINonLinear/Results
+    :parameter subj_code: subjID
+    :parameter merged_cifti_path: path to <subj>_FNL_preproc_Atlas.dtseries.nii
+    :parameter spec_file: path to .spec file
+    :return: list of paths to .ptseries.nii outputs
+    """
+
+    if not path.exists(env_config['path_to_label_files']):
+
+        print '\nCould not locate the path_to_label_files needed from env_config\n'
+
+        sys.exit(1)
+
+    parcellation_outputs = get_parcellation_outputs(env_config, mni_nonlinear_results_path, subj_code)
+
+    print '\nCreating parcellations using: \n%s' % '\n'.join(label_path for label_path, ptseries_list in
+                                                              parcellation_outputs)
+
+    chunk_bytes = config_hcp_postprocess.native_settings['parcellate_chunk_mb'] * 1024 * 1024
+
+    atlas_index = hcp_cifti.AtlasIndex(get_atlas_cache_dir(env_config))
+
+    parcellations = hcp_cifti.parcellate(merged_cifti_path, [label_path for label_path, ptseries_list in
+                                                             parcellation_outputs], chunk_bytes, atlas_index)
+
+    print '\nParcel membership: %s atlas(es) from cache %s, %s indexed now' % (atlas_index.hits,
+                                                                             atlas_index.cache_dir, atlas_index.builds)
+
+    all_ptseries = []
+
+    for (label_path, ptseries_list), (parcel_series, series_axis, parcel_axis) in zip(parcellation_outputs,
+                                                                                      parcellations):
+        # both names come from the same label file, as with wb_command
+        hcp_cifti.save_ptseries(parcel_series, series_axis, parcel_axis, ptseries_list[0])
+
+        for ptseries in ptseries_list[1:]:
+            hcp_fs.copy_file(ptseries_list[0], ptseries, allow_link=True)
+
+        all_ptseries.extend(ptseries_list)
+
+    print '\nAdding new parcellations to .spec...'
+
+    for ptseries in all_ptseries:
+
+        add_to_spec_cmd = '%(wb-command)s -add-to-spec-file %(spec-file)s INVALID %(file-out)s' % {
+
+                            'wb-command'            : env_config['wb_command']
+                            , 'spec-file'           : spec_file
+                            , 'file-out'            : ptseries
+                            }
+
+        submit_command(add_to_spec_cmd)
+
+    return all_ptseries
+
+
 # START PREP
 def concat_FD_text_files(summary_dir):
 
@@ -1151,7 +1670,8 @@ def cifti_to_txt(mni_results_dir):
 
 # # CALL OUT TO OCTAVE
 # ${octave} --traditional --quiet --path `dirname $0` --eval  "analyses_v2('${v2_config_path}')"
-def write_analyses_config_and_run_octave(env_config, project_config, output_folder, tr, summary_dir, mni_results_path):
+def write_analyses_config_and_run_octave(env_config, project_config, output_folder, tr, summary_dir, mni_results_path,
+                                         octave_session):
 
     json_file_path = path.join(output_folder, 'analyses_v2', 'matlab_code', 'analyses_v2_mat_config.json')
 
@@ -1193,32 +1713,34 @@ def write_analyses_config_and_run_octave(env_config, project_config, output_fold
 
     print '\nTime Update: %s' % datetime.now()
 
-    # TODO: try working inside a temp_dir -> try to avoid conversion to float?
-    oc = Oct2Py(executable=env_config['octave'], timeout=800, temp_dir=path.join(output_folder, 'analyses_v2',
-                                                                                 'matlab_code'), convert_to_float=False)
-    oc.addpath(path.dirname(sys.argv[0]))
-    oc.addpath(path.join(path.dirname(sys.argv[0])), 'scripts')
+    # TIMEOUT SCALES WITH THE NUMBER OF FRAMES ACROSS ALL SERIES
+    timeout_config = config_hcp_postprocess.octave_timeouts['analyses_v2']
 
-    # TODO: see if adding this path helps things along...
-    oc.addpath(env_config['HCP_Mat_Path'])
+    series_sizes = [get_series_size(path.join(path.dirname(regressors_path),
+                                              path.basename(path.dirname(regressors_path)) + '_Atlas.dtseries.nii'),
+                                    regressors_path)
+                    for regressors_path in glob(path.join(mni_results_path, 'REST*', 'Movement_Regressors.txt'))]
 
-    # TRY TO RUN .m FILE -> analyses_v2.m
+    timeout = hcp_octave.scaled_timeout(timeout_config, sum(frames for frames, grayordinates in series_sizes),
+                                        max([grayordinates for frames, grayordinates in series_sizes] or
+                                            [hcp_octave.STANDARD_GRAYORDINATES]))
+
+    # TRY TO RUN .m FILE -> analyses_v2.m (session already has this program's dir, scripts & HCP_Mat_Path on its path)
     try:
-        oc.analyses_v2(json_file_path)
+        octave_session.call('analyses_v2', json_file_path, timeout=timeout)
 
     except Exception, e:
 
         final_output = path.join(summary_dir, 'FD_dist.png')
 
-        if path.exists(final_output):
+        print "\nOctave did not return within %ss (%s)\nLet's watch for the final output (up to %ss)..." % (
+            timeout, e, timeout_config['deadline'])
+
+        if hcp_octave.wait_for_outputs([final_output], octave_session.process_alive, timeout_config['deadline']):
             print 'We have the final output from this octave section!\n%s' % final_output
         else:
-            print "\nLet's try waiting another few minutes, then exit octave... \n%s" % e
-            time.sleep(600)
-            oc.exit()
-            if not path.exists(final_output):
 
-                print '\nBe sure to check your outputs, we may have missed something...\n'
+            print '\nBe sure to check your outputs, we may have missed something...\n'
 
 
 def copy_motion_frames_matfile(src, dst):
@@ -1230,14 +1752,15 @@ def copy_motion_frames_matfile(src, dst):
     :return: None
     """
 
-    copy_command = 'cp %s/*.mat %s' % (src, dst)
+    mat_files = sorted(glob(path.join(src, '*.mat')))
 
-    submit_command(copy_command)
+    hcp_fs.copy_files(mat_files, dst)
 
 
 def write_frames_per_scan(mni_results_dir, summary_dir):
     """
-    Makes a list of all MNI/Results/REST?/Movement_Regressors.txt files and reports line-counts to another .txt
+    Makes a list of all MNI/Results/REST?/Movement_Regressors.txt files and reports each series' frame-count (from
+    the cached header of REST?.nii.gz, else the regressor line-count) to another .txt
 
     :param mni_results_dir: absolute path to MNINonLinear/Results
     :return: path to final output (frames_per_scan.txt)
@@ -1245,20 +1768,21 @@ def write_frames_per_scan(mni_results_dir, summary_dir):
 
     regressor_pattern = path.join(mni_results_dir, 'REST*/Movement_Regressors.txt')
 
-    # regressor_paths_list = glob(regressor_pattern)
+    regressor_paths_list = sorted(glob(regressor_pattern))
 
     frames_per_scan_out = path.join(summary_dir, 'frames_per_scan.txt')
 
-    # If it's already there (re-run), remove it
-    if path.exists(frames_per_scan_out):
+    with open(frames_per_scan_out, 'w') as f:
 
-        os.remove(frames_per_scan_out)
+        for regressors_path in regressor_paths_list:
 
-    cmd = 'for mov_reg in `ls %s` ; do frames=`wc -l < ${mov_reg}`; echo ${frames} >> %s; done' % (
-        regressor_pattern
-        , frames_per_scan_out
-    )
-    submit_command(cmd)
+            series_dir = path.dirname(regressors_path)
+
+            epi_path = path.join(series_dir, path.basename(series_dir) + '.nii.gz')
+
+            frames = get_series_size(epi_path, regressors_path)[0]
+
+            f.write('%s\n' % frames)
 
     return frames_per_scan_out
 
@@ -1267,43 +1791,881 @@ def wait_another_min():
     time.sleep(60)
 
 
-def main():
+# ~~~~~~~~~~~~~~~~ STAGE HELPERS (steps of process_subject that group several calls) ~~~~~~~~~~~~~~~~ #
+def select_scene_images(image_names, subject_has_t2_data, image_patterns=None):
+    """
+    Picks which scenes to render: T2-* images only when the subject has a T2 (T1-* images are always made), and
+    only the images matching image_patterns when given (e.g. QC re-runs of a few images).
 
-    # HANDLE ARGS
-    parser = get_parser()
+    :parameter image_names: list of image names from config, in scene order
+    :parameter subject_has_t2_data: Boolean
+    :parameter image_patterns: optional list of image names / shell-style patterns, e.g. ['T1-Axial-*']
+    :return: list of tuples (scene number (from 1), image name)
+    """
 
-    args = parser.parse_args()
+    scenes = []
 
-    # PULL INITIAL INFO FROM ARGS
+    for num, image_name in enumerate(image_names):
 
-    prog_path = path.dirname(sys.argv[0])
-    subject = args.subject_code
-    output_folder = path.abspath(args.output_path)
+        if image_name.startswith('T2') and not subject_has_t2_data:
+            continue
 
-    environment = get_environment(output_folder)
+        if image_patterns and not [pattern for pattern in image_patterns if fnmatch(image_name, pattern)]:
+            continue
 
-    # SETUP ENVIRONMENT AND PROJECT VARIABLES
+        scenes.append((num + 1, image_name))  # scene numbers count from 1
 
-    project_name, visitID, pipeline = infer_project_details_from_path(output_folder, subject)
+    return scenes
 
-    if args.project_config:
-        project_name = args.project_config
 
-    environ_binaries, project_settings, image_names, mask_labels = get_configs(environment, project_name)
-    raw_data_dir = path.abspath(path.join(output_folder, 'unprocessed', 'NIFTI'))
+def render_scene_images(output_folder, scenes, env_binaries, t2_path, t1_path, rp_path, lp_path, rwm_path,
+                        lwm_path, workers=1):
+    """
+    Builds the temp .scene file from template, renders each scene to summary/<image_name>.png, then removes the scene.
+    Scenes are rendered side-by-side by up to <workers> wb_command processes, each from its own copy of the scene.
 
-    # BEGIN PROCESSING ...
-    print '\nStarting Summary and Prep Sections...\n'
+    :parameter output_folder: user input
+    :parameter scenes: list of tuples (scene number, image name), from select_scene_images
+    :parameter env_binaries: from config
+    :parameter workers: max number of scenes rendered at once
+    :return: None
+    """
 
-    # check_complete_inputs(t1, regressors_path, t1_brain)
+    if not scenes:
+        print '\nNo scene images to make...\n'
+        return
 
-    # COUNT HOW MANY THINGS HAVE 'REST' in their file/directory strings
-    # we presume that's how many REST there are to process
-    try:
-        num_epi, raw_epi_list = count_epi_series(raw_data_dir)
-    except OSError:
-        print 'Missing raw EPI-data! Please check your -o setting to make sure this exists?\n%s' % raw_data_dir
-        exit(1)
+    print 'Creating scene from template...'
+    temp_scene = build_scene_from_template(t2_path, t1_path, rp_path, lp_path, rwm_path, lwm_path, output_folder)
+
+    print '\nMaking %s .png images from .scene...\n' % len(scenes)
+
+    worker_scenes = []
+    worker_state = threading.local()
+    copy_lock = threading.Lock()
+
+    def render(scene):
+
+        # wb_command may touch the scene it reads, so every worker thread renders from its own copy
+        if not hasattr(worker_state, 'scene_copy'):
+            with copy_lock:
+                worker_state.scene_copy = '%s.%s' % (temp_scene, len(worker_scenes))
+                worker_scenes.append(worker_state.scene_copy)
+            hcp_fs.copy_file(temp_scene, worker_state.scene_copy)
+
+        scene_num, image_name = scene
+
+        create_image_from_template(output_folder, scene_num, image_name, env_binaries, worker_state.scene_copy)
+
+    pool = ThreadPool(max(1, min(int(workers), len(scenes))))
+
+    try:
+        pool.map(render, scenes, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+        # REMOVE TEMP.SCENE FILES USED ABOVE
+        for scene_file in [temp_scene] + worker_scenes:
+            if path.exists(scene_file):
+                os.remove(scene_file)
+
+
+def require_valid_regressors(epi_path, epi_result_dir, env_binaries):
+    """
+    Runs check_regressors_valid and exits if the Movement_Regressors.txt of this series is invalid.
+
+    :parameter epi_path: raw epi-file
+    :parameter epi_result_dir: path to MNINonLinear/Results/REST?
+    :parameter env_binaries: from config
+    :return: None
+    """
+
+    regressors_path = path.join(epi_result_dir, 'Movement_Regressors.txt')
+
+    if not check_regressors_valid(epi_path, epi_result_dir, env_binaries):
+        print 'UGH, that <expletive deleted> check is telling me that you have a ' \
+              'Missing or otherwise "invalid" regressor file. \n%s\nPlease confirm, Exiting for now...' % regressors_path
+        sys.exit(1)
+    else:
+        print 'Regressor file valid for %s!' % epi_path
+
+
+def run_fnl_preproc_series(fnl_preproc_dir, env_config, project_config, rest_seriesname, tr, summary_dir,
+                           epi_result_dir, octave_session):
+    """
+    Copies the series' _Atlas.dtseries.nii into FNL_preproc and runs the first Octave section (FNL_preproc_Matlab.m).
+
+    :parameter fnl_preproc_dir: path to MNINonLinear/Results/REST?/FNL_preproc
+    :parameter env_config: binaries dict
+    :parameter project_config: dictionary of project-specific params
+    :parameter rest_seriesname: e.g. REST1
+    :parameter tr: repetition time of the epi file
+    :parameter summary_dir: path to /summary
+    :parameter epi_result_dir: path to MNINonLinear/Results/REST1
+    :parameter octave_session: hcp_octave.OctaveSession of this subject
+    :return: None
+    """
+
+    # BEGIN CIFTI CREATION SECTION
+    dt_series_suffix = '_Atlas.dtseries.nii'
+
+    # COPY _Atlas.dtseries.nii to /FNL_preproc sub-dir
+    print '\nCopying dtseries files to prep for Octave section...\n'
+    fnl_preproc_cifti = path.join(fnl_preproc_dir, rest_seriesname + '_FNL_preproc' + dt_series_suffix)
+
+    # We also need the REST_Atlas.dtseries.nii file from path above FNL_preproc directory
+    cifti_out = path.join(epi_result_dir, rest_seriesname + dt_series_suffix)
+    cifti_out_dest = path.join(fnl_preproc_dir, rest_seriesname + dt_series_suffix)
+
+    print 'CIFTI OUT IS: \n\t%s \nCOPYING TO: \n\t%s\n' % (cifti_out, cifti_out_dest)
+
+    # OCTAVE ONLY READS IT: reflink / hard link instead of a copy when on the same file system
+    print 'Copied by %s\n' % hcp_fs.copy_file(cifti_out, cifti_out_dest, allow_link=True)
+
+    fnl_preproc_cifti_name = path.basename(fnl_preproc_cifti)
+
+    # BEGIN FIRST OCTAVE SECTION -> WRITE CONFIG.json for FNL_preproc_Matlab.m
+    print '\nRunning FNL_preproc Octave Section for %s...\n' % rest_seriesname
+
+    print '\nRemoving existing, and creating config.json\n'
+
+    try:
+        write_ml_config_and_run_octave(fnl_preproc_dir, env_config, project_config, rest_seriesname,
+                                       tr, summary_dir, cifti_out, epi_result_dir, fnl_preproc_cifti_name,
+                                       octave_session)
+
+    except Exception, e:
+        print 'something went wrong during OCTAVE, UGH>..\n\t%s' % e
+        sys.exit()
+
+    print 'Done with first Octave section for %s...' % rest_seriesname
+
+
+def run_fnl_preproc_series_native(fnl_preproc_dir, project_config, rest_seriesname, tr, summary_dir, epi_result_dir,
+                                  workers=1):
+    """
+    Native version of FNL_preproc_Matlab: WM, ventricle & movement signals (plus intercept) are regressed out of the
+    series' _Atlas.dtseries.nii, betas estimated on frames with FD <= fd_th after the first skip_seconds, and the
+    residuals are band-pass filtered (bp_order, lp_Hz - hp_Hz), block by block in one pass.
+    Writes the FNL_preproc dtseries and summary/FD_REST?.txt (one FD per frame); analyses_v2 then runs as usual.
+    <motion_filename> is not written, FNL_preproc_Matlab's format for it is not reproduced here.
+
+    :parameter fnl_preproc_dir: path to MNINonLinear/Results/REST?/FNL_preproc
+    :parameter project_config: dictionary of project-specific params
+    :parameter rest_seriesname: e.g. REST1
+    :parameter tr: repetition time of the epi file
+    :parameter summary_dir: path to /summary
+    :parameter epi_result_dir: path to MNINonLinear/Results/REST1
+    :parameter workers: number of blocks of grayordinates processed at once (threads)
+    :return: path to the FNL_preproc dtseries
+    """
+
+    cifti_in = path.join(epi_result_dir, rest_seriesname + '_Atlas.dtseries.nii')
+    fnl_preproc_cifti = path.join(fnl_preproc_dir, rest_seriesname + '_FNL_preproc_Atlas.dtseries.nii')
+
+    movement, problem = load_regressors(path.join(epi_result_dir, 'Movement_Regressors.txt'))
+
+    if problem:
+        raise ValueError('Movement_Regressors.txt of %s is %s' % (rest_seriesname, problem))
+
+    wm_mean = np.loadtxt(path.join(fnl_preproc_dir, rest_seriesname + '_wm_mean.txt'), ndmin=1)
+    vent_mean = np.loadtxt(path.join(fnl_preproc_dir, rest_seriesname + '_vent_mean.txt'), ndmin=1)
+
+    fd = hcp_motion.framewise_displacement(movement, project_config['brain_radius_in_mm'])
+
+    skip_frames = int(project_config['skip_seconds'] / tr)
+
+    frames = hcp_regression.regression_frames(fd, project_config['fd_th'], skip_frames)
+
+    design = hcp_regression.design_matrix(wm_mean, vent_mean, movement,
+                                          config_hcp_postprocess.native_settings['regress_linear_trend'])
+
+    model = hcp_regression.NuisanceModel(design, frames)
+
+    print '\nRegressing & band-passing %s: betas from %s of %s frames (FD <= %s, first %s skipped)%s...\n' % (
+        rest_seriesname, frames.sum(), len(frames), project_config['fd_th'], skip_frames,
+        ', rank deficient design' if model.rank_deficient else '')
+
+    # cut-offs in either order: lp_Hz is the lower one in the project configs
+    band_pass = hcp_filter.butterworth_bandpass(tr, project_config['bp_order'],
+                                                min(project_config['lp_Hz'], project_config['hp_Hz']),
+                                                max(project_config['lp_Hz'], project_config['hp_Hz']))
+
+    hcp_regression.check_frames(cifti_in, model)
+
+    chunk_bytes = config_hcp_postprocess.native_settings['regress_chunk_mb'] * 1024 * 1024
+
+    hcp_cifti.map_dense_series(cifti_in, fnl_preproc_cifti,
+                               lambda block: hcp_filter.filtfilt(model.residuals(block), band_pass),
+                               chunk_bytes, workers)
+
+    with open(path.join(summary_dir, 'FD_%s.txt' % rest_seriesname), 'w') as f:
+        f.write(''.join('%f\n' % value for value in fd))
+
+    return fnl_preproc_cifti
+
+
+def merge_series_ciftis(env_config, mni_results_dir, subj_ID, rest_series):
+    """
+    Merges the FNL_preproc ciftis of every series into one, in REST-number order.
+
+    :param env_config: dict of binaries specific to the processing environment
+    :param mni_results_dir: path to the output_folder(supplied by user)/MNINonLinear/Results
+    :param subj_ID: subject code (also supplied by user)
+    :param rest_series: list of tuples (REST<num>, <num>, path to FNL_preproc dir)
+    :return: path to merged cifti file
+    """
+
+    series_ciftis = [path.join(fnl_preproc_dir, rest_prefix + '_FNL_preproc_Atlas.dtseries.nii')
+                     for rest_prefix, rest_num, fnl_preproc_dir in sorted(rest_series, key=lambda series: int(series[1]))]
+
+    print '\nMerging %s ciftis...\n' % len(series_ciftis)
+
+    return merge_ciftis(env_config, mni_results_dir, subj_ID, series_ciftis)
+
+
+def make_analysis_links(output_folder, subject, visitID, pipeline, merged_cifti, spec_file, summary_dir,
+                        final_output_folder=None):
+    """
+    (Re-)creates the study-level analyses_v2/<pipe>/<subjID>+<visit> folder and sym-links this subject's outputs there.
+
+    :param output_folder: user input
+    :param subject: user input
+    :param visitID: inferred from output_folder
+    :param pipeline: inferred from output_folder
+    :param merged_cifti: path to merged dtseries
+    :param spec_file: path to the subject's .spec
+    :param summary_dir: path to /summary
+    :param final_output_folder: where output_folder gets synced back to (--scratch), the study-level links point there
+    :return: path to analysis folder
+    """
+
+    workbench_ciftis_folder = path.join(output_folder, 'analyses_v2', 'workbench')
+
+    final_output_folder = final_output_folder or output_folder
+
+    def final_path(file_path):
+        return path.join(final_output_folder, path.relpath(path.abspath(file_path), path.abspath(output_folder)))
+
+    # TODO: clean this up
+    output_folder_parts = final_output_folder.split('/')[1:6]  # could be wrong -> [1:7] ?
+
+    # TODO: find a better HACK!
+    if 'win' not in sys.platform:
+        starting_slash = '/'
+    else:
+        starting_slash = '\\'
+
+    # GONNA ENFORCE THIS PATTERN FOR THIS SYM-LINKED STRUCTURE (for now)
+    # /<share_name>/<study_root_dir>/analyses_v2/<pipe>/<subjID>+<visit>  # slightly different than old FNL_preproc
+    analysis_folder = path.join(starting_slash + output_folder_parts[0]
+                                , output_folder_parts[1]  # a share_name usually starts with a slash and has 2 paths
+                                , output_folder_parts[2]
+                                , output_folder_parts[3]
+                                , output_folder_parts[4] # if len(output_folder_parts) is 5, this works... else adjust!
+                                , 'analyses_v2'
+                                , pipeline
+                                , subject + '+' + visitID)
+
+    if path.exists(analysis_folder):
+        print '\nRemoving existing analysis output folder from previous run...\n%s' % analysis_folder
+        hcp_fs.remove_path(analysis_folder)
+
+    if not path.exists(analysis_folder):
+        os.makedirs(analysis_folder)
+
+    links_to_make = {
+
+        path.abspath(merged_cifti)                              : workbench_ciftis_folder
+        , path.abspath(spec_file)                               : workbench_ciftis_folder
+    }
+
+    # STUDY-LEVEL LINKS TO WHERE THE OUTPUTS END UP
+    analysis_links = {
+
+        final_path(summary_dir)                                         : analysis_folder
+        , path.join(final_output_folder, 'analyses_v2', 'FCmaps')       : analysis_folder
+        , path.join(final_output_folder, 'analyses_v2', 'motion')       : analysis_folder
+        , path.join(final_output_folder, 'analyses_v2', 'timecourses')  : analysis_folder
+        , path.join(final_output_folder, 'analyses_v2', 'matlab_code')  : analysis_folder
+        , path.join(final_output_folder, 'analyses_v2', 'workbench')    : analysis_folder
+
+    }
+
+    links_to_make.update(analysis_links)
+
+    # MAKE SYM-LINKS
+
+    print '\nCreating sym links...'
+    make_sym_links(links_to_make)
+
+    return analysis_folder
+
+
+def run_analyses_stage(env_config, project_config, output_folder, tr, summary_dir, mni_results_path, octave_session):
+    """
+    Runs the second Octave section (analyses_v2.m), exiting if Octave itself blows up.
+
+    :return: None
+    """
+
+    print '\nRunning second octave stage (analyses_v2.m takes several minutes)...\n'
+
+    try:
+        write_analyses_config_and_run_octave(env_config, project_config, output_folder, tr, summary_dir,
+                                             mni_results_path, octave_session)
+    except Exception, e:
+
+        print 'Problem with analyses_v2.m to investigate... try running octave in a terminal to diagnose?\n%s' % e
+        sys.exit()
+
+
+def write_fd_sweep(project_config, tr, summary_dir, rest_series):
+    """
+    FD-sweep report, next to analyses_v2: FD of all runs at once, DVARS of every FNL_preproc dtseries, censoring masks
+    for the whole sweep of FD thresholds, written to summary/FD_threshold_sweep.txt. Nothing analyses_v2.m writes is
+    written or replaced here.
+
+    :parameter project_config: dictionary of project-specific params
+    :parameter tr: repetition time of the epi files
+    :parameter summary_dir: path to /summary
+    :parameter rest_series: list of tuples (REST<num>, <num>, path to FNL_preproc dir)
+    :return: list of FD thresholds
+    """
+
+    series_list = sorted(rest_series, key=lambda series: int(series[1]))
+
+    movements = []
+
+    for rest_seriesname, rest_num, fnl_preproc_dir in series_list:
+
+        movement, problem = load_regressors(path.join(path.dirname(fnl_preproc_dir), 'Movement_Regressors.txt'))
+
+        if problem:
+            raise ValueError('Movement_Regressors.txt of %s is %s' % (rest_seriesname, problem))
+
+        movements.append(movement[:, :6])
+
+    run_lengths = [len(movement) for movement in movements]
+
+    fd = hcp_motion.framewise_displacement(np.vstack(movements), project_config['brain_radius_in_mm'], run_lengths)
+
+    chunk_bytes = config_hcp_postprocess.native_settings['regress_chunk_mb'] * 1024 * 1024
+
+    dvars = np.concatenate([
+        hcp_motion.dvars(path.join(fnl_preproc_dir, rest_seriesname + '_FNL_preproc_Atlas.dtseries.nii'), chunk_bytes)
+        for rest_seriesname, rest_num, fnl_preproc_dir in series_list])
+
+    if len(dvars) != len(fd):
+        raise ValueError('FNL_preproc dtseries have %s frames, Movement_Regressors.txt %s' % (len(dvars), len(fd)))
+
+    thresholds = sorted(set(config_hcp_postprocess.native_settings['fd_thresholds'] + [project_config['fd_th']]))
+
+    skip_frames = int(project_config['skip_seconds'] / tr)
+
+    min_contiguous = project_config['expected_contiguous_frame_count']
+
+    masks = hcp_motion.censoring_masks(fd, thresholds, run_lengths, skip_frames, min_contiguous)
+
+    numbers = hcp_motion.motion_numbers(fd, dvars, masks, thresholds, run_lengths, tr)
+
+    hcp_motion.write_threshold_sweep(path.join(summary_dir, FD_SWEEP_FILE_NAME), numbers)
+
+    print '\n%-16s %10s %12s %10s %10s' % ('FD threshold', 'frames', 'seconds', 'mean FD', 'mean DVARS')
+
+    for i, threshold in enumerate(thresholds):
+        print '%-16s %10s %12.1f %10.3f %10.3f' % (threshold, numbers['remaining_frame_count'][i],
+                                                    numbers['remaining_seconds'][i],
+                                                    numbers['remaining_frame_mean_FD'][i],
+                                                    numbers['remaining_frame_mean_DVARS'][i])
+
+    return thresholds
+
+
+def print_stage_times(tracer, top=10):
+    """
+    Prints the stages that took longest in this run.
+
+    :param tracer: hcp_trace.Tracer after the run
+    :param top: number of stages to list
+    :return: None
+    """
+
+    stage_spans = sorted([span for span in tracer.spans if span.category == 'stage' and span.status != 'cached'],
+                         key=lambda span: span.stats['wall_s'], reverse=True)
+
+    if not stage_spans:
+        return
+
+    row_format = '%-40s %-8s %10s %10s %12s %12s'
+
+    print '\n' + row_format % ('stage', 'status', 'wall (s)', 'cpu (s)', 'read (MB)', 'written (MB)')
+    print '-' * 100
+
+    for span in stage_spans[:top]:
+        print row_format % (span.name, span.status, '%.1f' % span.stats['wall_s'], '%.1f' % span.stats['cpu_s'],
+                            '%.1f' % (span.stats['read_bytes'] / 1e6), '%.1f' % (span.stats['write_bytes'] / 1e6))
+
+
+def aggregate_stage_summaries(summary_paths):
+    """
+    Combines the per-stage summaries of several subjects (e.g. a batch): count, total / mean / max wall time, total
+    CPU time & bytes per stage name (REST series stages are pooled as REST*_<stage>).
+
+    :param summary_paths: paths to summary/hcp_postprocess_stages.json files
+    :return: dict of stage name -> dict of aggregated numbers
+    """
+
+    stages = {}
+
+    for summary_path in summary_paths:
+
+        if not path.exists(summary_path):
+            continue
+
+        with open(summary_path, 'r') as f:
+            spans = json.load(f)['spans']
+
+        for span in spans:
+
+            if span['category'] != 'stage' or span['status'] == 'cached':
+                continue
+
+            name = re.sub(r'^REST\d+_', 'REST*_', span['name'])
+
+            stage = stages.setdefault(name, {'count': 0, 'failed': 0, 'wall_s': 0.0, 'max_wall_s': 0.0, 'cpu_s': 0.0,
+                                             'read_bytes': 0, 'write_bytes': 0})
+
+            stage['count'] += 1
+            stage['failed'] += span['status'] == 'failed'
+            stage['wall_s'] += span['wall_s']
+            stage['max_wall_s'] = max(stage['max_wall_s'], span['wall_s'])
+            stage['cpu_s'] += span['cpu_s']
+            stage['read_bytes'] += span['read_bytes']
+            stage['write_bytes'] += span['write_bytes']
+
+    for stage in stages.values():
+        stage['mean_wall_s'] = stage['wall_s'] / stage['count']
+
+    return stages
+
+
+def aggregate_tool_summaries(summary_paths):
+    """
+    Adds up the per-tool totals (summary/hcp_postprocess_tools.json) of several subjects.
+
+    :param summary_paths: paths to tool summaries
+    :return: dict of tool name -> dict (count, failed, timed_out, wall_s, cpu_s, max_rss_kb)
+    """
+
+    tools = {}
+
+    for summary_path in summary_paths:
+
+        if not path.exists(summary_path):
+            continue
+
+        with open(summary_path, 'r') as f:
+            subject_tools = json.load(f)
+
+        for tool, stats in subject_tools.items():
+
+            total = tools.setdefault(tool, {'count': 0, 'failed': 0, 'timed_out': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                            'max_rss_kb': 0})
+
+            for counter in ('count', 'failed', 'timed_out', 'wall_s', 'cpu_s'):
+                total[counter] += stats[counter]
+
+            total['max_rss_kb'] = max(total['max_rss_kb'], stats['max_rss_kb'])
+
+    return tools
+
+
+def read_subject_list(list_path):
+    """
+    Reads a 2-column list-file (.csv) of subjectID, output_folder rows. Blank lines and lines starting with '#' are
+    skipped.
+
+    :param list_path: path to list-file (user input)
+    :return: list of tuples (subjectID, absolute path to output_folder)
+    """
+
+    subject_list = []
+
+    with open(list_path, 'r') as f:
+
+        for line_num, line in enumerate(f, 1):
+
+            line = line.strip()
+
+            if not line or line.startswith('#'):
+                continue
+
+            row = [item.strip() for item in line.split(',')]
+
+            if len(row) < 2 or not row[0] or not row[1]:
+                print 'Skipping line %s of %s, expected "subjectID, output_folder": \n\t%s' % (line_num, list_path, line)
+                continue
+
+            subject_list.append((row[0], path.abspath(row[1])))
+
+    return subject_list
+
+
+def run_subject_job(job):
+    """
+    Runs process_subject for one (subjectID, output_folder, options) job inside a batch worker. Catches the
+    sys.exit / exceptions raised along the way so one bad subject does not take down the rest of the batch.
+
+    :param job: tuple (subjectID, output_folder, dict of process_subject keyword options)
+    :return: dict with subject, output_folder, status ('success' or 'failure'), elapsed (seconds) and message
+    """
+
+    subject, output_folder, options = job
+
+    start = time.time()
+
+    status = 'failure'
+
+    message = ''
+
+    try:
+
+        if process_subject(subject, output_folder, **options):
+            status = 'success'
+        else:
+            message = 'missing final outputs'
+
+    except SystemExit, e:
+
+        message = 'exited with code %s' % e.code
+
+    except Exception, e:
+
+        message = '%s: %s' % (type(e).__name__, e)
+
+    return {
+        'subject'           : subject
+        , 'output_folder'   : output_folder
+        , 'status'          : status
+        , 'elapsed'         : time.time() - start
+        , 'message'         : message
+        , 'stage_summary'   : path.join(output_folder, 'summary', STAGE_SUMMARY_FILE_NAME)
+        , 'tool_summary'    : path.join(output_folder, 'summary', TOOL_SUMMARY_FILE_NAME)
+    }
+
+
+def print_batch_report(results):
+    """
+    Prints a per-subject success / failure / elapsed table for a finished batch.
+
+    :param results: list of dicts returned by run_subject_job
+    :return: None
+    """
+
+    row_format = '%-30s %-8s %10s  %s'
+
+    print '\n' + row_format % ('subjectID', 'status', 'elapsed', 'output_folder / message')
+    print '-' * 100
+
+    for result in results:
+
+        elapsed = '%d:%02d:%02d' % (result['elapsed'] // 3600, result['elapsed'] % 3600 // 60, result['elapsed'] % 60)
+
+        detail = result['output_folder']
+
+        if result['message']:
+            detail += ' (%s)' % result['message']
+
+        print row_format % (result['subject'], result['status'], elapsed, detail)
+
+    failures = [result for result in results if result['status'] != 'success']
+
+    print '\n%s of %s subjects succeeded.' % (len(results) - len(failures), len(results))
+
+
+def run_batch(list_path, workers, options=None):
+    """
+    Runs every subject in a list-file through process_subject in a bounded pool of worker processes.
+
+    :param list_path: path to list-file of subjectID, output_folder rows (user input)
+    :param workers: max number of subjects processed at once
+    :param options: dict of process_subject keyword options used for every subject (project_config, max_workers...)
+    :return: list of per-subject result dicts (see run_subject_job)
+    """
+
+    jobs = [(subject, output_folder, dict(options or {})) for subject, output_folder in read_subject_list(list_path)]
+
+    if not jobs:
+        print 'No subjects found in list-file: %s' % list_path
+        return []
+
+    workers = max(1, min(workers, len(jobs)))
+
+    print '\nProcessing %s subjects from %s with %s workers...\n' % (len(jobs), list_path, workers)
+
+    # one fresh process per subject: nothing (octave sessions, open files) leaks from one subject to the next
+    pool = multiprocessing.Pool(processes=workers, maxtasksperchild=1)
+
+    try:
+        results = pool.map(run_subject_job, jobs, chunksize=1)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    print_batch_report(results)
+
+    batch_summary_path = path.splitext(path.abspath(list_path))[0] + '_stage_summary.json'
+
+    try:
+        batch_summary = {
+            'stages'    : aggregate_stage_summaries([result['stage_summary'] for result in results])
+            , 'tools'   : aggregate_tool_summaries([result['tool_summary'] for result in results])
+        }
+        with open(batch_summary_path, 'w') as f:
+            json.dump(batch_summary, f, indent=1, sort_keys=True)
+        print '\nPer-stage summary of the batch: %s' % batch_summary_path
+    except IOError, e:
+        print '\nCould not write the per-stage summary of the batch (%s)' % e
+
+    return results
+
+
+def main():
+
+    # HANDLE ARGS
+    parser = get_parser()
+
+    args = parser.parse_args()
+
+    options = {
+        'project_config'        : args.project_config
+        , 'max_workers'         : args.cpus
+        , 'force_stages'        : args.force_stages
+        , 'backends'            : backend_choices(parser, args)
+        , 'scratch_dir'         : args.scratch_dir
+        , 'image_patterns'      : args.image_patterns
+        , 'fd_sweep'            : args.fd_sweep
+    }
+
+    if args.fd_sweep and hcp_motion is None:
+        parser.error('--fd-sweep needs NumPy / nibabel')
+
+    if args.check_regressors:
+
+        if args.list_path:
+            subject_list = read_subject_list(args.list_path)
+        elif args.subject_code and args.output_path:
+            subject_list = [(args.subject_code, path.abspath(args.output_path))]
+        else:
+            parser.error('either --list, or both --subject_ID and --output_path are required')
+
+        if np is None:
+            parser.error('--check-regressors needs NumPy')
+
+        series_list = []
+
+        for subject, output_folder in subject_list:
+
+            subject_series = find_subject_series(subject, output_folder)
+
+            if not subject_series:
+                print 'No REST series found for %s in %s' % (subject, output_folder)
+
+            series_list.extend(subject_series)
+
+        if print_regressor_report(validate_regressors(series_list)) or not series_list:
+            sys.exit(1)
+
+    elif args.list_path:
+
+        # share the CPUs between the subjects running at once
+        options['max_workers'] = max(1, args.cpus // max(1, args.workers))
+
+        results = run_batch(args.list_path, args.workers, options)
+
+        if not results or [result for result in results if result['status'] != 'success']:
+            sys.exit(1)
+
+    elif args.subject_code and args.output_path:
+
+        process_subject(args.subject_code, path.abspath(args.output_path), **options)
+
+    else:
+
+        parser.error('either --list, or both --subject_ID and --output_path are required')
+
+
+def backend_choices(parser, args):
+    """
+    :return: dict of stage -> backend asked for on the command line (--backend)
+    """
+
+    try:
+        return hcp_backends.parse_backend_spec(args.backends)
+    except ValueError, e:
+        parser.error('--backend: %s' % e)
+
+
+def scratch_inputs(subject):
+    """
+    What a subject's run reads, relative to its folder, for --scratch.
+
+    :return: tuple (glob patterns of files to copy to scratch, patterns of files only sym-linked there)
+    """
+
+    copy_patterns = [
+        'MNINonLinear/T1w_restore_brain.nii.gz'
+        , 'MNINonLinear/T1w_restore.nii.gz'
+        , 'MNINonLinear/T2w_restore.nii.gz'
+        , 'MNINonLinear/.resample_cache/*.nii.gz'
+        , 'MNINonLinear/ROIs/wmparc.2.nii.gz'
+        , 'MNINonLinear/fsaverage_LR32k/%s.[LR].white.32k_fs_LR.surf.gii' % subject
+        , 'MNINonLinear/fsaverage_LR32k/%s.[LR].pial.32k_fs_LR.surf.gii' % subject
+        , 'MNINonLinear/fsaverage_LR32k/%s.32k_fs_LR.wb.spec' % subject
+        , 'MNINonLinear/Results/REST*/REST*[0-9].nii.gz'
+        , 'MNINonLinear/Results/REST*/REST*[0-9]_Atlas.dtseries.nii'
+        , 'MNINonLinear/Results/REST*/Movement_Regressors.txt'
+        , '.hcp_postprocess_cache/*.json'
+    ]
+
+    # RAW EPI: only their headers are read (TR)
+    link_patterns = ['unprocessed/NIFTI/*REST*']
+
+    return copy_patterns, link_patterns
+
+
+def scratch_outputs():
+    """
+    Where a subject's run writes, relative to its folder, for --scratch: staged too when earlier stages are up to date,
+    as their manifests only list some of what they write.
+
+    :return: glob patterns of files to copy to scratch
+    """
+
+    return [
+        'summary/*'
+        , 'analyses_v2/*/*'
+        , 'MNINonLinear/ROIs/*'
+        , 'MNINonLinear/Results/*.nii'
+        , 'MNINonLinear/Results/REST*/FNL_preproc/*'
+    ]
+
+
+def process_subject_in_scratch(subject, output_folder, scratch_dir, max_workers=1, **options):
+    """
+    process_subject on a node-local copy of the subject's inputs (see hcp_scratch), syncing the outputs back.
+
+    :param scratch_dir: --scratch
+    :param options: process_subject keyword options
+    :return: whatever process_subject returned
+    """
+
+    staging = hcp_scratch.ScratchStaging(scratch_dir, output_folder, subject)
+
+    try:
+        try:
+            copy_patterns, link_patterns = scratch_inputs(subject)
+
+            # EARLIER OUTPUTS COME ALONG WITH THEIR MANIFESTS, SO UP-TO-DATE STAGES ARE STILL SKIPPED IN SCRATCH
+            recorded_files = hcp_stages.StageCache(path.join(output_folder, '.hcp_postprocess_cache'),
+                                                   output_folder).recorded_files()
+
+            if recorded_files:
+                copy_patterns += scratch_outputs()
+
+            started = time.time()
+            staged_bytes = staging.stage(copy_patterns, link_patterns, max_workers, recorded_files)
+
+            print '\nStaged %.1f MB of inputs to %s in %.1fs\n' % (staged_bytes / 1e6, staging.root,
+                                                                  time.time() - started)
+
+            # DECOMPRESSED INPUTS GO NEXT TO THE WORK FOLDER, NOT INTO IT, SO THEY ARE NEVER SYNCED BACK
+            return process_subject(subject, staging.work_folder, max_workers=max_workers,
+                                   final_output_folder=output_folder, volume_cache_dir=staging.root, **options)
+        finally:
+            # PARTIAL OUTPUTS & LOGS OF A FAILED RUN COME BACK TOO
+            started = time.time()
+            synced = staging.sync_back(max_workers)
+
+            print '\nSynced %s outputs back to %s in %.1fs\n' % (len(synced), output_folder, time.time() - started)
+    finally:
+        staging.cleanup()
+
+
+def process_subject(subject, output_folder, project_config=None, max_workers=1, force_stages=None, backends=None,
+                    image_patterns=None, scratch_dir=None, final_output_folder=None, volume_cache_dir=None,
+                    fd_sweep=False):
+    """
+    Runs the whole post-processing flow for one subject / visit.
+
+    :param subject: subjectID (user input)
+    :param output_folder: absolute path to HCP processed data directory (user input)
+    :param project_config: optional project name to force a different config (user input)
+    :param max_workers: max number of pipeline stages run at once
+    :param force_stages: names of stages to re-run even if up to date (plus everything downstream), 'all' to start over
+    :param backends: dict of stage -> backend overriding config_hcp_postprocess.backends (see hcp_backends.BACKENDS)
+    :param image_patterns: optional list of image names / patterns, only render those scene images
+    :param scratch_dir: optional node-local folder to run in (see process_subject_in_scratch)
+    :param final_output_folder: where output_folder gets synced back to, when running in scratch
+    :param volume_cache_dir: where to decompress the .nii.gz inputs, overrides config_hcp_postprocess.volume_cache
+    :param fd_sweep: also write summary/FD_threshold_sweep.txt (see write_fd_sweep)
+    :return: Boolean, whether all expected final outputs were found
+    """
+
+    if scratch_dir:
+        return process_subject_in_scratch(subject, output_folder, scratch_dir, max_workers,
+                                          project_config=project_config, force_stages=force_stages, backends=backends,
+                                          image_patterns=image_patterns, fd_sweep=fd_sweep)
+
+    prog_path = path.dirname(sys.argv[0])
+
+    # PROJECT, VISIT, PIPELINE & ENVIRONMENT COME FROM THE REAL PATH, NOT THE SCRATCH COPY
+    real_output_folder = final_output_folder or output_folder
+
+    environment = get_environment(real_output_folder)
+
+    # SETUP ENVIRONMENT AND PROJECT VARIABLES
+
+    project_name, visitID, pipeline = infer_project_details_from_path(real_output_folder, subject)
+
+    if project_config:
+        project_name = project_config
+
+    environ_binaries, project_settings, image_names, mask_labels = get_configs(environment, project_name)
+
+    backends, fallbacks = hcp_backends.resolve_backends(config_hcp_postprocess.backends, backends, {
+        'masks'         : ['native'] if hcp_volumes is None else []
+        , 'resample'    : ['native'] if hcp_volumes is None else []
+        , 'means'       : ['native'] if hcp_volumes is None else []
+        , 'parcellate'  : ['native'] if hcp_cifti is None else []
+        , 'regress'     : ['native'] if hcp_regression is None else []
+        , 'qc_images'   : ['native'] if hcp_qc is None else []
+    })
+
+    for stage, wanted, used in fallbacks:
+        print '\nNumPy / nibabel / SciPy / Pillow not available, %s backend %s falls back to %s...\n' % (stage, wanted, used)
+
+    print '\nBackends: %s\n' % hcp_backends.describe(backends)
+
+    raw_data_dir = path.abspath(path.join(output_folder, 'unprocessed', 'NIFTI'))
+
+    # BEGIN PROCESSING ...
+    print '\nStarting Summary and Prep Sections...\n'
+
+    # check_complete_inputs(t1, regressors_path, t1_brain)
+
+    # COUNT HOW MANY THINGS HAVE 'REST' in their file/directory strings
+    # we presume that's how many REST there are to process
+    try:
+        num_epi, raw_epi_list = count_epi_series(raw_data_dir)
+    except OSError:
+        print 'Missing raw EPI-data! Please check your -o setting to make sure this exists?\n%s' % raw_data_dir
+        exit(1)
 
     start_time = datetime.now()
     # TELL USER WHAT YOU'RE DOING
@@ -1333,20 +2695,31 @@ def main():
     # CONCAT DIRECTORY LISTS
     all_dirs_to_make = analysis_dirs_to_make + preproc_dirs_to_make
 
-    # REMOVE EXISTING OUTPUT DIRS
-    print '\nRemoving existing outputs...\n'
+    # STAGES KEEP A MANIFEST OF WHAT THEY RAN WITH -> on re-runs, only stages whose inputs / params changed run again
+    stage_cache = hcp_stages.StageCache(path.join(output_folder, '.hcp_postprocess_cache'), output_folder,
+                                        [real_output_folder])
+
+    force_stages = list(force_stages or [])
+
+    if 'all' in force_stages:
+
+        # REMOVE EXISTING OUTPUT DIRS
+        print '\nRemoving existing outputs...\n'
+
+        remove_outputs(analysis_dirs_to_make)
+        remove_outputs(preproc_dirs_to_make)
+        remove_outputs(rest_dirs_to_make)
 
-    remove_outputs(analysis_dirs_to_make)
-    remove_outputs(preproc_dirs_to_make)
-    remove_outputs(rest_dirs_to_make)
+        stage_cache.clear()
+
+        force_stages.remove('all')
 
     # NOW MAKE NEW OUTPUT DIRS
     try:
         print 'Making output directories...\n'
 
-        make_output_dirs(all_dirs_to_make)
-
-        make_output_dirs(rest_dirs_to_make)
+        make_output_dirs([output_dir for output_dir in all_dirs_to_make + rest_dirs_to_make
+                          if not path.exists(output_dir)])
 
     except Exception, e:
 
@@ -1354,24 +2727,21 @@ def main():
 
         sys.exit(1)
 
-    t1_brain = path.join(output_folder, 'MNINonLinear', 'T1w_restore_brain.nii.gz')
-
-    atlas = path.join(prog_path, 'templates', 'MNI152_T1_1mm_brain.nii.gz')
-
-    # MAKE T1 ON MNI & VICE VERSA GIFS
+    # EXTERNAL COMMANDS: no shell, output to a per-subject log, per-tool timeouts & resource totals
+    command_runner = hcp_commands.CommandRunner(path.join(summary_dir, COMMAND_LOG_FILE_NAME),
+                                                config_hcp_postprocess.command_timeouts)
+    hcp_commands.set_runner(command_runner)
 
-    print '\nCreating T1_atlas .gifs...\n'
+    print 'External command output goes to: %s' % command_runner.log_path
 
-    create_t1_atlas_gifs(atlas, t1_brain, summary_dir, subject)
+    t1_brain = path.join(output_folder, 'MNINonLinear', 'T1w_restore_brain.nii.gz')
 
-    # REGISTER T1 TO MNI-2mm
+    atlas = path.join(prog_path, 'templates', 'MNI152_T1_1mm_brain.nii.gz')
 
     fsl_standard_path = path.join('%(fsl_dir_path)s/data/standard/MNI152_T1_2mm_brain' % {
         'fsl_dir_path': environ_binaries['FSL_DIR']})
 
-    # FLIRT REG TO T1 MNI (2mm) SPACE -> from fsl_standards on beast
-    print '\nRegistering T1 -> MNI_2mm-space (via fsl template)...\n'
-    t1_2mm = flirt_t1_to_mni_2mm(t1_brain, fsl_standard_path)
+    t1_2mm = t1_brain.replace('_brain.nii.gz', '_brain.2.nii.gz')
 
     # SETUP VARS
 
@@ -1385,8 +2755,6 @@ def main():
 
     paths_for_scene = [t1, rw, rp, lw, lp]  # do not include t2 here since we have a method for handling that (below)
 
-    missing_paths = []
-
     # CHECK FOR T2
 
     subject_has_t2_data = has_t2(output_folder)
@@ -1398,67 +2766,72 @@ def main():
 
         t2 = t1
 
-    for file_path in paths_for_scene:
-        if path.exists(path.join(file_path)):
-            continue
-        else:
-            missing_paths.append(path.join(file_path))
-            raise 'Unable to locate these files: \n%s\nWill not be able to make .scene!\n' % missing_paths
-
-    # BUILD SCENE FROM TEMPLATE
-    # SETUP AND RUN SLICES (FSL) COMMAND TO MAKE .GIFS
+    # SETUP OUTPUT MASK LABELS TO BE USED
 
-    print 'Creating scene from template...'
-    build_scene_from_template(t2, t1, rp, lp, rw, lw, output_folder)
+    segBrainDir = "%s/MNINonLinear/ROIs" % output_folder  # TODO: refactor this varibale
 
-    # OUTPUTS A BUNCH OF PNG FILES
-    # for i in image_names; scenenum = i; if not has_t2 and 'T2' in i: print 'skip' && continue ;
-    # else create_image_from_template
+    segBrain = "wmparc.2.nii.gz"  # TODO: refactor this varibale
 
-    print '\nMaking .png images from .scene...\n'
+    eroded_wm_mask = path.join(segBrainDir, "wm_2mm_%s_mask_eroded.nii.gz" % subject)
 
-    # Count from i to max scenes number, check for t2, create_image_from_template on scene i
-    for num, scene in enumerate(image_names):
+    eroded_vent_mask = path.join(segBrainDir, "vent_2mm_%s_mask_eroded.nii.gz" % subject)
 
-        num += 1  # start your count at 1 instead of 0
+    # an existing merged cifti is removed by its stage before making a new one
+    merged_cifti = path.join(mni_results_path, subject + '_FNL_preproc_Atlas.dtseries.nii')
 
-        if not has_t2(output_folder):
+    spec_file = path.join(output_folder, 'MNINonLinear', 'fsaverage_LR32k', subject + '.32k_fs_LR.wb.spec')
 
-            print '\nNo T2 image found, skipping this scene...\n'
+    # ONE OCTAVE INTERPRETER FOR ALL OCTAVE CALLS OF THIS SUBJECT (started on first use)
+    octave_session = hcp_octave.OctaveSession(environ_binaries['octave'],
+                                              [prog_path, path.join(prog_path, 'scripts'),
+                                               environ_binaries['HCP_Mat_Path']])
 
-            continue
+    # DECLARE THE PIPELINE AS A STAGE GRAPH -> every stage starts as soon as the stages it depends on are done
 
-        else:
+    graph = hcp_stages.StageGraph()
 
-            create_image_from_template(output_folder, num, scene, environ_binaries)
+    # MAKE T1 ON MNI & VICE VERSA GIFS
+    graph.add('t1_atlas_gifs', partial(create_t1_atlas_gifs_native if backends['qc_images'] == 'native'
+                                       else create_t1_atlas_gifs, atlas, t1_brain, summary_dir, subject),
+              inputs=[atlas, t1_brain],
+              outputs=[path.join(summary_dir, '%s_atlas_in_t1.gif' % subject),
+                       path.join(summary_dir, '%s_t1_in_atlas.gif' % subject)])
 
-    # REMOVE TEMP.SCENE FILE USED ABOVE
+    # FLIRT REG TO T1 MNI (2mm) SPACE -> from fsl_standards on beast
+    graph.add('flirt_t1_2mm', partial(flirt_t1_to_mni_2mm_native if backends['resample'] == 'native'
+                                      else flirt_t1_to_mni_2mm, t1_brain, fsl_standard_path),
+              inputs=[t1_brain, find_nifti(fsl_standard_path)], outputs=[t1_2mm])
 
-    submit_command('rm -rf %s/image_template_temp.scene' % output_folder)
+    # BUILD SCENE FROM TEMPLATE, OUTPUTS A BUNCH OF PNG FILES
+    scenes = select_scene_images(image_names, subject_has_t2_data, image_patterns)
 
-    # SETUP OUTPUT MASK LABELS TO BE USED
+    graph.add('scene_images', partial(render_scene_images, output_folder, scenes, environ_binaries,
+                                      t2, t1, rp, lp, rw, lw, max_workers),
+              inputs=paths_for_scene,
+              outputs=[path.join(summary_dir, '%s.png' % image_name) for scene_num, image_name in scenes])
 
-    segBrainDir = "%s/MNINonLinear/ROIs" % output_folder  # TODO: refactor this varibale
+    # CREATE WM AND VENT MASKS
+    if backends['masks'] == 'native':
 
-    segBrain = "wmparc.2.nii.gz"  # TODO: refactor this varibale
+        # both masks from a single read of wmparc, in memory
+        graph.add('masks', partial(make_wm_vent_masks, segBrainDir, segBrain, project_settings, subject),
+                  inputs=[path.join(segBrainDir, segBrain)], outputs=[eroded_wm_mask, eroded_vent_mask])
 
-    # CREATE WM AND VENT MASKS
-    print '\nMaking ventricle and WM masks...\n'
+        mask_stages = ['masks']
 
-    eroded_wm_mask = make_wm_mask(segBrainDir, segBrain, project_settings, subject)
+    else:
 
-    eroded_vent_mask = make_vent_mask(segBrainDir, segBrain, project_settings, subject)
+        graph.add('wm_mask', partial(make_wm_mask, segBrainDir, segBrain, project_settings, subject),
+                  inputs=[path.join(segBrainDir, segBrain)], outputs=[eroded_wm_mask])
 
-    print '\ndone making masks...\n'
+        graph.add('vent_mask', partial(make_vent_mask, segBrainDir, segBrain, project_settings, subject),
+                  inputs=[path.join(segBrainDir, segBrain)], outputs=[eroded_vent_mask])
 
-    # REMOVE EXISTING merged cifti if present -> will be making a new one
-    merged_cifti = path.join(mni_results_path, subject + '_FNL_preproc_Atlas.dtseries.nii')
+        mask_stages = ['wm_mask', 'vent_mask']
 
-    if path.exists(merged_cifti):
-        print '\nRemoving existing merged cifti...\n%s' % merged_cifti
-        os.remove(merged_cifti)
+    # NOW ADD STAGES FOR ALL OUR RESTing EPI
 
-    # NOW LOOP THROUGH ALL OUR RESTing EPI
+    rest_series = []
 
     for epi_file in raw_epi_list:
 
@@ -1478,175 +2851,215 @@ def main():
 
         fnl_preproc_dir = path.join(epi_result_dir, 'FNL_preproc')
 
-        # CHECK REGRESSOR PATH VIA IN-HOUSE PYTHON SCRIPT (in config)
-        # Makes an additional call out to fslhd, then uses data-munging to "validate" a text file, then returns Nothing?
-        # TODO: refactor this script into my own function and keep local to this module
-        regressors_path = path.join(mni_results_path, resting_series_name, 'Movement_Regressors.txt')
-
-        if not check_regressors_valid(epi_file, epi_result_dir, environ_binaries):
-            print 'UGH, that <expletive deleted> script is telling me that you have a ' \
-                  'Missing or otherwise "invalid" regressor file. \n%s\nPlease confirm, Exiting for now...' % regressors_path
-            sys.exit(1)
-        else:
-            print 'Regressor file valid for %s!' % epi_file
+        regressors_path = path.join(epi_result_dir, 'Movement_Regressors.txt')
 
-        # print epi_result_path
-        # MAKE T1<->FUNCTIONAL REG GIFS
-        print '\nMaking functional registration .gifs...\n'
-        make_functional_registration_gifs(t1_2mm, subject, summary_dir, epi_result_path, resting_series_name)
-
-        # CALCULATE AND WRITE _VENT and _WM_meant.txt files
-        print '\ncalculating vent and wm_meant.txt...\n'
-        calculate_wm_vent_means(epi_result_dir, resting_series_name, fnl_preproc_dir, eroded_vent_mask, eroded_wm_mask)
+        fnl_preproc_cifti = path.join(fnl_preproc_dir, resting_series_name + '_FNL_preproc_Atlas.dtseries.nii')
 
-        # BEGIN CIFTI CREATION SECTION
-        dt_series_suffix = '_Atlas.dtseries.nii'
+        rest_series.append((resting_series_name, rest_num, fnl_preproc_dir))
 
-        # COPY _Atlas.dtseries.nii to /FNL_preproc sub-dir
-        print '\nCopying dtseries files to prep for Octave section...\n'
-        # copy_source = path.join(epi_result_dir, resting_series_name + dt_series_suffix)
-        fnl_preproc_cifti = path.join(fnl_preproc_dir, resting_series_name + '_FNL_preproc' + dt_series_suffix)
+        # CHECK REGRESSOR FILE (rows = frames, columns, finite values)
+        graph.add(resting_series_name + '_regressors',
+                  partial(require_valid_regressors, epi_file, epi_result_dir, environ_binaries),
+                  inputs=[epi_file, regressors_path])
 
-        # shutil.copyfile(copy_source, fnl_preproc_cifti)
-
-        # We also need the REST_Atlas.dtseries.nii file from path above FNL_preproc directory
-        cifti_out = path.join(epi_result_dir, resting_series_name + dt_series_suffix)
-        cifti_out_dest = path.join(fnl_preproc_dir, resting_series_name + dt_series_suffix)
-
-        print 'CIFTI OUT IS: \n\t%s \nCOPYING TO: \n\t%s\n' % (cifti_out, cifti_out_dest)
-        shutil.copyfile(cifti_out, cifti_out_dest)
-
-        fnl_preproc_cifti_name = path.basename(fnl_preproc_cifti)
+        # MAKE T1<->FUNCTIONAL REG GIFS
+        graph.add(resting_series_name + '_gifs',
+                  partial(make_functional_registration_gifs_native if backends['qc_images'] == 'native'
+                          else make_functional_registration_gifs, t1_2mm, subject, summary_dir, epi_result_path,
+                          resting_series_name),
+                  inputs=[t1_2mm, epi_result_path],
+                  outputs=[path.join(summary_dir, '%s_%s_in_t1.gif' % (subject, resting_series_name)),
+                           path.join(summary_dir, '%s_t1_in_%s.gif' % (subject, resting_series_name))],
+                  depends=['flirt_t1_2mm'])
 
-        # BEGIN FIRST OCTAVE SECTION -> WRITE CONFIG.json for FNL_preproc_Matlab.m
-        print '\nRunning FNL_preproc Octave Section...\n'
+        # CALCULATE AND WRITE _VENT and _WM_meant.txt files
+        graph.add(resting_series_name + '_means',
+                  partial(calculate_wm_vent_means_native if backends['means'] == 'native' else calculate_wm_vent_means,
+                          epi_result_dir, resting_series_name, fnl_preproc_dir,
+                          eroded_vent_mask, eroded_wm_mask),
+                  inputs=[epi_result_path, eroded_vent_mask, eroded_wm_mask],
+                  outputs=[path.join(fnl_preproc_dir, resting_series_name + '_vent_mean.txt'),
+                           path.join(fnl_preproc_dir, resting_series_name + '_wm_mean.txt')],
+                  depends=mask_stages)
+
+        if backends['regress'] == 'native':
+
+            # NUISANCE REGRESSION & BAND-PASS IN-PROCESS, series run side-by-side
+            graph.add(resting_series_name + '_fnl_preproc',
+                      partial(run_fnl_preproc_series_native, fnl_preproc_dir, project_settings, resting_series_name,
+                              epi_file_tr, summary_dir, epi_result_dir, max_workers),
+                      inputs=[regressors_path, path.join(epi_result_dir, resting_series_name + '_Atlas.dtseries.nii'),
+                              path.join(fnl_preproc_dir, resting_series_name + '_wm_mean.txt'),
+                              path.join(fnl_preproc_dir, resting_series_name + '_vent_mean.txt')],
+                      outputs=[fnl_preproc_cifti, path.join(summary_dir, 'FD_%s.txt' % resting_series_name)],
+                      depends=[resting_series_name + '_regressors', resting_series_name + '_means'])
 
-        print '\nRemoving existing, and creating config.json\n'
+        else:
 
-        try:
-            write_ml_config_and_run_octave(fnl_preproc_dir, environ_binaries, project_settings, resting_series_name,
-                                           epi_file_tr, summary_dir, cifti_out, epi_result_dir, fnl_preproc_cifti_name)
+            # FIRST OCTAVE SECTION -> FNL_preproc_Matlab.m, per series
+            graph.add(resting_series_name + '_fnl_preproc',
+                      partial(run_fnl_preproc_series, fnl_preproc_dir, environ_binaries, project_settings,
+                              resting_series_name, epi_file_tr, summary_dir, epi_result_dir, octave_session),
+                      inputs=[regressors_path, path.join(epi_result_dir, resting_series_name + '_Atlas.dtseries.nii')],
+                      outputs=[fnl_preproc_cifti],
+                      depends=[resting_series_name + '_regressors', resting_series_name + '_means'],
+                      locks=['octave'])
 
-        except Exception, e:
-            print 'something went wrong during OCTAVE, UGH>..\n\t%s' % e
-            sys.exit()
+    fnl_preproc_stages = [series_name + '_fnl_preproc' for series_name, rest_num, fnl_preproc_dir in rest_series]
 
-        print 'Done with first Octave section...'
+    # NOW CONCATENATE ALL THE CIFTIS WE JUST MADE
+    graph.add('merge_ciftis', partial(merge_series_ciftis, environ_binaries, mni_results_path, subject, rest_series),
+              outputs=[merged_cifti], depends=fnl_preproc_stages)
 
-        # NOW CONCATENATE ALL THE CIFTIS WE JUST MADE
+    # .spec is edited in-place by wb_command, so only one stage at a time may touch it
+    graph.add('dense_ts_to_spec', partial(dense_ts_to_spec, environ_binaries, merged_cifti, spec_file),
+              inputs=[merged_cifti], depends=['merge_ciftis'], locks=['spec_file'])
 
-        # FNL_preproc_CIFTI_name="${fMRIName}_FNL_preproc_Atlas.dtseries.nii"
-        print '\nMerging ciftis...\n'
-        merge_ciftis(environ_binaries, mni_results_path, fnl_preproc_dir, rest_num, subject, resting_series_name)
+    # MAKE SYM-LINKS
+    graph.add('sym_links', partial(make_analysis_links, output_folder, subject, visitID, pipeline, merged_cifti,
+                                   spec_file, summary_dir, real_output_folder),
+              depends=['dense_ts_to_spec'])
 
     # NOW DO PARCELLATIONS FOR SURF+SUBCORT AND SUBCORT-ONLY
-    merged_cifti = path.join(mni_results_path, subject + '_FNL_preproc_Atlas.dtseries.nii')
+    parcellation_outputs = get_parcellation_outputs(environ_binaries, mni_results_path, subject)
 
-    spec_file = path.join(output_folder, 'MNINonLinear', 'fsaverage_LR32k', subject + '.32k_fs_LR.wb.spec')
+    label_paths = [label_path for label_path, ptseries_list in parcellation_outputs]
 
-    print '\nAdding merged cifti (dense_ts) to .spec (for Quality Assurance)...\n'
-    dense_ts_to_spec(environ_binaries, merged_cifti, spec_file)
+    if backends['parcellate'] == 'native':
 
-    workbench_ciftis_folder = path.join(output_folder, 'analyses_v2', 'workbench')
+        # every atlas from a single read of the merged dtseries
+        graph.add('parcellations', partial(make_parcellations_native, environ_binaries, mni_results_path, subject,
+                                           merged_cifti, spec_file),
+                  inputs=[merged_cifti] + label_paths,
+                  outputs=[ptseries for label_path, ptseries_list in parcellation_outputs for ptseries in ptseries_list],
+                  depends=['dense_ts_to_spec'], locks=['spec_file'])
 
-    # TODO: clean this up
-    output_folder_parts = output_folder.split('/')[1:6]  # could be wrong -> [1:7] ?
+        parcellation_stages = ['parcellations']
 
-    # TODO: find a better HACK!
-    if 'win' not in sys.platform:
-        starting_slash = '/'
     else:
-        starting_slash = '\\'
 
-    # GONNA ENFORCE THIS PATTERN FOR THIS SYM-LINKED STRUCTURE (for now)
-    # /<share_name>/<study_root_dir>/analyses_v2/<pipe>/<subjID>+<visit>  # slightly different than old FNL_preproc
-    analysis_folder = path.join(starting_slash + output_folder_parts[0]
-                                , output_folder_parts[1]  # a share_name usually starts with a slash and has 2 paths
-                                , output_folder_parts[2]
-                                , output_folder_parts[3]
-                                , output_folder_parts[4] # if len(output_folder_parts) is 5, this works... else adjust!
-                                , 'analyses_v2'
-                                , pipeline
-                                , subject + '+' + visitID)
+        # <parcel>_subcortical.ptseries.nii
+        graph.add('surface_parcellations', partial(make_subcort_and_surface_parcellations, environ_binaries,
+                                                   mni_results_path, subject, merged_cifti, spec_file),
+                  inputs=[merged_cifti] + label_paths,
+                  outputs=[ptseries_list[0] for label_path, ptseries_list in parcellation_outputs],
+                  depends=['dense_ts_to_spec'], locks=['spec_file'])
 
-    if path.exists(analysis_folder):
-        print '\nRemoving existing analysis output folder from previous run...\n%s' % analysis_folder
-        shutil.rmtree(analysis_folder)
-
-    if not path.exists(analysis_folder):
-        os.makedirs(analysis_folder)
+        # <parcel>.ptseries.nii
+        graph.add('subcortical_parcellations', partial(make_subcortical_only_parcellations, environ_binaries,
+                                                       mni_results_path, subject, merged_cifti, spec_file),
+                  inputs=[merged_cifti] + label_paths,
+                  outputs=[ptseries_list[1] for label_path, ptseries_list in parcellation_outputs],
+                  depends=['dense_ts_to_spec'], locks=['spec_file'])
 
-    links_to_make = {
+        parcellation_stages = ['surface_parcellations', 'subcortical_parcellations']
 
-        path.abspath(merged_cifti)                              : workbench_ciftis_folder
-        , path.abspath(spec_file)                               : workbench_ciftis_folder
-        , path.abspath(summary_dir)                             : analysis_folder
-        , path.join(output_folder, 'analyses_v2', 'FCmaps')     : analysis_folder
-        , path.join(output_folder, 'analyses_v2', 'motion')     : analysis_folder
-        , path.join(output_folder, 'analyses_v2', 'timecourses'): analysis_folder
-        , path.join(output_folder, 'analyses_v2', 'matlab_code'): analysis_folder
-        , path.join(output_folder, 'analyses_v2', 'workbench')  : analysis_folder
+    # ADD NEW METHODS TO HELP REDUCE ML DEPENDENCY
+    graph.add('concat_fd', partial(concat_FD_text_files, summary_dir),
+              outputs=[path.join(summary_dir, 'all_FD.txt')], depends=fnl_preproc_stages)
 
-    }
+    # SECOND OCTAVE SECTION -> ANALYSES_V2.m
 
-    # MAKE SYM-LINKS
+    # TODO: do we not need the TR from EACH file for this? OR can we just pick 1 ? Choose randomly?
+    # TODO: Do we assume that any given TR will be the same across all?
+    # epi_file_tr will = the last TR value from our epi_files_list
+    graph.add('analyses_v2', partial(run_analyses_stage, environ_binaries, project_settings, output_folder,
+                                     epi_file_tr, summary_dir, mni_results_path, octave_session),
+              outputs=[path.join(summary_dir, 'FD_dist.png')],
+              depends=['sym_links', 'concat_fd'] + parcellation_stages,
+              locks=['octave'])
 
-    print '\nCreating sym links...'
-    make_sym_links(links_to_make)
+    # COPY MAT FILES TO /motion -> used in downstream analysis by "GUI_environments".m"
+    graph.add('copy_motion_mats', partial(copy_motion_frames_matfile,
+                                          path.join(output_folder, 'analyses_v2', 'matlab_code'),
+                                          path.join(output_folder, 'analyses_v2', 'motion')),
+              depends=['analyses_v2'])
+
+    if fd_sweep and hcp_motion is not None:
+
+        # FD, DVARS & CENSORING FOR EVERY FD THRESHOLD IN-PROCESS -> FD_threshold_sweep.txt, alongside analyses_v2
+        graph.add('fd_sweep', partial(write_fd_sweep, project_settings, epi_file_tr, summary_dir, rest_series),
+                  inputs=[input_path for series_name, rest_num, fnl_preproc_dir in rest_series
+                          for input_path in (path.join(path.dirname(fnl_preproc_dir), 'Movement_Regressors.txt'),
+                                             path.join(fnl_preproc_dir,
+                                                       series_name + '_FNL_preproc_Atlas.dtseries.nii'))],
+                  outputs=[path.join(summary_dir, FD_SWEEP_FILE_NAME)],
+                  depends=fnl_preproc_stages)
+
+    elif fd_sweep:
+        print '\nNumPy / nibabel not available, no %s...\n' % FD_SWEEP_FILE_NAME
+
+    graph.add('frames_per_scan', partial(write_frames_per_scan, mni_results_path, summary_dir),
+              outputs=[path.join(summary_dir, 'frames_per_scan.txt')],
+              depends=[series_name + '_regressors' for series_name, rest_num, fnl_preproc_dir in rest_series])
+
+    unknown_images = [pattern for pattern in image_patterns or []
+                      if not [image_name for image_name in image_names if fnmatch(image_name, pattern)]]
+
+    if unknown_images:
+        print '\nNo scene image matches: %s\nChoices are: %s' % (', '.join(unknown_images), ', '.join(image_names))
+        sys.exit(1)
 
-    # START MAKING PTSERIES DATA
+    unknown_stages = [name for name in force_stages if name not in [stage.name for stage in graph.stages]]
 
-    print '\nMaking subcort + surface parcellations...\n'
+    if unknown_stages:
+        print '\nUnknown stage(s) to force: %s\nChoices are: all, %s' % (
+            ', '.join(unknown_stages), ', '.join(stage.name for stage in graph.stages))
+        sys.exit(1)
 
-    try:
+    print '\nRunning %s stages, up to %s at once...\n' % (len(graph.stages), max_workers)
 
-        make_subcort_and_surface_parcellations(environ_binaries, mni_results_path, subject, merged_cifti, spec_file)
+    volume_cache = config_hcp_postprocess.volume_cache
 
-    except Exception, e:
+    if volume_cache['enabled']:
+        print 'Decompressing .nii.gz inputs once, to %s\n' % hcp_volume_cache.open_cache(
+            volume_cache_dir or volume_cache['dir'], volume_cache['ram_mb'] * 1024 * 1024)
 
-        print '\nProblem making parcellations...\n%s\nExiting or the next section will fail anyway...\n' % e
+    tracer = hcp_trace.Tracer(subject)
 
-        sys.exit()
+    subject_span = tracer.start(subject, category='subject', output_folder=real_output_folder, backends=backends)
 
-    # MAKE SUBCORTICAL PARCELLATIONS
+    try:
+        graph_ok = graph.run(max_workers, cache=stage_cache, force_stages=force_stages, tracer=tracer)
+    finally:
+        octave_session.exit()
 
-    print '\nMaking subcort-ONLY parcellations...\n'
+        hcp_volume_cache.close_cache()
 
-    make_subcortical_only_parcellations(environ_binaries, mni_results_path, subject, merged_cifti, spec_file)
+        tracer.finish(subject_span, 'ok' if not graph.failed else 'failed', octave_starts=octave_session.starts)
 
-    # ADD NEW METHODS TO HELP REDUCE ML DEPENDENCY
-    concat_FD_text_files(summary_dir)
+        # ONE SPAN PER REST SERIES, covering all of its stages
+        tracer.group_spans(dict((series_name, [stage.name for stage in graph.stages
+                                               if stage.name.startswith(series_name + '_')])
+                                for series_name, rest_num, fnl_preproc_dir in rest_series))
 
+        trace_path, stage_summary_path = tracer.write(path.join(summary_dir, TRACE_FILE_NAME),
+                                                      path.join(summary_dir, STAGE_SUMMARY_FILE_NAME))
 
-    # SECOND OCTAVE SECTION -> ANALYSES_V2.m
+        tool_summary_path = command_runner.write_stats(path.join(summary_dir, TOOL_SUMMARY_FILE_NAME))
 
-    print '\nRunning second octave stage (analyses_v2.m takes several minutes)...\n'
+        print '\nStage trace: %s\nStage summary: %s\nTool summary: %s' % (trace_path, stage_summary_path,
+                                                                        tool_summary_path)
 
-    # TODO: do we not need the TR from EACH file for this? OR can we just pick 1 ? Choose randomly?
-    # TODO: Do we assume that any given TR will be the same across all?
+        print_stage_times(tracer)
 
-    try:
-        # epi_file_tr will = the last TR value from our epi_files_list
-        # TODO: should that^ be the case?
-        write_analyses_config_and_run_octave(environ_binaries, project_settings, output_folder,
-                                             epi_file_tr, summary_dir, mni_results_path)
-    except Exception, e:
+        command_runner.print_stats()
 
-        print 'Problem with analyses_v2.m to investigate... try running octave in a terminal to diagnose?'
-        sys.exit()
+    if graph.cached:
+        print '\nUp to date from a previous run (not re-run): \n\t%s' % '\n\t'.join(graph.cached)
 
-    # COPY MAT FILES TO /motion -> used in downstream analysis by "GUI_environments".m"
+    if not graph_ok:
 
-    print '\nCopying .mat files to /analyses_v2/motion where they belong...'
+        print '\nStages that failed: \n\t%s' % '\n\t'.join('%s -> %s' % item for item in graph.failed.items())
 
-    copy_motion_frames_matfile(path.join(output_folder, 'analyses_v2', 'matlab_code'),
-                               path.join(output_folder, 'analyses_v2', 'motion'))
+        if graph.skipped:
+            print '\nStages skipped because of those failures: \n\t%s' % '\n\t'.join(graph.skipped)
 
-    print '\nWriting frames_per_scan file...\n'
+        sys.exit(1)
 
-    write_frames_per_scan(mni_results_path, summary_dir)
+    outputs_complete = check_final_outputs(output_folder, subject)
 
-    if check_final_outputs(output_folder, subject):
+    if outputs_complete:
 
         print '\n-->All Done with %s!' % subject
 
@@ -1656,6 +3069,8 @@ def main():
 
     print '\nElapsed Time: \n\t%s' % (end_time - start_time)
 
+    return outputs_complete
+
 if __name__ == '__main__':
 
     main()
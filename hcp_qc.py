@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+In-process (NumPy / nibabel / Pillow) QC montages for hcp_postprocess, in place of FSL slices.
+
+Like `slices base overlay [-s scale] -o out.gif`: a 3 x 3 montage of the base volume (sagittal, coronal & axial slices
+at 40, 50 & 60 % of each axis, one row per orientation) with the edges of the overlay volume drawn in red. Volumes
+are read through hcp_volume_cache, once per subject (the T1, atlas & 2mm T1 serve several montages; of a 4D EPI only
+its first volume is read), montages are built with NumPy slicing and written as palette GIFs.
+"""
+
+import numpy as np
+from PIL import Image
+
+import hcp_volume_cache
+
+SLICE_POSITIONS = (0.4, 0.5, 0.6)
+
+# intensities outside these percentiles of the non-zero voxels are clipped, like slicer's robust range
+ROBUST_PERCENTILES = (2, 98)
+
+# overlay voxels above this fraction of its robust range are its foreground, the edges are that outline
+EDGE_LEVEL = 0.1
+
+# palette: 0-254 grey ramp, 255 red for the edges
+EDGE_INDEX = 255
+PALETTE = [level for grey in range(255) for level in (grey, grey, grey)] + [255, 0, 0]
+
+
+# ~~~~~~~~~~~~~~~~ VOLUMES ~~~~~~~~~~~~~~~~ #
+def reference_volume(nifti_path):
+    """
+    :param nifti_path: 3D or 4D .nii / .nii.gz
+    :return: read-only float32 array (x, y, z), the first volume of a 4D image
+    """
+
+    data, img = hcp_volume_cache.load_data(nifti_path, first_volume=True, dtype=np.float32)
+
+    return data.reshape(data.shape[:3])
+
+
+def robust_range(data):
+
+    values = data[data != 0]
+
+    if not len(values):
+        return 0.0, 1.0
+
+    low, high = [float(value) for value in np.percentile(values, ROBUST_PERCENTILES)]
+
+    if high <= low:
+        # e.g. a mask: its one value against the background
+        low = min(low, 0.0)
+
+    return low, high if high > low else low + 1
+
+
+# ~~~~~~~~~~~~~~~~ MONTAGE ~~~~~~~~~~~~~~~~ #
+def orthogonal_slice(data, axis, position, shape=None):
+    """
+    :param data: volume (x, y, z)
+    :param axis: 0 sagittal, 1 coronal, 2 axial
+    :param position: fraction of the axis, e.g. 0.5 for the middle slice
+    :param shape: optional (rows, columns) to resample to (nearest neighbour), for an overlay on another grid
+    :return: 2D array, superior / anterior up
+    """
+
+    index = min(int(round(position * (data.shape[axis] - 1))), data.shape[axis] - 1)
+
+    image = np.rot90(np.take(data, index, axis=axis))
+
+    if shape is not None and image.shape != tuple(shape):
+        rows = (np.arange(shape[0]) * image.shape[0] // shape[0])
+        columns = (np.arange(shape[1]) * image.shape[1] // shape[1])
+        image = image[rows[:, np.newaxis], columns]
+
+    return image
+
+
+def outline(foreground):
+    """
+    :param foreground: 2D boolean array
+    :return: foreground pixels with at least one 4-neighbour outside it
+    """
+
+    padded = np.pad(foreground, 1, 'constant')
+
+    interior = (padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:])
+
+    return foreground & ~interior
+
+
+def montage(base, overlay=None, scale=1):
+    """
+    :param base: volume shown in grey
+    :param overlay: optional volume whose edges are drawn in red, resampled to the base's slices
+    :param scale: integer zoom of every slice
+    :return: uint8 palette-index array (rows, columns)
+    """
+
+    low, high = robust_range(base)
+
+    if overlay is not None:
+        overlay_low, overlay_high = robust_range(overlay)
+        overlay_level = overlay_low + EDGE_LEVEL * (overlay_high - overlay_low)
+
+    rows = []
+
+    for axis in (0, 1, 2):
+
+        cells = []
+
+        for position in SLICE_POSITIONS:
+
+            image = orthogonal_slice(base, axis, position)
+
+            cell = np.round(np.clip((image - low) / (high - low), 0, 1) * (EDGE_INDEX - 1)).astype(np.uint8)
+
+            if overlay is not None:
+                cell[outline(orthogonal_slice(overlay, axis, position, image.shape) > overlay_level)] = EDGE_INDEX
+
+            cells.append(cell.repeat(scale, axis=0).repeat(scale, axis=1))
+
+        height = max(cell.shape[0] for cell in cells)
+
+        rows.append(np.hstack([np.pad(cell, ((0, height - cell.shape[0]), (0, 0)), 'constant') for cell in cells]))
+
+    width = max(row.shape[1] for row in rows)
+
+    return np.vstack([np.pad(row, ((0, 0), (0, width - row.shape[1])), 'constant') for row in rows])
+
+
+def write_gif(indices, out_path):
+
+    image = Image.fromarray(indices, mode='P')
+
+    image.putpalette(PALETTE)
+
+    image.save(out_path, format='GIF')
+
+    return out_path
+
+
+def render_slices(base_path, overlay_path, out_path, scale=1):
+    """
+    Native `slices base_path overlay_path [-s scale] -o out_path`.
+
+    :return: out_path
+    """
+
+    return write_gif(montage(reference_volume(base_path), reference_volume(overlay_path), scale), out_path)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+In-process (NumPy / SciPy) nuisance regression of dense CIFTI time-series for hcp_postprocess, the regression part of
+FNL_preproc_Matlab.
+
+Per REST series the design matrix (intercept, WM & ventricle means, movement regressors, like FNL_preproc_Matlab) is
+built once and factored once (QR of its low-motion rows: FD under fd_th, after the first skip_seconds). Betas for every
+grayordinate then come from one matrix product per block of grayordinates, so the whole dtseries is regressed with a
+few BLAS calls and never has to be in memory at once.
+"""
+
+import numpy as np
+import nibabel as nib
+from scipy import linalg
+
+import hcp_cifti
+
+# diagonal of R relative to its largest entry below which the design is taken as rank deficient
+RANK_TOLERANCE = 1e-10
+
+
+# ~~~~~~~~~~~~~~~~ MOTION ~~~~~~~~~~~~~~~~ #
+def regression_frames(fd, fd_threshold, skip_frames):
+    """
+    :param fd: framewise displacement per frame
+    :param fd_threshold: project_config 'fd_th' (mm)
+    :param skip_frames: number of frames at the start of the series never used (skip_seconds / TR)
+    :return: boolean array, frames the betas are estimated from
+    """
+
+    keep = fd <= fd_threshold
+
+    keep[:skip_frames] = False
+
+    return keep
+
+
+# ~~~~~~~~~~~~~~~~ REGRESSION ~~~~~~~~~~~~~~~~ #
+def design_matrix(wm_mean, vent_mean, movement, linear_trend=False):
+    """
+    :param wm_mean: WM mean time-series (frames,)
+    :param vent_mean: ventricle mean time-series (frames,)
+    :param movement: movement regressors (frames, columns)
+    :param linear_trend: add a linear trend column after the intercept (not in FNL_preproc_Matlab's model)
+    :return: float64 array (frames, 3 + columns): intercept, (linear trend,) WM, ventricles, movement
+    """
+
+    frames = movement.shape[0]
+
+    for name, series in (('WM mean', wm_mean), ('ventricle mean', vent_mean)):
+        if len(series) != frames:
+            raise ValueError('%s has %s frames, movement regressors have %s' % (name, len(series), frames))
+
+    trend = [np.linspace(-1.0, 1.0, frames)] if linear_trend else []
+
+    return np.column_stack([np.ones(frames)] + trend + [wm_mean, vent_mean, movement])
+
+
+class NuisanceModel(object):
+    """
+    Least-squares fit of a design matrix on a subset of frames, factored once and applied to any number of
+    grayordinates: betas = R^-1 Q^T Y[frames], residuals = Y - X betas (every frame).
+
+    :parameter design: array (frames, regressors)
+    :parameter frames: boolean array (frames,), rows used for the fit
+    """
+
+    def __init__(self, design, frames):
+
+        self.design = np.asarray(design, dtype=np.float64)
+        self.frames = np.asarray(frames, dtype=bool)
+
+        fit = self.design[self.frames]
+
+        if fit.shape[0] < fit.shape[1]:
+            raise ValueError('%s frames to fit %s regressors' % (fit.shape[0], fit.shape[1]))
+
+        q, r = linalg.qr(fit, mode='economic')
+
+        diagonal = np.abs(np.diag(r))
+
+        self.rank_deficient = diagonal.min() <= diagonal.max() * RANK_TOLERANCE
+
+        if self.rank_deficient:
+            # e.g. a constant regressor: minimum-norm solution instead
+            self.projection = np.linalg.pinv(fit)
+        else:
+            self.projection = linalg.solve_triangular(r, q.T)
+
+    def betas(self, data):
+        """
+        :param data: array (frames, grayordinates)
+        :return: array (regressors, grayordinates)
+        """
+
+        return self.projection.dot(data[self.frames])
+
+    def residuals(self, data):
+
+        return data - self.design.dot(self.betas(data))
+
+
+def regress_dtseries(dtseries_path, out_path, model, max_chunk_bytes=256 * 1024 * 1024, workers=1):
+    """
+    Writes the residuals of a dense time-series after removing the nuisance model, reading & writing it in blocks of
+    grayordinates.
+
+    :param dtseries_path: e.g. REST1_Atlas.dtseries.nii
+    :param out_path: e.g. FNL_preproc/REST1_FNL_preproc_Atlas.dtseries.nii
+    :param model: NuisanceModel with one row per frame of the dtseries
+    :param max_chunk_bytes: bounds the dense data held in memory at once
+    :param workers: number of blocks processed at once (threads)
+    :return: out_path
+    """
+
+    check_frames(dtseries_path, model)
+
+    return hcp_cifti.map_dense_series(dtseries_path, out_path, model.residuals, max_chunk_bytes, workers)
+
+
+def check_frames(dtseries_path, model):
+
+    frames = nib.load(dtseries_path).shape[0]
+
+    if frames != model.design.shape[0]:
+        raise ValueError('%s has %s frames, the nuisance regressors %s' % (dtseries_path, frames,
+                                                                          model.design.shape[0]))
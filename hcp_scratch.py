@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Node-local scratch staging for hcp_postprocess (--scratch DIR).
+
+The subject's inputs are copied from network storage to a private folder under DIR that mirrors the subject folder's
+absolute path, every stage then reads & writes there, and only what the run produced (new files, inputs changed in
+place like the .spec, sym-links within the subject) is synced back: in parallel, each copy checked against the
+sha1 of its source before it replaces anything. The scratch folder is removed whether the run succeeded or not.
+
+Copies keep their source's mtime both ways, so the stage manifests (.hcp_postprocess_cache, staged & synced like any
+other file, with paths relative to the subject folder) see the same files on either side and re-runs stay incremental.
+"""
+
+import os
+import glob
+import tempfile
+from os import path
+from multiprocessing.pool import ThreadPool
+
+import hcp_fs
+
+SYNC_TMP_SUFFIX = '.scratch_sync'
+
+
+class SyncError(Exception):
+    pass
+
+
+class ScratchStaging(object):
+    """
+    :parameter scratch_dir: node-local disk or tmpfs (--scratch)
+    :parameter output_folder: absolute path of the subject folder on network storage
+    :parameter subject: subjID, part of the scratch folder name
+    """
+
+    def __init__(self, scratch_dir, output_folder, subject):
+
+        if not path.isdir(scratch_dir):
+            os.makedirs(scratch_dir)
+
+        self.output_folder = path.abspath(output_folder).rstrip('/')
+        self.root = tempfile.mkdtemp(prefix='hcp_postprocess_%s_' % subject, dir=scratch_dir)
+        self.work_folder = self.root + self.output_folder
+
+        # work path -> (real path, size, mtime) as staged
+        self.staged = {}
+
+        # work paths sym-linked to their real file, never synced back
+        self.linked = set()
+
+        os.makedirs(self.work_folder)
+
+    def work_path(self, real_path):
+
+        return self.root + path.abspath(real_path)
+
+    def real_path(self, work_path):
+
+        return path.join(self.output_folder, path.relpath(work_path, self.work_folder))
+
+    # ~~~~~~~~~~~~~~~~ STAGING ~~~~~~~~~~~~~~~~ #
+    def stage(self, copy_patterns, link_patterns=(), workers=1, copy_files=()):
+        """
+        :param copy_patterns: glob patterns relative to the subject folder, files copied to scratch
+        :param link_patterns: glob patterns of files only glanced at (e.g. raw epi headers), sym-linked instead
+        :param workers: copies run at once
+        :param copy_files: paths relative to the subject folder copied too when they exist (e.g. earlier outputs)
+        :return: number of bytes copied
+        """
+
+        to_copy = sorted(set([real for pattern in copy_patterns
+                              for real in glob.glob(path.join(self.output_folder, pattern)) if path.isfile(real)] +
+                             [path.join(self.output_folder, relative) for relative in copy_files
+                              if path.isfile(path.join(self.output_folder, relative))]))
+
+        to_link = sorted(set(real for pattern in link_patterns
+                             for real in glob.glob(path.join(self.output_folder, pattern))) - set(to_copy))
+
+        for real in to_copy + to_link:
+            if not path.isdir(path.dirname(self.work_path(real))):
+                os.makedirs(path.dirname(self.work_path(real)))
+
+        hcp_fs.make_links(dict((real, self.work_path(real)) for real in to_link))
+
+        self.linked.update(self.work_path(real) for real in to_link)
+
+        def copy_in(real):
+
+            work = self.work_path(real)
+
+            hcp_fs.copy_file(real, work)
+            copy_times(real, work)
+
+            stat = os.stat(work)
+
+            return work, (real, stat.st_size, stat.st_mtime)
+
+        pool = ThreadPool(max(1, min(int(workers), len(to_copy) or 1)))
+
+        try:
+            self.staged.update(pool.map(copy_in, to_copy, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+
+        return sum(size for real, size, mtime in self.staged.values())
+
+    # ~~~~~~~~~~~~~~~~ SYNC BACK ~~~~~~~~~~~~~~~~ #
+    def outputs(self):
+        """
+        :return: tuple (directories, files, sym-links) under the work folder that the run made or changed
+        """
+
+        directories, files, links = [], [], []
+
+        for dir_path, dir_names, file_names in os.walk(self.work_folder):
+
+            directories.append(dir_path)
+
+            for name in file_names:
+
+                work = path.join(dir_path, name)
+
+                if work in self.linked:
+                    continue
+
+                elif path.islink(work):
+                    links.append(work)
+
+                elif work not in self.staged or self.changed(work):
+                    files.append(work)
+
+            # sym-links to directories are listed with the directories
+            links.extend(path.join(dir_path, name) for name in dir_names
+                         if path.islink(path.join(dir_path, name)) and path.join(dir_path, name) not in self.linked)
+
+            dir_names[:] = [name for name in dir_names if not path.islink(path.join(dir_path, name))]
+
+        return directories, files, links
+
+    def changed(self, work):
+        """
+        :param work: staged path
+        :return: Boolean, True if the run re-wrote the staged file, or removed it (e.g. a stage clearing its outputs)
+        """
+
+        real, size, mtime = self.staged[work]
+
+        if not path.exists(work):
+            return True
+
+        stat = os.stat(work)
+
+        return (stat.st_size, stat.st_mtime) != (size, mtime)
+
+    def sync_back(self, workers=1):
+        """
+        Copies the run's outputs back to the subject folder.
+
+        :param workers: copies run at once
+        :return: list of real paths written
+        :raise SyncError: when a copy does not match its source
+        """
+
+        directories, files, links = self.outputs()
+
+        for directory in directories:
+            if not path.isdir(self.real_path(directory)):
+                os.makedirs(self.real_path(directory))
+
+        # STAGED INPUTS BY INODE: a hard link to one of them becomes a link to the real input, not a copy
+        # (staged files the run removed count as changed, they are left out)
+        staged_inodes = dict(((os.stat(work).st_dev, os.stat(work).st_ino), real)
+                             for work, (real, size, mtime) in self.staged.items() if not self.changed(work))
+
+        def copy_out(work):
+
+            real = self.real_path(work)
+            stat = os.stat(work)
+
+            if (stat.st_dev, stat.st_ino) in staged_inodes:
+                hcp_fs.copy_file(staged_inodes[(stat.st_dev, stat.st_ino)], real, allow_link=True)
+                return real
+
+            expected = hcp_fs.file_sha1(work)
+
+            for attempt in range(2):
+
+                hcp_fs.copy_file(work, real + SYNC_TMP_SUFFIX)
+
+                if hcp_fs.file_sha1(real + SYNC_TMP_SUFFIX) == expected:
+                    copy_times(work, real + SYNC_TMP_SUFFIX)
+                    os.rename(real + SYNC_TMP_SUFFIX, real)
+                    return real
+
+            hcp_fs.remove_path(real + SYNC_TMP_SUFFIX)
+
+            raise SyncError('copy of %s to %s does not match its sha1 (%s)' % (work, real, expected))
+
+        pool = ThreadPool(max(1, min(int(workers), len(files) or 1)))
+
+        try:
+            synced = pool.map(copy_out, files, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        # LINKS WITHIN THE SUBJECT FOLDER POINT AT THE SAME FILES ON THE REAL SIDE
+        link_targets = {}
+
+        for work in links:
+
+            target = os.readlink(work)
+
+            if target.startswith(self.root + '/'):
+                target = target[len(self.root):]
+
+            if target != self.real_path(work):
+                link_targets[target] = self.real_path(work)
+
+        return synced + hcp_fs.make_links(link_targets)
+
+    def cleanup(self):
+
+        hcp_fs.remove_path(self.root)
+
+
+def copy_times(src, dst):
+
+    stat = os.stat(src)
+
+    os.utime(dst, (stat.st_atime, stat.st_mtime))
@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+"""
+Stage graph & scheduler for hcp_postprocess.
+
+Each step of the post-processing flow is declared as a Stage (callable, input paths, output paths, stages it depends
+on). A StageGraph starts every stage whose dependencies have finished and whose inputs exist, up to a limit on the
+number of stages running at once. The steps mostly wait on external binaries (fslmaths, wb_command, octave...), so
+stages are run in threads.
+
+With a StageCache, each finished stage leaves a manifest (fingerprints of its inputs & outputs, hash of its
+parameters) and is skipped on re-runs as long as none of those changed. Paths inside the subject folder are kept
+relative to it, so the manifests still hold when the folder is run from another place (--scratch).
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+import time
+from functools import partial
+from os import path
+
+# files bigger than this are fingerprinted by size + mtime only, hashing multi-GB ciftis on every run costs too much
+HASH_SIZE_LIMIT = 256 * 1024 * 1024
+
+# copies that keep their source's mtime (os.utime) only keep it to the microsecond
+MTIME_TOLERANCE = 1e-6
+
+# stands for the subject folder in manifests & parameter signatures
+SUBJECT_FOLDER = '$SUBJECT'
+
+
+class Stage(object):
+    """
+    One step of the pipeline.
+
+    :parameter name: unique stage name, e.g. 'flirt_t1_2mm' or 'REST1_means'
+    :parameter func: callable run (without args) when the stage starts; its return value is kept in graph.results
+    :parameter inputs: paths that must exist before the stage can start
+    :parameter outputs: paths the stage creates; a stage without any (a check, an in-place edit) is never skipped as
+                        up to date, there is nothing to tell whether its work is still there
+    :parameter depends: names of stages that must finish first
+    :parameter locks: names of shared resources (e.g. a .spec file) only one running stage may hold at a time
+    """
+
+    def __init__(self, name, func, inputs=None, outputs=None, depends=None, locks=None):
+
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.depends = list(depends or [])
+        self.locks = list(locks or [])
+
+    def missing_inputs(self):
+
+        return [input_path for input_path in self.inputs if not path.exists(input_path)]
+
+    def remove_outputs(self):
+        """
+        Removes whatever is left of this stage's outputs from a previous run, so nothing stale survives a re-run.
+        """
+
+        for output in self.outputs:
+
+            if path.isdir(output) and not path.islink(output):
+                shutil.rmtree(output)
+            elif path.lexists(output):
+                os.remove(output)
+
+    def params_signature(self, folders=()):
+        """
+        :param folders: paths that stand for the subject folder (e.g. a scratch copy & the real one), written as
+                        SUBJECT_FOLDER before hashing so the same stage of a relocated subject hashes the same
+        :return: sha1 of the function name & arguments this stage was declared with (project config values, TR...)
+        """
+
+        func = self.func
+        args = []
+        keywords = {}
+
+        while isinstance(func, partial):
+            args = list(func.args) + args
+            keywords = dict(func.keywords or {}, **keywords)
+            func = func.func
+
+        description = json.dumps({
+            'func'          : getattr(func, '__name__', repr(func))
+            , 'args'        : args
+            , 'keywords'    : keywords
+        }, sort_keys=True, default=str)
+
+        # LONGEST FIRST, A SCRATCH COPY'S PATH ENDS WITH THE REAL ONE
+        for folder in sorted(folders, key=len, reverse=True):
+            description = description.replace(folder.rstrip('/'), SUBJECT_FOLDER)
+
+        return hashlib.sha1(description).hexdigest()
+
+    def __repr__(self):
+
+        return 'Stage(%r)' % self.name
+
+
+def file_fingerprint(file_path, with_hash=True):
+    """
+    :param file_path: path to a file (or directory)
+    :param with_hash: also compute a sha1 of the contents (skipped for directories and files above HASH_SIZE_LIMIT)
+    :return: dict (size, mtime, sha1) or None if the path does not exist
+    """
+
+    if not path.exists(file_path):
+        return None
+
+    stat = os.stat(file_path)
+
+    fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': None}
+
+    if with_hash and path.isfile(file_path) and stat.st_size <= HASH_SIZE_LIMIT:
+
+        sha1 = hashlib.sha1()
+
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha1.update(block)
+
+        fingerprint['sha1'] = sha1.hexdigest()
+
+    return fingerprint
+
+
+class StageCache(object):
+    """
+    Keeps one JSON manifest per stage in cache_dir, recording what the stage last ran with and what it produced.
+
+    :parameter cache_dir: where the manifests go, e.g. <subject folder>/.hcp_postprocess_cache
+    :parameter subject_folder: optional folder whose paths are recorded relative to it
+    :parameter aliases: other paths standing for the same subject folder in stage parameters (--scratch: the real one)
+    """
+
+    def __init__(self, cache_dir, subject_folder=None, aliases=()):
+
+        self.cache_dir = cache_dir
+        self.subject_folder = path.abspath(subject_folder) if subject_folder else None
+        self.folders = [folder for folder in [self.subject_folder] + list(aliases) if folder]
+
+        if not path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, file_path):
+        """
+        :return: file_path as recorded: relative to the subject folder if inside it, else absolute
+        """
+
+        file_path = path.abspath(file_path)
+
+        if self.subject_folder and file_path.startswith(self.subject_folder + '/'):
+            return path.relpath(file_path, self.subject_folder)
+
+        return file_path
+
+    def file_path(self, key):
+
+        return key if path.isabs(key) else path.join(self.subject_folder, key)
+
+    def recorded_files(self):
+        """
+        :return: sorted list of the subject folder's files named in the manifests (relative paths), e.g. to stage them
+        """
+
+        recorded = set()
+
+        for manifest_name in os.listdir(self.cache_dir):
+
+            if manifest_name.endswith('.json'):
+
+                manifest = self.load(manifest_name[:-len('.json')]) or {}
+
+                recorded.update(key for files in (manifest.get('inputs', {}), manifest.get('outputs', {}))
+                                for key in files if not path.isabs(key))
+
+        return sorted(recorded)
+
+    def manifest_path(self, stage_name):
+
+        return path.join(self.cache_dir, stage_name + '.json')
+
+    def load(self, stage_name):
+
+        manifest_path = self.manifest_path(stage_name)
+
+        if not path.exists(manifest_path):
+            return None
+
+        try:
+            with open(manifest_path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def invalidate(self, stage_name):
+
+        manifest_path = self.manifest_path(stage_name)
+
+        if path.exists(manifest_path):
+            os.remove(manifest_path)
+
+    def clear(self):
+
+        for manifest in os.listdir(self.cache_dir):
+            if manifest.endswith('.json'):
+                os.remove(path.join(self.cache_dir, manifest))
+
+    def is_fresh(self, stage, input_paths):
+        """
+        :param stage: Stage
+        :param input_paths: everything the stage reads (its inputs + outputs of the stages it depends on)
+        :return: Boolean, True if the stage ran before with the same parameters, unchanged inputs & intact outputs
+        """
+
+        if not stage.outputs:
+            return False
+
+        manifest = self.load(stage.name)
+
+        if not manifest or manifest.get('params') != stage.params_signature(self.folders):
+            return False
+
+        if sorted(manifest['inputs'].keys()) != sorted(self.key(input_path) for input_path in input_paths) or \
+                sorted(manifest['outputs'].keys()) != sorted(self.key(output) for output in stage.outputs):
+            return False
+
+        # a stage whose outputs were not all there when it finished is always re-run
+        if None in manifest['outputs'].values():
+            return False
+
+        for recorded_files in (manifest['inputs'], manifest['outputs']):
+
+            for key, recorded in recorded_files.items():
+
+                if not self._unchanged(self.file_path(key), recorded):
+                    return False
+
+        return True
+
+    def record(self, stage, input_paths):
+        """
+        Writes the manifest of a stage that just finished.
+        """
+
+        manifest = {
+            'stage'         : stage.name
+            , 'params'      : stage.params_signature(self.folders)
+            , 'inputs'      : dict((self.key(input_path), file_fingerprint(input_path)) for input_path in input_paths)
+            , 'outputs'     : dict((self.key(output), file_fingerprint(output)) for output in stage.outputs)
+            , 'finished'    : time.time()
+        }
+
+        temp_path = self.manifest_path(stage.name) + '.tmp'
+
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+        os.rename(temp_path, self.manifest_path(stage.name))
+
+    @staticmethod
+    def _unchanged(file_path, recorded):
+
+        if recorded is None:
+            return not path.exists(file_path)
+
+        current = file_fingerprint(file_path, with_hash=False)
+
+        if current is None or current['size'] != recorded['size']:
+            return False
+
+        if abs(current['mtime'] - recorded['mtime']) <= MTIME_TOLERANCE:
+            return True
+
+        # touched since: only trust it if the contents hash the same
+        if recorded['sha1'] is None:
+            return False
+
+        return file_fingerprint(file_path)['sha1'] == recorded['sha1']
+
+
+class StageGraph(object):
+    """
+    Holds the declared stages of one subject and runs them in dependency order.
+    """
+
+    def __init__(self):
+
+        self.stages = []
+        self.results = {}
+        self.failed = {}
+        self.skipped = []
+        self.cached = []
+        self.elapsed = {}
+
+    def add(self, name, func, inputs=None, outputs=None, depends=None, locks=None):
+        """
+        Declares a new stage (see Stage for params). Dependencies must already be declared.
+
+        :return: the new Stage
+        """
+
+        known_names = [stage.name for stage in self.stages]
+
+        if name in known_names:
+            raise ValueError('stage "%s" is declared twice' % name)
+
+        unknown = [dep for dep in (depends or []) if dep not in known_names]
+
+        if unknown:
+            raise ValueError('stage "%s" depends on undeclared stage(s): %s' % (name, ', '.join(unknown)))
+
+        stage = Stage(name, func, inputs, outputs, depends, locks)
+
+        self.stages.append(stage)
+
+        return stage
+
+    def get(self, name):
+
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+
+        raise KeyError(name)
+
+    def downstream_of(self, name):
+        """
+        :param name: stage name
+        :return: list of names of every stage that (directly or not) depends on the given stage, declared order
+        """
+
+        affected = set([name])
+
+        for stage in self.stages:
+            if affected.intersection(stage.depends):
+                affected.add(stage.name)
+
+        return [stage.name for stage in self.stages if stage.name in affected and stage.name != name]
+
+    def stage_reads(self, stage):
+        """
+        :param stage: Stage
+        :return: list of paths the stage reads: its declared inputs plus the outputs of the stages it depends on
+        """
+
+        input_paths = list(stage.inputs)
+
+        for dep in stage.depends:
+            input_paths.extend(output for output in self.get(dep).outputs if output not in input_paths)
+
+        return input_paths
+
+    def run(self, max_workers=1, cache=None, force_stages=None, tracer=None):
+        """
+        Runs all declared stages, at most max_workers at once. A stage that raises (or calls sys.exit) is marked
+        failed and every stage downstream of it is skipped; the others carry on.
+
+        :param max_workers: max number of stages running at once
+        :param cache: optional StageCache; stages whose manifest is still valid are not run again
+        :param force_stages: names of stages to run regardless of the cache (along with everything downstream)
+        :param tracer: optional hcp_trace.Tracer, gets a span per stage (run, up to date, failed or skipped)
+        :return: Boolean, True if every stage succeeded (or was up to date)
+        """
+
+        max_workers = max(1, int(max_workers))
+
+        forced = set()
+
+        for name in force_stages or []:
+            self.get(name)
+            forced.add(name)
+            forced.update(self.downstream_of(name))
+
+        if cache:
+            for name in forced:
+                cache.invalidate(name)
+
+        condition = threading.Condition()
+
+        waiting = list(self.stages)
+        running = {}
+        held_locks = set()
+        done = set()
+
+        def run_stage(stage):
+
+            start = time.time()
+
+            span = tracer.start(stage.name) if tracer else None
+
+            try:
+                stage.remove_outputs()
+                result = stage.func()
+                error = None
+                if cache:
+                    cache.record(stage, self.stage_reads(stage))
+            except (SystemExit, Exception), e:
+                result = None
+                error = '%s: %s' % (type(e).__name__, e)
+                if cache:
+                    cache.invalidate(stage.name)
+
+            if tracer:
+                tracer.finish(span, 'ok' if error is None else 'failed', error=error)
+
+            with condition:
+
+                self.elapsed[stage.name] = time.time() - start
+
+                if error is None:
+                    self.results[stage.name] = result
+                    done.add(stage.name)
+                    print '\n[stage] finished %s (%.1fs)' % (stage.name, self.elapsed[stage.name])
+                else:
+                    self.failed[stage.name] = error
+                    print '\n[stage] FAILED %s (%.1fs)\n\t%s' % (stage.name, self.elapsed[stage.name], error)
+
+                del running[stage.name]
+                held_locks.difference_update(stage.locks)
+
+                condition.notify()
+
+        with condition:
+
+            while waiting or running:
+
+                started = False
+
+                for stage in list(waiting):
+
+                    blocked_by = [dep for dep in stage.depends if dep in self.failed or dep in self.skipped]
+
+                    if blocked_by:
+                        print '\n[stage] skipping %s, upstream stage(s) did not finish: %s' % (
+                            stage.name, ', '.join(blocked_by))
+                        self.skipped.append(stage.name)
+                        waiting.remove(stage)
+                        if tracer:
+                            tracer.instant(stage.name, status='skipped', blocked_by=blocked_by)
+                        continue
+
+                    if len(running) >= max_workers:
+                        break
+
+                    if [dep for dep in stage.depends if dep not in done]:
+                        continue
+
+                    if cache and stage.name not in forced and cache.is_fresh(stage, self.stage_reads(stage)):
+                        print '\n[stage] up to date, skipping %s' % stage.name
+                        waiting.remove(stage)
+                        self.cached.append(stage.name)
+                        done.add(stage.name)
+                        if tracer:
+                            tracer.instant(stage.name, status='cached')
+                        started = True
+                        continue
+
+                    if held_locks.intersection(stage.locks) or stage.missing_inputs():
+                        continue
+
+                    waiting.remove(stage)
+                    held_locks.update(stage.locks)
+
+                    worker = threading.Thread(target=run_stage, args=(stage,), name=stage.name)
+                    worker.daemon = True
+                    running[stage.name] = worker
+
+                    print '\n[stage] starting %s' % stage.name
+                    worker.start()
+
+                    started = True
+
+                if started:
+                    continue
+
+                if not running and waiting:
+
+                    # nothing left that could produce the missing inputs of the stages still waiting
+                    stage = waiting.pop(0)
+                    self.failed[stage.name] = 'missing inputs: %s' % ', '.join(stage.missing_inputs())
+                    print '\n[stage] FAILED %s\n\t%s' % (stage.name, self.failed[stage.name])
+                    if tracer:
+                        tracer.instant(stage.name, status='failed', error=self.failed[stage.name])
+                    continue
+
+                if running:
+                    # wake up regularly: py2 Condition.wait() without a timeout cannot be interrupted by ctrl-c
+                    condition.wait(1.0)
+
+        return not self.failed and not self.skipped
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+Per-stage tracing for hcp_postprocess.
+
+A Tracer records one span per pipeline stage (wall time, CPU time, peak RSS of child processes, bytes read/written)
+and writes them as a Chrome trace (open in chrome://tracing or ui.perfetto.dev) plus a per-stage JSON summary that
+can be aggregated across a batch.
+
+Stages run in threads of one process and the external binaries they start are children of that process, so CPU
+time of children, bytes read/written and children's peak RSS are process-wide counters: a span gets their change
+while it ran, and spans that overlap share what happened in that time. Python CPU time is the stage's own thread.
+"""
+
+import os
+import json
+import time
+import socket
+import resource
+import threading
+
+# getrusage(RUSAGE_THREAD) is Linux-only and only named in the resource module from py3.2 on
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+
+def resource_snapshot():
+    """
+    :return: dict of cumulative counters: CPU seconds of this thread & of reaped children, children's peak RSS (KB),
+             bytes read & written by this process (incl. reaped children) as reported by /proc/self/io
+    """
+
+    try:
+        thread_usage = resource.getrusage(RUSAGE_THREAD)
+        thread_cpu = thread_usage.ru_utime + thread_usage.ru_stime
+    except (ValueError, resource.error):
+        thread_cpu = time.clock()
+
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    snapshot = {
+        'thread_cpu'            : thread_cpu
+        , 'children_cpu'        : children.ru_utime + children.ru_stime
+        , 'children_maxrss_kb'  : children.ru_maxrss
+        , 'read_bytes'          : 0
+        , 'write_bytes'         : 0
+    }
+
+    try:
+        with open('/proc/self/io', 'r') as f:
+            io = dict(line.split(':') for line in f if ':' in line)
+        # rchar / wchar: everything read / written through syscalls, page cache hits included
+        snapshot['read_bytes'] = int(io['rchar'])
+        snapshot['write_bytes'] = int(io['wchar'])
+    except (IOError, KeyError, ValueError):
+        pass
+
+    return snapshot
+
+
+class Span(object):
+    """
+    One timed piece of work (a stage, a REST series...); filled in by Tracer.start / Tracer.finish.
+    """
+
+    def __init__(self, name, category, lane, start, snapshot):
+
+        self.name = name
+        self.category = category
+        self.lane = lane
+        self.start = start
+        self.snapshot = snapshot
+        self.end = None
+        self.status = None
+        self.stats = {}
+        self.args = {}
+
+
+class Tracer(object):
+    """
+    Collects spans from any thread. Spans running at the same time are put on different lanes (trace 'threads').
+
+    :parameter name: shown as the process name in the trace, e.g. the subject ID
+    """
+
+    def __init__(self, name):
+
+        self.name = name
+        self.origin = time.time()
+        self.spans = []
+
+        self._lock = threading.Lock()
+        self._busy_lanes = set()
+
+    def start(self, name, category='stage', **args):
+        """
+        Opens a span, to be closed with finish() from the same thread.
+
+        :return: Span
+        """
+
+        with self._lock:
+            lane = 0
+            while lane in self._busy_lanes:
+                lane += 1
+            self._busy_lanes.add(lane)
+
+        span = Span(name, category, lane, time.time(), resource_snapshot())
+        span.args.update(args)
+
+        return span
+
+    def finish(self, span, status='ok', **args):
+        """
+        Closes a span, storing wall time and the change of each resource counter while it ran.
+
+        :return: Span
+        """
+
+        span.end = time.time()
+        span.status = status
+        span.args.update(args)
+
+        snapshot = resource_snapshot()
+
+        span.stats = {
+            'wall_s'                : round(span.end - span.start, 6)
+            , 'cpu_s'               : round(snapshot['thread_cpu'] - span.snapshot['thread_cpu'] +
+                                            snapshot['children_cpu'] - span.snapshot['children_cpu'], 6)
+            , 'python_cpu_s'        : round(snapshot['thread_cpu'] - span.snapshot['thread_cpu'], 6)
+            , 'children_cpu_s'      : round(snapshot['children_cpu'] - span.snapshot['children_cpu'], 6)
+            , 'children_maxrss_kb'  : snapshot['children_maxrss_kb']
+            , 'read_bytes'          : snapshot['read_bytes'] - span.snapshot['read_bytes']
+            , 'write_bytes'         : snapshot['write_bytes'] - span.snapshot['write_bytes']
+        }
+
+        with self._lock:
+            self._busy_lanes.discard(span.lane)
+            self.spans.append(span)
+
+        return span
+
+    def instant(self, name, category='stage', status='cached', **args):
+        """
+        Records a zero-length span, e.g. for a stage skipped because it was up to date.
+        """
+
+        return self.finish(self.start(name, category, **args), status)
+
+    def group_spans(self, groups):
+        """
+        Adds one span per group (e.g. per REST series) covering its member spans, from the first start to the last end.
+
+        :param groups: dict of group name -> list of span (stage) names
+        :return: list of new Spans
+        """
+
+        added = []
+
+        for group_name, member_names in sorted(groups.items()):
+
+            members = [span for span in self.spans if span.name in member_names]
+
+            if not members:
+                continue
+
+            span = Span(group_name, 'series', 0, min(member.start for member in members), {})
+            span.end = max(member.end for member in members)
+            span.status = 'failed' if [member for member in members if member.status == 'failed'] else 'ok'
+            span.stats = {'wall_s': round(span.end - span.start, 6)}
+
+            for counter in ('cpu_s', 'python_cpu_s', 'children_cpu_s', 'read_bytes', 'write_bytes'):
+                span.stats[counter] = sum(member.stats.get(counter, 0) for member in members)
+
+            span.stats['children_maxrss_kb'] = max(member.stats.get('children_maxrss_kb', 0) for member in members)
+            span.args['stages'] = sorted(member.name for member in members)
+
+            added.append(span)
+
+        with self._lock:
+            self.spans.extend(added)
+
+        return added
+
+    def chrome_trace(self):
+        """
+        :return: dict in the Chrome trace event format (complete 'X' events, microseconds from the tracer's start)
+        """
+
+        pid = os.getpid()
+
+        # series spans get their own lanes below the stage lanes
+        series_lane = 1 + max([span.lane for span in self.spans if span.category != 'series'] or [0])
+
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': self.name}}]
+
+        series_spans = sorted([span for span in self.spans if span.category == 'series'], key=lambda span: span.start)
+
+        for series_num, span in enumerate(series_spans):
+            span.lane = series_lane + series_num
+
+        for span in sorted(self.spans, key=lambda span: span.start):
+
+            args = dict(span.args, status=span.status, **span.stats)
+
+            events.append({
+                'name'      : span.name
+                , 'cat'     : span.category
+                , 'ph'      : 'X'
+                , 'ts'      : int(round((span.start - self.origin) * 1e6))
+                , 'dur'     : int(round((span.end - span.start) * 1e6))
+                , 'pid'     : pid
+                , 'tid'     : span.lane
+                , 'args'    : args
+            })
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def summary(self):
+        """
+        :return: dict (host, start, total wall time, one entry per span in start order), JSON-ready
+        """
+
+        spans = sorted(self.spans, key=lambda span: span.start)
+
+        return {
+            'name'          : self.name
+            , 'host'        : socket.gethostname()
+            , 'started'     : self.origin
+            , 'wall_s'      : round(max([span.end for span in spans] or [self.origin]) - self.origin, 6)
+            , 'spans'       : [dict(span.stats, name=span.name, category=span.category, status=span.status,
+                                    start_s=round(span.start - self.origin, 6)) for span in spans]
+        }
+
+    def write(self, trace_path, summary_path):
+        """
+        Writes the Chrome trace & the per-stage summary.
+
+        :return: tuple (trace_path, summary_path)
+        """
+
+        for out_path, content in ((trace_path, self.chrome_trace()), (summary_path, self.summary())):
+
+            with open(out_path + '.tmp', 'w') as f:
+                json.dump(content, f, indent=1, sort_keys=True)
+
+            os.rename(out_path + '.tmp', out_path)
+
+        return trace_path, summary_path
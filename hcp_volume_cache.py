@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""
+Per-subject cache of decoded NIfTI volumes, shared by every stage of hcp_postprocess.
+
+A .nii.gz read by several stages (T1w_restore_brain, each RESTn, wmparc.2, the masks...) is decompressed once, into
+an uncompressed .nii under a folder on local disk: nibabel memory-maps it and the FSL tools (slices, flirt, fslmeants,
+fslmaths) are handed that path, so none of them gunzips the file again. Whole volumes decoded by the native engines
+are also kept in RAM, least recently used out first once over a size budget.
+
+Entries are keyed by path + mtime + size, so a stage re-writing an input (e.g. forced masks) never gets a stale copy.
+A file that cannot be decompressed to the cache (disk full, a .nii.gz that is not gzipped) is read in place instead.
+Until open_cache is called every function reads the original file, as if there were no cache.
+"""
+
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from os import path
+
+import hcp_fs
+
+try:
+    import numpy as np  # decoded volumes, optional: local_path only needs the standard library
+    import nibabel as nib
+except ImportError:
+    np = nib = None
+
+_cache_lock = threading.Lock()
+
+# key -> lock, so two stages asking for the same file at once decompress it only once
+_key_locks = {}
+
+# (path, mtime, size) -> uncompressed copy
+_local_paths = {}
+
+# (path, mtime, size, first_volume, dtype) -> (read-only array, nibabel image, bytes), least recently used first
+_arrays = OrderedDict()
+
+_state = {
+    'root'          : None  # folder of the uncompressed copies, None = cache closed
+    , 'ram_budget'  : 0     # max bytes of decoded arrays held in RAM
+    , 'ram_bytes'   : 0
+}
+
+
+# ~~~~~~~~~~~~~~~~ LIFETIME ~~~~~~~~~~~~~~~~ #
+def open_cache(cache_dir=None, ram_budget_bytes=0):
+    """
+    :param cache_dir: local disk or tmpfs to decompress to (a private folder is made inside), None = system temp dir
+    :param ram_budget_bytes: max bytes of decoded arrays kept in RAM, 0 = none
+    :return: path to the cache folder
+    """
+
+    close_cache()
+
+    if cache_dir and not path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    with _cache_lock:
+        _state['root'] = tempfile.mkdtemp(prefix='hcp_volume_cache_', dir=cache_dir or None)
+        _state['ram_budget'] = int(ram_budget_bytes)
+
+        return _state['root']
+
+
+def close_cache():
+    """
+    Drops every cached volume and removes the uncompressed copies.
+    """
+
+    with _cache_lock:
+        root = _state['root']
+
+        _state['root'] = None
+        _state['ram_bytes'] = 0
+
+        _key_locks.clear()
+        _local_paths.clear()
+        _arrays.clear()
+
+    if root and path.isdir(root):
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def file_key(nifti_path):
+
+    nifti_path = path.abspath(nifti_path)
+
+    stat = os.stat(nifti_path)
+
+    return nifti_path, stat.st_mtime, stat.st_size
+
+
+def key_lock(key):
+
+    with _cache_lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+# ~~~~~~~~~~~~~~~~ UNCOMPRESSED COPIES ~~~~~~~~~~~~~~~~ #
+def local_path(nifti_path):
+    """
+    :param nifti_path: .nii / .nii.gz
+    :return: path to an uncompressed copy of a .nii.gz in the cache (made on first use), else nifti_path itself
+    """
+
+    # A MISSING FILE IS LEFT FOR THE READER TO REPORT
+    if _state['root'] is None or not nifti_path.endswith('.gz') or not path.isfile(nifti_path):
+        return nifti_path
+
+    key = file_key(nifti_path)
+
+    with key_lock(key):
+
+        with _cache_lock:
+            if key in _local_paths:
+                return _local_paths[key]
+
+            root = _state['root']
+
+        if root is None:
+            return nifti_path
+
+        # SAME FILE NAME (FSL TOOLS KEEP IT IN THEIR OUTPUT & LOGS), ONE FOLDER PER VERSION OF THE FILE
+        copy_dir = path.join(root, hashlib.sha1(repr(key)).hexdigest()[:16])
+        copy_path = path.join(copy_dir, path.basename(nifti_path)[:-len('.gz')])
+
+        try:
+            if not path.isdir(copy_dir):
+                os.makedirs(copy_dir)
+
+            source = gzip.open(nifti_path, 'rb')
+
+            try:
+                with open(copy_path + '.part', 'wb') as destination:
+                    shutil.copyfileobj(source, destination, 16 * 1024 * 1024)
+            finally:
+                source.close()
+
+            os.rename(copy_path + '.part', copy_path)
+
+        except (IOError, OSError), e:
+            # NO ROOM LEFT, NOT REALLY GZIPPED (FSL READS THOSE FINE)... -> READERS GET THE ORIGINAL FILE
+            print '\nNot caching %s, reading it in place: %s' % (nifti_path, e)
+
+            # THE FOLDER ONLY EVER HOLDS THIS FILE, .part INCLUDED
+            hcp_fs.remove_path(copy_dir)
+
+            # NOT TRIED AGAIN FOR THIS VERSION OF THE FILE
+            copy_path = nifti_path
+
+        with _cache_lock:
+            if _state['root'] == root:
+                _local_paths[key] = copy_path
+
+        return copy_path
+
+
+def load_image(nifti_path):
+    """
+    :return: nibabel image, read from the uncompressed copy (memory-mapped) when there is one
+    """
+
+    return nib.load(local_path(nifti_path))
+
+
+# ~~~~~~~~~~~~~~~~ DECODED ARRAYS ~~~~~~~~~~~~~~~~ #
+def load_data(nifti_path, first_volume=False, dtype=None):
+    """
+    :param nifti_path: .nii / .nii.gz
+    :param first_volume: only the first volume of a 4D image
+    :param dtype: optional dtype to convert to (e.g. np.float32), the converted array is what gets cached
+    :return: tuple (read-only data array (scaled, original dtype when unscaled and no dtype), nibabel image)
+    """
+
+    key = file_key(nifti_path) + (first_volume, np.dtype(dtype).str if dtype else None)
+
+    with _cache_lock:
+        if key in _arrays:
+            _arrays[key] = _arrays.pop(key)
+            return _arrays[key][:2]
+
+    img = load_image(nifti_path)
+
+    if first_volume and len(img.shape) > 3:
+        # only reads (or decompresses) up to the end of the first volume
+        data = img.dataobj[..., 0]
+    else:
+        data = np.asanyarray(img.dataobj)
+
+    if dtype is not None:
+        # A PLAIN IN-MEMORY ARRAY, astype WOULD KEEP THE np.memmap CLASS OF A MEMORY-MAPPED VOLUME
+        data = np.array(data, dtype=dtype)
+
+    # CALLERS SHARE THE ARRAY, NONE MAY CHANGE IT
+    data = data.view()
+    data.flags.writeable = False
+
+    # A MEMORY-MAPPED ARRAY LIVES IN THE PAGE CACHE, NOT IN THE BUDGET
+    size = 0 if isinstance(data, np.memmap) else data.nbytes
+
+    with _cache_lock:
+        if _state['root'] is not None and size <= _state['ram_budget']:
+
+            if key not in _arrays:
+                _arrays[key] = (data, img, size)
+                _state['ram_bytes'] += size
+
+            while _state['ram_bytes'] > _state['ram_budget']:
+                evicted_data, evicted_img, evicted_size = _arrays.popitem(last=False)[1]
+                _state['ram_bytes'] -= evicted_size
+
+    return data, img
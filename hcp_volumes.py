@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+"""
+In-process (NumPy / nibabel) versions of the FSL volume steps of hcp_postprocess.
+
+Each function reproduces the fslmaths (etc.) call chain it replaces, voxel for voxel, while reading its inputs once
+and keeping intermediates in memory instead of writing and re-reading them as .nii.gz files.
+"""
+
+import gzip
+import numpy as np
+import nibabel as nib
+
+import hcp_volume_cache
+
+
+# ~~~~~~~~~~~~~~~~ VOLUME I/O ~~~~~~~~~~~~~~~~ #
+def load_volume(nifti_path):
+    """
+    :param nifti_path: path to .nii or .nii.gz
+    :return: tuple (read-only data ndarray (scaled, original dtype when unscaled), nibabel image), decoded once per
+             subject (see hcp_volume_cache)
+    """
+
+    return hcp_volume_cache.load_data(nifti_path)
+
+
+def save_like(data, reference_img, out_path, dtype=None):
+    """
+    Writes data with the header (geometry, datatype) of reference_img, the way fslmaths keeps the input's header.
+
+    :param data: ndarray with the spatial shape of reference_img
+    :param reference_img: nibabel image the header is copied from
+    :param out_path: path to .nii / .nii.gz to write
+    :param dtype: datatype on disk, defaults to the datatype of reference_img
+    :return: out_path
+    """
+
+    header = reference_img.header.copy()
+
+    header.set_data_dtype(dtype or reference_img.get_data_dtype())
+
+    out_img = reference_img.__class__(np.asarray(data), reference_img.affine, header)
+
+    nib.save(out_img, out_path)
+
+    return out_path
+
+
+# ~~~~~~~~~~~~~~~~ MASKING (fslmaths -thr / -uthr / -add / -bin / -kernel gauss / -ero) ~~~~~~~~~~~~~~~~ #
+def gaussian_kernel_support(sigma_mm, voxel_dims, cutoff=4.0):
+    """
+    Offsets covered by fslmaths' '-kernel gauss <sigma>' when used for morphology: FSL builds exp(-r^2 / 2sigma^2) on
+    a box of +/- ceil(cutoff * sigma / voxel size) voxels and its morphological filters only use kernel values > 0.5.
+
+    The masks use sigma 2 like the fslmaths version (make_wm_mask / make_vent_mask); whether a fixed size suits every
+    fMRI resolution is still an open question there.
+
+    :param sigma_mm: gaussian sigma, mm
+    :param voxel_dims: voxel sizes (x, y, z), mm
+    :param cutoff: box half-width in sigmas (FSL default 4)
+    :return: list of (dx, dy, dz) voxel offsets, including (0, 0, 0)
+    """
+
+    half_widths = [int(np.ceil(sigma_mm * cutoff / dim)) for dim in voxel_dims[:3]]
+
+    offsets = []
+
+    for dx in range(-half_widths[0], half_widths[0] + 1):
+        for dy in range(-half_widths[1], half_widths[1] + 1):
+            for dz in range(-half_widths[2], half_widths[2] + 1):
+
+                r2 = (dx * voxel_dims[0]) ** 2 + (dy * voxel_dims[1]) ** 2 + (dz * voxel_dims[2]) ** 2
+
+                if np.exp(-r2 / (2.0 * sigma_mm ** 2)) > 0.5:
+                    offsets.append((dx, dy, dz))
+
+    return offsets
+
+
+def erode(mask, offsets):
+    """
+    fslmaths -ero: a non-zero voxel is zeroed if any voxel under the kernel is zero. Voxels outside the image are
+    ignored (FSL only looks at in-bounds neighbours).
+
+    :param mask: 3D boolean array
+    :param offsets: kernel support, from gaussian_kernel_support
+    :return: eroded 3D boolean array
+    """
+
+    pad = max(max(abs(offset) for offset in offsets_xyz) for offsets_xyz in offsets)
+
+    # pad with True so out-of-bounds neighbours never erode anything
+    padded = np.pad(mask, pad, mode='constant', constant_values=True)
+
+    eroded = mask.copy()
+
+    nx, ny, nz = mask.shape
+
+    for dx, dy, dz in offsets:
+        eroded &= padded[pad + dx:pad + dx + nx, pad + dy:pad + dy + ny, pad + dz:pad + dz + nz]
+
+    return eroded
+
+
+def label_range_mask(seg_data, lower, upper):
+    """
+    fslmaths <seg> -thr lower -uthr upper, then -bin (non-zero, positive voxels).
+
+    :param seg_data: label volume
+    :param lower: lower threshold (inclusive)
+    :param upper: upper threshold (inclusive)
+    :return: 3D boolean array
+    """
+
+    return (seg_data >= lower) & (seg_data <= upper) & (seg_data > 0)
+
+
+def make_wm_vent_masks(seg_brain_path, project_config, wm_mask_out, vent_mask_out, kernel_sigma=2):
+    """
+    Loads the segmented brain (wmparc) once and writes both eroded masks that make_wm_mask / make_vent_mask build with
+    4 fslmaths calls each: L & R label ranges from project_config, combined & binarized, then eroded with a gaussian
+    kernel.
+
+    :param seg_brain_path: path to MNINonLinear/ROIs/wmparc.2.nii.gz
+    :param project_config: project settings with wm_lt_L ... vent_ut_R thresholds
+    :param wm_mask_out: path to write the eroded white matter mask
+    :param vent_mask_out: path to write the eroded ventricle mask
+    :param kernel_sigma: gaussian kernel sigma (mm) used for erosion
+    :return: tuple (path to eroded wm mask, path to eroded vent mask)
+    """
+
+    seg_data, seg_img = load_volume(seg_brain_path)
+
+    if seg_data.ndim > 3:
+        seg_data = seg_data[..., 0]
+
+    offsets = gaussian_kernel_support(kernel_sigma, seg_img.header.get_zooms()[:3])
+
+    for tissue, out_path in (('wm', wm_mask_out), ('vent', vent_mask_out)):
+
+        mask = label_range_mask(seg_data, project_config[tissue + '_lt_L'], project_config[tissue + '_ut_L']) | \
+            label_range_mask(seg_data, project_config[tissue + '_lt_R'], project_config[tissue + '_ut_R'])
+
+        save_like(erode(mask, offsets).astype(seg_img.get_data_dtype()), seg_img, out_path)
+
+    return wm_mask_out, vent_mask_out
+
+
+# ~~~~~~~~~~~~~~~~ MEAN TIME-SERIES (fslmeants -m) ~~~~~~~~~~~~~~~~ #
+def iter_volume_chunks(nifti_path, max_chunk_bytes, voxel_indices=None):
+    """
+    Reads a 4D NIfTI in blocks of whole frames, in file order (one sequential pass, no decompress-to-disk). Frames are
+    contiguous in a NIfTI, so each block is a (frames, voxels) array with voxels in x-fastest (Fortran) order.
+    Uncompressed files, and the uncompressed copy hcp_volume_cache keeps of a .nii.gz, are memory-mapped.
+
+    :param nifti_path: path to .nii or .nii.gz
+    :param max_chunk_bytes: max bytes of raw data held at once (at least one frame is always read)
+    :param voxel_indices: optional flat (Fortran-order) voxel indices to keep, the rest is dropped before scaling
+    :return: generator of tuples (first frame index, float32 array (frames, voxels))
+    """
+
+    nifti_path = hcp_volume_cache.local_path(nifti_path)
+
+    # the array proxy knows where the data starts & how it is scaled, as read from the file's header
+    proxy = nib.load(nifti_path).dataobj
+
+    shape = proxy.shape
+
+    n_voxels = int(np.prod(shape[:3]))
+
+    n_frames = int(np.prod(shape[3:])) if len(shape) > 3 else 1
+
+    dtype = proxy.dtype
+
+    slope, inter = float(proxy.slope), float(proxy.inter)
+
+    frame_bytes = n_voxels * dtype.itemsize
+
+    frames_per_chunk = max(1, int(max_chunk_bytes // frame_bytes))
+
+    offset = proxy.offset
+
+    def scaled(raw):
+
+        if voxel_indices is not None:
+            raw = raw[:, voxel_indices]
+
+        block = np.array(raw, dtype=np.float32)
+
+        if slope != 1:
+            block *= slope
+        if inter != 0:
+            block += inter
+
+        return block
+
+    if nifti_path.endswith('.gz'):
+
+        stream = gzip.open(nifti_path, 'rb')
+
+        try:
+            stream.seek(offset)
+
+            for first_frame in range(0, n_frames, frames_per_chunk):
+
+                frames = min(frames_per_chunk, n_frames - first_frame)
+
+                raw = np.frombuffer(stream.read(frames * frame_bytes), dtype=dtype)
+
+                yield first_frame, scaled(raw.reshape(frames, n_voxels))
+        finally:
+            stream.close()
+
+    else:
+
+        data = np.memmap(nifti_path, dtype=dtype, mode='r', offset=offset, shape=(n_frames, n_voxels))
+
+        for first_frame in range(0, n_frames, frames_per_chunk):
+
+            yield first_frame, scaled(data[first_frame:first_frame + frames_per_chunk])
+
+
+def masked_means(nifti_path, mask_paths, max_chunk_bytes=256 * 1024 * 1024):
+    """
+    Mean of the voxels inside each mask, for every frame, from a single pass over the 4D file (fslmeants -m, for any
+    number of masks at once).
+
+    :param nifti_path: path to 4D .nii / .nii.gz (e.g. REST1.nii.gz)
+    :param mask_paths: list of 3D masks in the same space (voxels > 0.5 are in, like fslmeants)
+    :param max_chunk_bytes: bounds the raw data held in memory at once
+    :return: float64 array (frames, masks)
+    """
+
+    mask_indices = []
+
+    for mask_path in mask_paths:
+
+        mask_data, mask_img = load_volume(mask_path)
+
+        indices = np.flatnonzero(np.asarray(mask_data, dtype=np.float32).ravel(order='F') > 0.5)
+
+        if not indices.size:
+            raise ValueError('mask is empty: %s' % mask_path)
+
+        mask_indices.append(indices)
+
+    # read only the voxels inside any mask, then find each mask's columns within that subset
+    all_indices = np.unique(np.concatenate(mask_indices))
+
+    mask_columns = [np.searchsorted(all_indices, indices) for indices in mask_indices]
+
+    shape = hcp_volume_cache.load_image(nifti_path).shape
+
+    means = np.zeros((int(np.prod(shape[3:])) if len(shape) > 3 else 1, len(mask_paths)), dtype=np.float64)
+
+    for first_frame, block in iter_volume_chunks(nifti_path, max_chunk_bytes, all_indices):
+
+        for mask_num, columns in enumerate(mask_columns):
+
+            means[first_frame:first_frame + block.shape[0], mask_num] = \
+                block[:, columns].mean(axis=1, dtype=np.float64)
+
+    return means
+
+
+def write_meants(values, out_path):
+    """
+    Writes a single time-series the way fslmeants does: one value per line, 6 significant digits.
+
+    :param values: 1D array of per-frame values
+    :param out_path: path to _mean.txt
+    :return: out_path
+    """
+
+    with open(out_path, 'w') as f:
+        for value in values:
+            f.write('%g \n' % value)
+
+    return out_path
+
+
+# ~~~~~~~~~~~~~~~~ RESAMPLING (flirt -applyisoxfm, identity transform) ~~~~~~~~~~~~~~~~ #
+def fsl_voxel_mm(img):
+    """
+    :return: tuple (voxel sizes, whether FSL flips x), FSL's scaled-mm coordinates run along x reversed when the
+             voxel-to-world matrix has a positive determinant (neurological storage)
+    """
+
+    return np.asarray(img.header.get_zooms()[:3], dtype=np.float64), np.linalg.det(img.affine[:3, :3]) > 0
+
+
+def linear_weights(out_mm, in_size, in_voxel_mm, flip=False):
+    """
+    :param out_mm: FSL mm coordinate of each output voxel along one axis
+    :param in_size: input voxels along that axis
+    :param in_voxel_mm: input voxel size along that axis
+    :param flip: input x is stored reversed
+    :return: float64 array (output voxels, input voxels), linear interpolation weights, rows outside the input are 0
+    """
+
+    position = out_mm / in_voxel_mm
+
+    if flip:
+        position = (in_size - 1) - position
+
+    weights = np.zeros((len(out_mm), in_size))
+
+    inside = np.nonzero((position >= 0) & (position <= in_size - 1))[0]
+
+    lower = np.minimum(np.floor(position[inside]).astype(int), max(in_size - 2, 0))
+    fraction = position[inside] - lower
+
+    weights[inside, lower] = 1 - fraction
+
+    if in_size > 1:
+        weights[inside, lower + 1] += fraction
+
+    return weights
+
+
+def resample_isotropic(in_path, ref_path, out_path, voxel_mm):
+    """
+    Native `flirt -in in_path -ref ref_path -applyisoxfm voxel_mm -out out_path`: identity transform in FSL mm
+    coordinates, trilinear interpolation onto the reference field of view at voxel_mm isotropic. With an identity
+    transform & axis-aligned grids trilinear interpolation is separable, so it is three small matrix products.
+
+    :param in_path: e.g. MNINonLinear/T1w_restore_brain.nii.gz
+    :param ref_path: e.g. FSL_DIR/data/standard/MNI152_T1_2mm_brain.nii.gz
+    :param out_path: e.g. MNINonLinear/T1w_restore_brain.2.nii.gz
+    :param voxel_mm: output voxel size (mm)
+    :return: out_path
+    """
+
+    data, in_img = load_volume(in_path)
+    ref_img = nib.load(ref_path)
+
+    in_voxel_mm, in_flip = fsl_voxel_mm(in_img)
+    ref_voxel_mm, ref_flip = fsl_voxel_mm(ref_img)
+
+    out_shape = [max(1, int(round(size * voxel / voxel_mm))) for size, voxel in zip(ref_img.shape[:3], ref_voxel_mm)]
+
+    resampled = np.asarray(data, dtype=np.float32).reshape(data.shape[:3])
+
+    for axis in (0, 1, 2):
+
+        out_mm = np.arange(out_shape[axis]) * float(voxel_mm)
+
+        if axis == 0 and ref_flip:
+            out_mm = out_mm[::-1]
+
+        weights = linear_weights(out_mm, data.shape[axis], in_voxel_mm[axis], in_flip and axis == 0)
+
+        # CONTRACT ONE AXIS AT A TIME, THE NEW AXIS COMES FIRST SO ROLL IT BACK INTO PLACE
+        resampled = np.rollaxis(np.tensordot(weights.astype(np.float32), resampled, axes=(1, axis)), 0, axis + 1)
+
+    # REFERENCE GRID SCALED TO voxel_mm, INPUT DATATYPE
+    affine = ref_img.affine.copy()
+    affine[:3, :3] = affine[:3, :3] * (voxel_mm / ref_voxel_mm)
+
+    header = ref_img.header.copy()
+    header.set_data_shape(out_shape)
+    header.set_zooms([voxel_mm] * 3)
+    header.set_data_dtype(in_img.get_data_dtype())
+
+    if np.issubdtype(in_img.get_data_dtype(), np.integer):
+        resampled = np.round(resampled)
+
+    out_img = nib.Nifti1Image(resampled.astype(in_img.get_data_dtype()), affine, header)
+    out_img.set_sform(affine, int(ref_img.header['sform_code']) or 1)
+    out_img.set_qform(affine, int(ref_img.header['qform_code']) or 1)
+
+    nib.save(out_img, out_path)
+
+    return out_path